@@ -1,6 +1,9 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from app.core.cache import TTLCache
+from app.core.config import settings
 from app.core.database import get_db
 from app.core.security import verify_token
 from app.models.user import User
@@ -8,6 +11,44 @@ from app.schemas.auth import TokenData
 
 security = HTTPBearer()
 
+# Column snapshots of recently authenticated users keyed by id. A hit is
+# re-attached to the request's session without a query; an ORM update or
+# delete of the user (profile edits, deactivation, online status) in this
+# process drops it. Changes made by other workers or by bulk
+# ``query.update()`` do not fire those hooks, so the TTL is kept short: a
+# deactivated user stays signed in elsewhere for at most
+# ``auth_identity_cache_ttl`` seconds.
+identity_cache = TTLCache(maxsize=settings.auth_cache_max_entries, ttl=settings.auth_identity_cache_ttl)
+
+_USER_COLUMNS = tuple(attr.key for attr in inspect(User).column_attrs)
+
+
+def invalidate_user_identity(user_id: int) -> None:
+    """Forget the cached identity of a user"""
+    identity_cache.pop(user_id)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_identity(mapper, connection, target: User) -> None:
+    invalidate_user_identity(target.id)
+
+
+def _load_user(db: Session, user_id: int) -> User:
+    snapshot = identity_cache.get(user_id)
+    if snapshot is None:
+        user = db.query(User).filter(User.id == user_id).first()
+        if user is not None:
+            identity_cache.set(user_id, {key: getattr(user, key) for key in _USER_COLUMNS})
+        return user
+
+    # Rebuild the row as a clean persistent instance: no SQL is emitted, and
+    # changes made by the endpoint are flushed as a normal UPDATE.
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    db.add(user)
+    return user
+
 
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -24,7 +65,7 @@ def get_current_user(
             detail="Could not validate credentials"
         )
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = _load_user(db, user_id)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
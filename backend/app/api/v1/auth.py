@@ -1,15 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from app.core.database import get_db
 from app.core.security import (
-    create_access_token, 
-    create_refresh_token, 
     verify_token,
     generate_verification_code
 )
+from app.core import sessions
+from app.core.config import settings
+from app.core.verification_store import (
+    verification_store, verification_audit,
+    CODE_MISSING, CODE_ALREADY_VERIFIED, CODE_ATTEMPTS_EXCEEDED, CODE_INVALID
+)
 from app.models.user import User
-from app.models.verification import PhoneVerification
 from app.schemas.auth import (
     PhoneVerificationRequest,
     PhoneVerificationResponse,
@@ -22,40 +26,32 @@ import asyncio
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
+# Logout stays idempotent: a missing or already invalid token is not an error
+optional_bearer = HTTPBearer(auto_error=False)
+
 
 @router.post("/send-verification", response_model=PhoneVerificationResponse)
 async def send_verification_code(
-    request: PhoneVerificationRequest,
-    db: Session = Depends(get_db)
+    request: PhoneVerificationRequest
 ):
     """Send verification code to phone number"""
     phone_number = request.phone_number
     
-    # Check if user already exists
-    existing_user = db.query(User).filter(User.phone_number == phone_number).first()
-    
     # Generate verification code
     verification_code = generate_verification_code()
     
-    # Create or update verification record
-    verification = db.query(PhoneVerification).filter(
-        PhoneVerification.phone_number == phone_number
-    ).first()
-    
-    if verification:
-        verification.verification_code = verification_code
-        verification.is_verified = False
-        verification.attempts = 0
-        verification.expires_at = datetime.utcnow() + timedelta(minutes=5)
-    else:
-        verification = PhoneVerification(
-            phone_number=phone_number,
-            verification_code=verification_code,
-            expires_at=datetime.utcnow() + timedelta(minutes=5)
-        )
-        db.add(verification)
-    
-    db.commit()
+    # Store it with a TTL; a new code replaces any previous one
+    await verification_store.issue(
+        phone_number,
+        verification_code,
+        ttl=settings.verification_code_ttl,
+        max_attempts=settings.verification_max_attempts
+    )
+    verification_audit.record(
+        phone_number,
+        verification_code,
+        expires_at=datetime.utcnow() + timedelta(seconds=settings.verification_code_ttl)
+    )
     
     # In production, send SMS here
     # For development, we'll just return the code
@@ -65,7 +61,7 @@ async def send_verification_code(
     return {
         "success": True,
         "message": "Verification code sent successfully",
-        "expires_in": 300,
+        "expires_in": settings.verification_code_ttl,
         "code": verification_code  # For development only
     }
 
@@ -79,46 +75,40 @@ async def verify_code(
     phone_number = request.phone_number
     verification_code = request.verification_code
     
-    # Get verification record
-    verification = db.query(PhoneVerification).filter(
-        PhoneVerification.phone_number == phone_number
-    ).first()
+    # Check and count the attempt in one step; expired codes are already gone from the store
+    outcome, verification = await verification_store.check_code(phone_number, verification_code)
     
-    if not verification:
+    if outcome == CODE_MISSING:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No verification request found for this phone number"
         )
     
-    if verification.is_verified:
+    if outcome == CODE_ALREADY_VERIFIED:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Phone number already verified"
         )
     
-    if verification.attempts >= verification.max_attempts:
+    if outcome == CODE_ATTEMPTS_EXCEEDED:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Too many attempts. Please request a new code."
         )
     
-    if datetime.utcnow() > verification.expires_at:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Verification code expired"
-        )
-    
-    if verification.verification_code != verification_code:
-        verification.attempts += 1
-        db.commit()
+    if outcome == CODE_INVALID:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid verification code"
         )
     
-    # Mark as verified
-    verification.is_verified = True
-    verification.verified_at = datetime.utcnow()
+    verification_audit.record(
+        phone_number,
+        verification.code,
+        expires_at=datetime.utcfromtimestamp(verification.expires_at),
+        attempts=verification.attempts,
+        verified_at=datetime.utcnow()
+    )
     
     # Create or update user
     user = db.query(User).filter(User.phone_number == phone_number).first()
@@ -157,15 +147,12 @@ async def verify_code(
     
     db.commit()
     
-    # Create tokens
-    access_token = create_access_token(data={"user_id": user.id, "phone_number": user.phone_number})
-    refresh_token = create_refresh_token(data={"user_id": user.id, "phone_number": user.phone_number})
+    # Open a session and create tokens for it
+    tokens = sessions.issue_tokens(db, user)
     
     return {
         "success": True,
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "token_type": "bearer"
+        **tokens
     }
 
 
@@ -177,30 +164,9 @@ async def refresh_token(
     """Refresh access token using refresh token"""
     try:
         payload = verify_token(request.refresh_token, token_type="refresh")
-        user_id = payload.get("user_id")
         
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid refresh token"
-            )
-        
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user or not user.is_active:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found or inactive"
-            )
-        
-        # Create new tokens
-        access_token = create_access_token(data={"user_id": user.id, "phone_number": user.phone_number})
-        refresh_token = create_refresh_token(data={"user_id": user.id, "phone_number": user.phone_number})
-        
-        return Token(
-            access_token=access_token,
-            refresh_token=refresh_token,
-            token_type="bearer"
-        )
+        # Rotate: the presented refresh token is invalidated by this call
+        return Token(**sessions.rotate_refresh_token(db, payload))
         
     except Exception as e:
         raise HTTPException(
@@ -210,6 +176,16 @@ async def refresh_token(
 
 
 @router.post("/logout")
-async def logout():
-    """Logout user (client should discard tokens)"""
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(optional_bearer),
+    db: Session = Depends(get_db)
+):
+    """Logout user: revoke the access token and end its session"""
+    if credentials is not None:
+        try:
+            payload = verify_token(credentials.credentials)
+        except HTTPException:
+            payload = None
+        if payload is not None:
+            sessions.logout(db, payload)
     return {"message": "Successfully logged out"}
@@ -1,19 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, Response
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import Dict, Optional, Tuple
+import asyncio
 import os
-import uuid
-import aiofiles
 from datetime import datetime
 from app.core.database import get_db
 from app.api.dependencies import get_current_active_user
 from app.models.user import User
+from app.models.file import FileBlob, StoredFile
 from app.core.config import settings
-from PIL import Image
-import shutil
+from app.core.blob_store import FILE_TYPES, blob_store, parse_file_id, stored_paths
+from app.core.media import hot_media_cache, media_response
+from app.core.thumbnails import thumbnail_name, thumbnail_queue
+from app.core.transcoding import choose_variant, is_original_image, media_transcoder
+from app.core.storage import (
+    FTYP_GENERIC,
+    SNIFF_BYTES,
+    UploadSession,
+    read_head,
+    receive_upload,
+    sniff_mime_type,
+    upload_sessions,
+)
+from app.schemas.file import FileLinkCreate, UploadSessionCreate, UploadSessionResponse
 
 router = APIRouter(prefix="/files", tags=["files"])
+# Public URLs of stored files (``/files/...``), outside the API prefix
+media_router = APIRouter(tags=["files"])
 
 # Allowed file types
 ALLOWED_IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
@@ -32,163 +46,464 @@ MAX_AUDIO_SIZE = 50 * 1024 * 1024  # 50MB
 MAX_DOCUMENT_SIZE = 50 * 1024 * 1024  # 50MB
 
 
-@router.post("/upload")
-async def upload_file(
-    file: UploadFile = File(...),
-    file_type: str = Form(...),  # image, video, audio, document
-    current_user: User = Depends(get_current_active_user)
-):
-    """Upload a file"""
-    
-    # Validate file type
-    if file_type not in ["image", "video", "audio", "document"]:
+# Per file type: allowed MIME types, size limit, name used in errors
+FILE_RULES = {
+    "image": (ALLOWED_IMAGE_TYPES, MAX_IMAGE_SIZE, "Image"),
+    "video": (ALLOWED_VIDEO_TYPES, MAX_VIDEO_SIZE, "Video"),
+    "audio": (ALLOWED_AUDIO_TYPES, MAX_AUDIO_SIZE, "Audio"),
+    "document": (ALLOWED_DOCUMENT_TYPES, MAX_DOCUMENT_SIZE, "Document"),
+}
+MAX_UPLOAD_SIZE = max(max_size for _, max_size, _ in FILE_RULES.values())
+# Multipart boundaries, part headers and form fields around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+UPLOAD_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file", "file_type"],
+                    "properties": {
+                        "file_type": {"type": "string", "enum": list(FILE_RULES)},
+                        "file": {"type": "string", "format": "binary"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+
+def validate_upload(file_type: Optional[str], content_type: Optional[str]) -> Tuple[int, str]:
+    """Check the declared type of an upload; return its size limit and error detail"""
+    if file_type not in FILE_RULES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid file type"
         )
     
-    # Check file size
-    file_size = 0
-    content = await file.read()
-    file_size = len(content)
-    
-    # Validate file size based on type
-    if file_type == "image" and file_size > MAX_IMAGE_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Image file too large"
-        )
-    elif file_type == "video" and file_size > MAX_VIDEO_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Video file too large"
-        )
-    elif file_type == "audio" and file_size > MAX_AUDIO_SIZE:
+    allowed_types, max_size, label = FILE_RULES[file_type]
+    if content_type not in allowed_types:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Audio file too large"
+            detail=f"Invalid {file_type} format"
         )
-    elif file_type == "document" and file_size > MAX_DOCUMENT_SIZE:
+    return max_size, f"{label} file too large"
+
+
+def validate_content(file_type: str, sniffed_type: Optional[str]) -> None:
+    """Check the sniffed format of received data against its declared file type"""
+    allowed_types = FILE_RULES[file_type][0]
+    if sniffed_type == FTYP_GENERIC:
+        sniffed_categories = {"audio", "video"}
+    else:
+        sniffed_categories = {category for category, (types, _, _) in FILE_RULES.items() if sniffed_type in types}
+    # Images always carry a signature; other types are rejected only when
+    # the content is recognisably something else
+    if (file_type == "image" and sniffed_type not in allowed_types) or \
+            (sniffed_categories and file_type not in sniffed_categories):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Document file too large"
+            detail=f"Invalid {file_type} format"
         )
+
+
+async def add_preview(db: Session, blob: FileBlob) -> None:
+    """Render the inline preview of an image blob that has none yet
     
-    # Validate MIME type
-    if file_type == "image" and file.content_type not in ALLOWED_IMAGE_TYPES:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid image format"
+    Runs in the thumbnail pool while the request waits: the preview is
+    small enough to cost a few milliseconds, and messages sent right after
+    the upload already carry it.
+    """
+    if blob.file_type == "image" and blob.preview is None:
+        preview = await thumbnail_queue.render_preview(blob.path)
+        if preview is not None:
+            blob_store.set_preview(db, blob, preview)
+
+
+def stored_file_info(stored_file: StoredFile, blob_written: bool) -> dict:
+    """Describe a stored upload to the client and queue thumbnails and variants of new images
+    
+    Thumbnails are rendered in the background; their URLs answer 404 until
+    they are ready, and ``/files/image/{filename}/thumbnail`` answers 202.
+    """
+    blob = stored_file.blob
+    thumbnail_url = None
+    thumbnails = None
+    if blob.file_type == "image":
+        if blob_written:
+            media_transcoder.notify()
+        if blob_written or not thumbnail_queue.is_ready(blob.path):
+            thumbnail_queue.submit(blob.path)
+        thumbnails = thumbnail_queue.urls(blob_store.public_path(stored_file))
+        thumbnail_url = thumbnails.get(str(settings.thumbnail_default_size))
+    
+    return {
+        "file_id": stored_file.id,
+        "filename": stored_file.filename,
+        "file_type": stored_file.file_type,
+        "file_size": stored_file.size,
+        "mime_type": stored_file.mime_type,
+        "sha256": blob.sha256,
+        "url": blob_store.file_url(stored_file),
+        "thumbnail_url": thumbnail_url,
+        "thumbnails": thumbnails,
+        "preview": blob.preview,
+        "uploaded_at": datetime.utcnow().isoformat()
+    }
+
+
+@router.post("/upload", openapi_extra=UPLOAD_FORM_SCHEMA)
+async def upload_file(
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Upload a file
+    
+    Multipart form with ``file_type`` (image, video, audio, document) and
+    ``file``. The body is streamed to disk and rejected as soon as it
+    exceeds the size limit of its type. Content that is already stored is
+    not written again.
+    """
+    
+    remaining_quota = blob_store.remaining_quota(db, current_user.id)
+    
+    def open_file(fields: Dict[str, str], filename: str, content_type: Optional[str]) -> Tuple[int, str]:
+        # file_type normally precedes the file; if not, apply the largest limit
+        # while streaming and the exact one below
+        if "file_type" in fields:
+            max_size, too_large_detail = validate_upload(fields["file_type"], content_type)
+        else:
+            max_size, too_large_detail = MAX_UPLOAD_SIZE, "File too large"
+        if remaining_quota is not None and remaining_quota < max_size:
+            return remaining_quota, "Storage quota exceeded"
+        return max_size, too_large_detail
+    
+    fields, upload = await receive_upload(request, open_file, MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD)
+    try:
+        file_type = fields.get("file_type")
+        max_size, too_large_detail = validate_upload(file_type, upload.content_type)
+        if upload.size > max_size:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=too_large_detail
+            )
+        validate_content(file_type, upload.sniffed_type)
+        
+        stored_file, blob_written = blob_store.store(
+            db, current_user.id, file_type, upload.filename, upload.content_type,
+            upload.size, upload.sha256, upload.temp_path
         )
-    elif file_type == "video" and file.content_type not in ALLOWED_VIDEO_TYPES:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid video format"
+    except BaseException:
+        await upload.discard()
+        raise
+    
+    await add_preview(db, stored_file.blob)
+    return stored_file_info(stored_file, blob_written)
+
+
+@router.post("/link")
+async def link_file(
+    link_data: FileLinkCreate,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Add a copy of a file the caller can already see, without uploading it again
+    
+    ``file_id`` is one of the caller's files or one attached to a message
+    in their chats - the id in its URL - so clients can forward or re-send
+    it. Content is only ever linked by such an id, never by its hash, so
+    nobody can find out whether the server stores some known file. Returns
+    the same file info as ``/files/upload``.
+    """
+    source = blob_store.visible_file(db, current_user.id, link_data.file_id)
+    stored_file = None
+    if source is not None and os.path.exists(blob_store.local_path(source.blob)):
+        stored_file = blob_store.link(
+            db, current_user.id, source.file_type, link_data.filename or source.filename, source.mime_type,
+            source.blob
         )
-    elif file_type == "audio" and file.content_type not in ALLOWED_AUDIO_TYPES:
+    if stored_file is None:
+        raise _file_not_found()
+    
+    await add_preview(db, stored_file.blob)
+    return stored_file_info(stored_file, blob_written=False)
+
+
+@router.get("/usage")
+async def get_storage_usage(
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Get the storage used by the current user and their quota"""
+    usage = blob_store.usage(db, current_user.id)
+    return {
+        "bytes_used": usage.bytes_used,
+        "file_count": usage.file_count,
+        "quota": blob_store.quota or None
+    }
+
+
+@router.get("/cache/stats")
+async def media_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """Hit ratio and bytes served from the in-memory cache of hot files; for signed-in users only"""
+    return hot_media_cache.stats()
+
+
+def _session_response(session: UploadSession, offset: Optional[int] = None) -> UploadSessionResponse:
+    return UploadSessionResponse(
+        upload_id=session.id,
+        file_type=session.file_type,
+        filename=session.filename,
+        size=session.size,
+        offset=session.offset if offset is None else offset,
+        expires_at=datetime.utcfromtimestamp(session.expires_at)
+    )
+
+
+def _get_upload_session(upload_id: str, current_user: User) -> UploadSession:
+    session = upload_sessions.get(upload_id)
+    if session is None or session.user_id != current_user.id:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid audio format"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upload session not found"
         )
-    elif file_type == "document" and file.content_type not in ALLOWED_DOCUMENT_TYPES:
+    return session
+
+
+def _validate_session_content(session: UploadSession) -> None:
+    try:
+        validate_content(session.file_type, sniff_mime_type(read_head(session.data_path)))
+    except HTTPException:
+        upload_sessions.discard(session.id)
+        raise
+
+
+@router.post("/uploads", response_model=UploadSessionResponse)
+async def create_upload_session(
+    session_data: UploadSessionCreate,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Start a resumable upload
+    
+    Send the bytes with ``PUT /files/uploads/{upload_id}?offset=N`` in any
+    number of chunks, resume from the ``offset`` returned by
+    ``GET /files/uploads/{upload_id}`` after a failure, then call
+    ``POST /files/uploads/{upload_id}/complete``.
+    """
+    max_size, too_large_detail = validate_upload(session_data.file_type, session_data.content_type)
+    if session_data.size > max_size:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid document format"
+            detail=too_large_detail
         )
+    blob_store.check_quota(db, current_user.id, session_data.size)
     
-    # Generate unique filename
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    session = upload_sessions.create(
+        user_id=current_user.id,
+        file_type=session_data.file_type,
+        filename=session_data.filename,
+        content_type=session_data.content_type,
+        size=session_data.size
+    )
+    return _session_response(session, offset=0)
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_session(
+    upload_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get the committed offset of a resumable upload"""
+    return _session_response(_get_upload_session(upload_id, current_user))
+
+
+@router.put("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Append the raw request body to a resumable upload at ``offset``"""
+    session = _get_upload_session(upload_id, current_user)
+    new_offset = await upload_sessions.append(session, offset, request.stream())
     
-    # Create directory if it doesn't exist
-    upload_dir = os.path.join(settings.upload_dir, file_type)
-    os.makedirs(upload_dir, exist_ok=True)
+    # Reject content of the wrong kind as soon as its signature has arrived
+    if offset < SNIFF_BYTES <= new_offset or (offset < new_offset == session.size):
+        _validate_session_content(session)
     
-    # Save file
-    file_path = os.path.join(upload_dir, unique_filename)
+    return _session_response(session, offset=new_offset)
+
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: str,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Finish a resumable upload; returns the same file info as ``/files/upload``"""
+    session = _get_upload_session(upload_id, current_user)
+    _validate_session_content(session)
     
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(content)
+    async def store(data_path: str, sha256: str) -> Tuple[StoredFile, bool]:
+        return blob_store.store(
+            db, current_user.id, session.file_type, session.filename, session.content_type,
+            session.size, sha256, data_path
+        )
     
-    # Generate thumbnail for images
-    thumbnail_url = None
-    if file_type == "image":
-        try:
-            thumbnail_url = await generate_image_thumbnail(file_path, upload_dir)
-        except Exception as e:
-            print(f"Error generating thumbnail: {e}")
+    stored_file, blob_written = await upload_sessions.finalize(session, store)
+    await add_preview(db, stored_file.blob)
+    return stored_file_info(stored_file, blob_written)
+
+
+@router.delete("/uploads/{upload_id}")
+async def cancel_upload(
+    upload_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Abort a resumable upload and delete its data"""
+    session = _get_upload_session(upload_id, current_user)
+    upload_sessions.discard(session.id)
+    return {"message": "Upload cancelled"}
+
+
+async def stored_path(path: str) -> Optional[str]:
+    """Where the file or thumbnail at the URL ``/files/<path>`` is stored
     
-    # Return file info
-    return {
-        "file_id": unique_filename,
-        "filename": file.filename,
-        "file_type": file_type,
-        "file_size": file_size,
-        "mime_type": file.content_type,
-        "url": f"/files/{file_type}/{unique_filename}",
-        "thumbnail_url": thumbnail_url,
-        "uploaded_at": datetime.utcnow().isoformat()
-    }
+    Returns the path relative to the upload directory, or None if there is
+    no such file or it may not be served. Looked up in a thread: a file id
+    that is not cached yet is resolved through the database.
+    """
+    return await asyncio.to_thread(blob_store.resolve_url_path, path)
 
 
-@router.get("/{file_type}/{filename}")
-async def get_file(file_type: str, filename: str):
-    """Get uploaded file"""
+def _variant_key(request: Request, path: str) -> Optional[str]:
+    """What picks the file sent for ``path`` besides the path itself"""
+    if not is_original_image(path):
+        return None
+    if request.query_params.get("original"):
+        return "original"
+    return "webp" if "image/webp" in request.headers.get("accept", "") else "other"
+
+
+async def stored_file_response(request: Request, path: str) -> Response:
+    """Response for the stored file or thumbnail requested as ``path``
     
-    if file_type not in ["image", "video", "audio", "document"]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid file type"
-        )
+    ``path`` is the URL below ``/files/``, see ``BlobStore.resolve_url_path``. Images
+    are sent as the re-encoded variant that suits the client's ``Accept``
+    header, or as uploaded with ``?original=1`` or while no variant exists
+    yet - then without ``immutable``, so clients pick up the variant later.
+    Small files are served from ``hot_media_cache``.
+    """
+    key = (path, _variant_key(request, path))
+    entry = hot_media_cache.get(key)
+    if entry is not None:
+        return hot_media_cache.response(request, entry)
+    
+    resolved = await stored_path(path)
+    if resolved is None:
+        raise _file_not_found()
+    file_path = os.path.join(settings.upload_dir, resolved)
+    options = {}
+    if key[1] == "original":
+        options = {"vary": "Accept"}
+    elif key[1] is not None:
+        variant = choose_variant(resolved, request.headers.get("accept", ""))
+        if variant is None:
+            # Not kept in memory: the variant replaces it as soon as it exists
+            return media_response(request, file_path, immutable=False, vary="Accept")
+        file_path, media_type = variant
+        options = {"media_type": media_type, "vary": "Accept"}
     
-    file_path = os.path.join(settings.upload_dir, file_type, filename)
+    entry = await hot_media_cache.load(key, file_path, **options)
+    if entry is not None:
+        return hot_media_cache.response(request, entry)
+    return media_response(request, file_path, **options)
+
+
+def _file_not_found() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="File not found"
+    )
+
+
+@media_router.api_route("/files/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def serve_file(path: str, request: Request):
+    """Serve a stored file by the URL returned on upload, with caching and range support"""
+    return await stored_file_response(request, path)
+
+
+@router.api_route("/{file_type}/{filename}", methods=["GET", "HEAD"])
+async def get_file(file_type: str, filename: str, request: Request):
+    """Get uploaded file
+    
+    Supports ``Range`` (206), ``If-None-Match`` / ``If-Modified-Since`` (304)
+    and sends long-lived caching headers for content-addressed files. Images
+    come re-encoded for the client's ``Accept`` header unless ``?original=1``.
+    """
     
-    if not os.path.exists(file_path):
+    if file_type not in FILE_TYPES:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="File not found"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid file type"
         )
     
-    return FileResponse(file_path)
+    return await stored_file_response(request, f"{file_type}/{filename}")
 
 
-@router.get("/{file_type}/{filename}/thumbnail")
-async def get_thumbnail(file_type: str, filename: str):
-    """Get file thumbnail"""
+@router.api_route("/{file_type}/{filename}/thumbnail", methods=["GET", "HEAD"])
+async def get_thumbnail(
+    file_type: str,
+    filename: str,
+    request: Request,
+    size: int = settings.thumbnail_default_size
+):
+    """Get file thumbnail
+    
+    ``size`` is one of the configured thumbnail sizes. Answers 202 with
+    ``Retry-After`` while the thumbnail is being rendered.
+    """
     
     if file_type != "image":
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Thumbnails only available for images"
         )
-    
-    file_path = os.path.join(settings.upload_dir, file_type, filename)
-    thumbnail_path = os.path.join(settings.upload_dir, file_type, "thumbnails", filename)
-    
-    if not os.path.exists(file_path):
+    if size not in thumbnail_queue.sizes:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="File not found"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid thumbnail size"
         )
     
-    if not os.path.exists(thumbnail_path):
-        # Generate thumbnail if it doesn't exist
-        try:
-            await generate_image_thumbnail(file_path, os.path.join(settings.upload_dir, file_type))
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Error generating thumbnail"
-            )
+    path = await stored_path(f"{file_type}/{filename}")
+    
+    if path is None:
+        raise _file_not_found()
     
-    return FileResponse(thumbnail_path)
+    directory, name = os.path.split(path)
+    if not os.path.exists(os.path.join(settings.upload_dir, f"{directory}/thumbnails/{thumbnail_name(name, size)}")):
+        thumbnail_queue.submit(path)
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={"detail": "Thumbnail is being generated"},
+            headers={"Retry-After": "1"}
+        )
+    
+    return await stored_file_response(request, f"{file_type}/thumbnails/{thumbnail_name(filename, size)}")
 
 
 @router.delete("/{file_type}/{filename}")
 async def delete_file(
     file_type: str,
     filename: str,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
 ):
     """Delete uploaded file"""
     
@@ -198,43 +513,37 @@ async def delete_file(
             detail="Invalid file type"
         )
     
-    file_path = os.path.join(settings.upload_dir, file_type, filename)
-    thumbnail_path = os.path.join(settings.upload_dir, file_type, "thumbnails", filename)
-    
-    if not os.path.exists(file_path):
+    file_id = parse_file_id(f"{file_type}/{filename}")
+    if file_id is not None:
+        files = db.query(StoredFile).filter(
+            StoredFile.id == file_id,
+            StoredFile.owner_id == current_user.id
+        ).all()
+        blob = files[0].blob if files else None
+    else:
+        # A URL from before files got their own: every file of the caller
+        # with that content. Files stored before content addressing have no
+        # recorded owner; the orphan sweeper removes them once nothing
+        # references them
+        blob = blob_store.find(db, f"{file_type}/{filename}")
+        files = db.query(StoredFile).filter(
+            StoredFile.blob_sha256 == blob.sha256,
+            StoredFile.owner_id == current_user.id
+        ).all() if blob is not None else []
+    if not files:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found"
         )
     
-    # Delete file
-    os.remove(file_path)
-    
-    # Delete thumbnail if exists
-    if os.path.exists(thumbnail_path):
-        os.remove(thumbnail_path)
+    # Stored content is shared: only the caller's files are deleted and the
+    # blob is collected once nothing references it
+    if not blob_store.release(db, files):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="File is attached to messages"
+        )
+    for path in stored_paths(blob.path):
+        hot_media_cache.invalidate(path)
     
     return {"message": "File deleted successfully"}
-
-
-async def generate_image_thumbnail(file_path: str, upload_dir: str) -> str:
-    """Generate thumbnail for image"""
-    try:
-        # Create thumbnails directory
-        thumbnails_dir = os.path.join(upload_dir, "thumbnails")
-        os.makedirs(thumbnails_dir, exist_ok=True)
-        
-        # Open image
-        with Image.open(file_path) as img:
-            # Create thumbnail (max 300x300)
-            img.thumbnail((300, 300), Image.Resampling.LANCZOS)
-            
-            # Save thumbnail
-            thumbnail_path = os.path.join(thumbnails_dir, os.path.basename(file_path))
-            img.save(thumbnail_path, optimize=True, quality=85)
-            
-            return f"/files/{os.path.basename(upload_dir)}/thumbnails/{os.path.basename(file_path)}"
-            
-    except Exception as e:
-        print(f"Error generating thumbnail: {e}")
-        return None
@@ -1,8 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import and_, or_, desc
+from sqlalchemy import and_, or_, desc, select, type_coerce, Text
 from typing import List, Optional
 from datetime import datetime
+from app.core.config import settings
 from app.core.database import get_db
 from app.api.dependencies import get_current_active_user
 from app.models.user import User
@@ -10,11 +11,20 @@ from app.models.chat import Chat, ChatParticipant
 from app.models.message import Message, MessageType
 from app.schemas.message import MessageCreate, MessageUpdate, MessageResponse
 from app.core.websocket import manager
+from app.core.blob_store import blob_store
 import json
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
 
+def with_previews(db: Session, messages: List[Message]) -> List[Message]:
+    """Set ``file_preview`` on messages that carry images, with one query for all of them"""
+    previews = blob_store.previews(db, {message.file_url for message in messages if message.file_url})
+    for message in messages:
+        message.file_preview = previews.get(message.file_url)
+    return messages
+
+
 @router.get("/chat/{chat_id}", response_model=List[MessageResponse])
 async def get_chat_messages(
     chat_id: int,
@@ -47,7 +57,7 @@ async def get_chat_messages(
         joinedload(Message.reply_to)
     ).order_by(desc(Message.created_at)).offset(offset).limit(limit).all()
     
-    return messages
+    return with_previews(db, messages)
 
 
 @router.post("/", response_model=MessageResponse)
@@ -95,6 +105,19 @@ async def send_message(
         reply_to_id=message_data.reply_to_id
     )
     
+    file_preview = None
+    if message_data.file_id:
+        stored_file = blob_store.attach(db, current_user.id, message_data.file_id)
+        if stored_file is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="File not found"
+            )
+        message.file_url = blob_store.file_url(stored_file)
+        message.file_size = stored_file.size
+        message.file_name = stored_file.filename
+        file_preview = stored_file.blob.preview
+    
     db.add(message)
     db.commit()
     db.refresh(message)
@@ -102,6 +125,7 @@ async def send_message(
     # Update chat's last activity
     chat.updated_at = datetime.utcnow()
     db.commit()
+    message.file_preview = file_preview
     
     # Notify chat participants via WebSocket
     try:
@@ -112,6 +136,8 @@ async def send_message(
                 "chat_id": message.chat_id,
                 "sender_id": message.sender_id,
                 "content": message.content,
+                "file_url": message.file_url,
+                "file_preview": file_preview,
                 "message_type": message.message_type.value if hasattr(message.message_type, "value") else str(message.message_type),
                 "created_at": message.created_at.isoformat(),
             }
@@ -164,7 +190,7 @@ async def get_message(
             detail="Message not found or access denied"
         )
     
-    return message
+    return with_previews(db, [message])[0]
 
 
 @router.put("/{message_id}", response_model=MessageResponse)
@@ -199,7 +225,7 @@ async def update_message(
     db.commit()
     db.refresh(message)
     
-    return message
+    return with_previews(db, [message])[0]
 
 
 @router.delete("/{message_id}")
@@ -225,6 +251,8 @@ async def delete_message(
     message.is_deleted = True
     message.deleted_at = datetime.utcnow()
     message.updated_at = datetime.utcnow()
+    if message.file_url:
+        blob_store.detach(db, current_user.id, message.file_url)
     
     db.commit()
     
@@ -232,14 +260,18 @@ async def delete_message(
 
 
 @router.get("/search/{chat_id}", response_model=List[MessageResponse])
-async def search_messages(
+def search_messages(
     chat_id: int,
     query: str = Query(..., min_length=1),
     limit: int = Query(20, ge=1, le=100),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Search messages in a chat"""
+    """Search messages in a chat, ignoring case
+    
+    With encrypted messages only the latest ``MESSAGE_SEARCH_SCAN_LIMIT``
+    messages of the chat are searched.
+    """
     # Check if user is participant
     participant = db.query(ChatParticipant).filter(
         ChatParticipant.chat_id == chat_id,
@@ -254,17 +286,41 @@ async def search_messages(
         )
     
     # Search messages
-    messages = db.query(Message).filter(
+    messages_query = db.query(Message).filter(
         Message.chat_id == chat_id,
-        Message.is_deleted == False,
-        Message.content.contains(query)
+        Message.is_deleted == False
     ).options(
         joinedload(Message.sender),
         joinedload(Message.receiver),
         joinedload(Message.reply_to)
-    ).order_by(desc(Message.created_at)).limit(limit).all()
+    ).order_by(desc(Message.created_at), desc(Message.id))
     
-    return messages
+    if not settings.encrypt_messages:
+        return with_previews(db, messages_query.filter(Message.content.icontains(query)).limit(limit).all())
+    
+    # Encrypted content cannot be matched in SQL: decrypt the chat's latest
+    # messages newest first, a chunk at a time, until enough matches are found.
+    # Only ids and raw content are read; the matches are loaded afterwards
+    needle = query.casefold()
+    raw_content = type_coerce(Message.content, Text)
+    scan = select(Message.id, raw_content).where(
+        Message.chat_id == chat_id,
+        Message.is_deleted == False,
+        raw_content.isnot(None)
+    ).order_by(desc(Message.created_at), desc(Message.id)).limit(settings.message_search_scan_limit)
+    
+    matched_ids = []
+    result = db.execute(scan.execution_options(yield_per=500))
+    for chunk in result.partitions():
+        contents = Message.content.type.decrypt_many([content for _, content in chunk])
+        matched_ids.extend(row.id for row, content in zip(chunk, contents) if needle in content.casefold())
+        if len(matched_ids) >= limit:
+            break
+    result.close()
+    
+    if not matched_ids:
+        return []
+    return with_previews(db, messages_query.filter(Message.id.in_(matched_ids[:limit])).all())
 
 
 @router.get("/unread/count")
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
 from typing import List, Optional
 from datetime import datetime
 from app.core.database import get_db
+from app.core.encryption import data_sanitizer
+from app.core.user_search import user_search
 from app.api.dependencies import get_current_active_user
 from app.models.user import User
 from app.models.contact import Contact
@@ -85,23 +86,15 @@ async def search_users(
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Search users by phone number, username, or name"""
-    if len(query) < 1:
-        return []
-    
-    # Search by phone number, username, first name, or last name
-    users = db.query(User).filter(
-        User.id != current_user.id,  # Exclude current user
-        User.is_active == True,
-        or_(
-            User.phone_number.contains(query),
-            User.username.contains(query),
-            User.first_name.contains(query),
-            User.last_name.contains(query)
-        )
-    ).limit(limit).all()
+    """Search users by phone number, username, or name
     
-    return users
+    Matches word prefixes through a search index; an exact username comes
+    first, then usernames and names starting with the query. Every word of
+    the query must start a word of the user's fields. A phone number is
+    normalised like stored numbers and matched from its first digit:
+    "+7 999", "8 (999) 123" and "7999" find +79991234567, "999" does not.
+    """
+    return user_search.search(db, query, limit, exclude_id=current_user.id)
 
 
 @router.get("/contacts", response_model=List[UserProfile])
@@ -158,24 +151,6 @@ async def remove_contact(
     return {"message": "Contact removed"}
 
 
-@router.get("/{user_id}", response_model=UserProfile)
-async def get_user_by_id(
-    user_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
-):
-    """Get user profile by ID"""
-    user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
-    
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    return user
-
-
 @router.get("/by-username/{username}", response_model=UserProfile)
 async def get_user_by_username(
     username: str,
@@ -203,28 +178,50 @@ async def get_user_by_phone(
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Get user profile by phone number"""
-    normalized = phone_number.replace(" ", "").replace("(", "").replace(")", "")
+    """Get user profile by phone number
+    
+    The number may be formatted in any way a client would show it; it is
+    matched in E.164 form, exactly, through the unique index.
+    """
+    try:
+        normalized = data_sanitizer.sanitize_phone_number(phone_number)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     user = db.query(User).filter(
         User.phone_number == normalized,
         User.is_active == True
     ).first()
 
     if not user:
-        # try contains as a fallback (e.g., with country code formatting differences)
-        user = db.query(User).filter(
-            User.phone_number.contains(normalized),
-            User.is_active == True
-        ).first()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    return user
 
+
+@router.get("/{user_id}", response_model=UserProfile)
+async def get_user_by_id(
+    user_id: int,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Get user profile by ID"""
+    user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
+    
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
-
+    
     return user
 
+
 @router.post("/me/online")
 async def set_user_online(
     current_user: User = Depends(get_current_active_user),
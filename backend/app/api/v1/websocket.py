@@ -3,13 +3,21 @@ from sqlalchemy.orm import Session
 from app.core.database import get_db
 from app.core.websocket import manager
 from app.core.security import verify_token
+from app.api.dependencies import get_current_active_user
 from app.models.user import User
 from app.models.chat import ChatParticipant
+from typing import Optional
 import json
 
 router = APIRouter(prefix="/ws", tags=["websocket"])
 
 
+@router.get("/stats")
+async def websocket_stats(current_user: User = Depends(get_current_active_user)):
+    """Connection and heartbeat statistics; for signed-in users only"""
+    return {**manager.heartbeat.stats(), "active_calls": len(manager.calls)}
+
+
 @router.websocket("/{token}")
 async def websocket_endpoint(websocket: WebSocket, token: str):
     """WebSocket endpoint for real-time communication"""
@@ -29,19 +37,22 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
             while True:
                 # Receive message from client
                 data = await websocket.receive_text()
+                manager.heartbeat.touch(websocket)
                 message_data = json.loads(data)
                 
                 # Handle different message types
-                await handle_websocket_message(user_id, message_data)
+                await handle_websocket_message(user_id, message_data, websocket)
                 
         except WebSocketDisconnect:
+            pass
+        finally:
             manager.disconnect(websocket, user_id)
             
     except Exception as e:
         await websocket.close(code=1008, reason="Authentication failed")
 
 
-async def handle_websocket_message(user_id: int, message_data: dict):
+async def handle_websocket_message(user_id: int, message_data: dict, websocket: Optional[WebSocket] = None):
     """Handle incoming WebSocket messages"""
     message_type = message_data.get("type")
     
@@ -58,10 +69,15 @@ async def handle_websocket_message(user_id: int, message_data: dict):
             user_id
         )
         
+    elif message_type == "pong":
+        # Reply to a server heartbeat ping
+        if websocket is not None:
+            manager.heartbeat.record_pong(websocket)
+        
     elif message_type == "call":
         # Handle call notifications
         call_data = message_data.get("data", {})
-        await manager.send_call_notification(call_data)
+        await manager.send_call_notification(user_id, call_data)
         
     else:
         # Unknown message type
@@ -90,19 +106,22 @@ async def chat_websocket(websocket: WebSocket, chat_id: int, token: str):
             while True:
                 # Receive message from client
                 data = await websocket.receive_text()
+                manager.heartbeat.touch(websocket)
                 message_data = json.loads(data)
                 
                 # Handle chat-specific messages
-                await handle_chat_websocket_message(user_id, chat_id, message_data)
+                await handle_chat_websocket_message(user_id, chat_id, message_data, websocket)
                 
         except WebSocketDisconnect:
+            pass
+        finally:
             manager.disconnect(websocket, user_id)
             
     except Exception as e:
         await websocket.close(code=1008, reason="Authentication failed")
 
 
-async def handle_chat_websocket_message(user_id: int, chat_id: int, message_data: dict):
+async def handle_chat_websocket_message(user_id: int, chat_id: int, message_data: dict, websocket: Optional[WebSocket] = None):
     """Handle chat-specific WebSocket messages"""
     message_type = message_data.get("type")
     
@@ -120,6 +139,11 @@ async def handle_chat_websocket_message(user_id: int, chat_id: int, message_data
             "message_type": message_data.get("message_type", "text")
         })
         
+    elif message_type == "pong":
+        # Reply to a server heartbeat ping
+        if websocket is not None:
+            manager.heartbeat.record_pong(websocket)
+        
     else:
         # Unknown message type
         pass
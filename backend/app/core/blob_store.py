@@ -0,0 +1,666 @@
+"""
+Content-addressed storage for uploaded files
+
+File content is stored once per SHA-256, as a blob at
+``<upload_dir>/<file_type>/<ab>/<cd>/<sha256><ext>``, where ``ab`` and
+``cd`` are the first two bytes of the hash in hex: two levels of at most
+256 directories keep every directory small however many files are stored.
+Blobs stored before that sit directly in ``<file_type>/`` until
+``scripts/migrate_upload_layout.py`` moves them; a URL in either layout is
+resolved to the other from the hash in the file name, without a lookup,
+and references are counted under both. Every upload creates a
+``StoredFile`` row - the file id handed to the client - pointing at its
+blob, and the blob's ``ref_count`` counts those rows. Uploading content
+that is already stored only adds a row and a reference: the received temp
+file is dropped instead of being moved into place and no thumbnail is
+generated again.
+
+Files are published at ``/files/<file_type>/<file id><ext>``, resolved to
+their blob through the ``files`` table, so a URL does not reveal the hash
+of its content and nobody can find out whether some known content is
+stored by requesting its hash. Older URLs that name the blob itself are
+served only while a message or avatar references them.
+
+Files count the messages that carry them, and every user has a
+``StorageUsage`` row with the totals of their files, so quotas are checked
+without walking directories. A background task removes files that no
+message references once they are older than a grace period, removes
+untracked files and thumbnails left from before content addressing, and
+deletes blobs whose last reference is gone.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+from fastapi import HTTPException, status
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.database import SessionLocal, engine
+from app.core.media import hot_media_cache
+from app.core.thumbnails import thumbnail_paths, thumbnail_source_name
+from app.core.transcoding import variant_paths
+from app.models.chat import Chat, ChatParticipant
+from app.models.file import FileBlob, StoredFile, StorageUsage, TranscodeJob
+from app.models.message import Message
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+FILE_TYPES = ("image", "video", "audio", "document")
+FILES_URL_PREFIX = "/files/"
+_SHA256_NAME = re.compile(r"[0-9a-f]{64}")
+_FILE_ID_NAME = re.compile(r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(\.[^/]*)?")
+_MISSING = object()
+
+
+def blob_path(file_type: str, sha256: str, extension: str) -> str:
+    """Path of new blob content, relative to the upload directory"""
+    return f"{file_type}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+
+def alternate_path(path: str) -> Optional[str]:
+    """The same blob or thumbnail in the other directory layout
+
+    ``image/<sha256>.jpg`` <-> ``image/ab/cd/<sha256>.jpg``, and likewise
+    for files in ``thumbnails/`` and ``variants/``. None for paths that are
+    not named by a hash.
+    """
+    parts = path.split("/")
+    name = parts[-1]
+    if len(parts) < 2 or not _SHA256_NAME.match(name):
+        return None
+    tail = parts[-2:] if len(parts) > 2 and parts[-2] in ("thumbnails", "variants") else parts[-1:]
+    shards = parts[1:-len(tail)]
+    if not shards:
+        return "/".join([parts[0], name[:2], name[2:4], *tail])
+    if shards == [name[:2], name[2:4]]:
+        return "/".join([parts[0], *tail])
+    return None
+
+
+def parse_file_id(path: str) -> Optional[str]:
+    """The file id in the public path ``<file_type>/<file id><ext>``, if it is one
+
+    Files uploaded before content addressing have names of the same form
+    but no ``StoredFile`` row.
+    """
+    parts = path.split("/")
+    if len(parts) != 2 or parts[0] not in FILE_TYPES:
+        return None
+    match = _FILE_ID_NAME.fullmatch(parts[1])
+    return match.group(1) if match else None
+
+
+def resolve_path(path: str) -> Optional[str]:
+    """``path`` or its ``alternate_path``, whichever exists in the upload directory"""
+    for candidate in (path, alternate_path(path)):
+        if candidate is not None and os.path.isfile(os.path.join(settings.upload_dir, candidate)):
+            return candidate
+    return None
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stored_paths(path: str) -> List[str]:
+    """Local paths of a stored file and of every thumbnail and variant of it"""
+    return [os.path.join(settings.upload_dir, path)] + thumbnail_paths(path) + variant_paths(path)
+
+
+def _remove_with_thumbnails(path: str) -> None:
+    for stored in stored_paths(path):
+        _remove(stored)
+        hot_media_cache.invalidate(stored)
+
+
+class BlobStore:
+    """Reference-counted blobs, per-user quotas and the orphan sweeper
+
+    The reference is taken with a single ``UPDATE ... ref_count + 1`` and a
+    new blob row is flushed before its file is moved into place, so the
+    collector - which deletes a row only while its count is still zero and
+    removes the file before committing - never deletes content that an
+    upload has just linked to. Quota charges are conditional updates of the
+    owner's counters for the same reason.
+    """
+
+    # Public URL paths resolved to stored paths
+    _URL_CACHE_SIZE = 100000
+
+    def __init__(self, quota: int, gc_interval: float, grace_period: timedelta,
+                 orphan_grace_period: timedelta, gc_batch_size: int, url_cache_ttl: float):
+        self.quota = quota
+        self.gc_interval = gc_interval
+        self.grace_period = grace_period
+        self.orphan_grace_period = orphan_grace_period
+        self.gc_batch_size = gc_batch_size
+        # File id or older URL path -> stored path, or None if it is not served
+        self._url_paths = TTLCache(maxsize=self._URL_CACHE_SIZE, ttl=url_cache_ttl)
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def local_path(blob: FileBlob) -> str:
+        return os.path.join(settings.upload_dir, blob.path)
+
+    @staticmethod
+    def public_path(stored_file: StoredFile) -> str:
+        """Path of a file's URL below ``/files/``; names the file, not its content"""
+        blob = stored_file.blob
+        return f"{blob.file_type}/{stored_file.id}{os.path.splitext(blob.path)[1]}"
+
+    @classmethod
+    def file_url(cls, stored_file: StoredFile) -> str:
+        return f"{FILES_URL_PREFIX}{cls.public_path(stored_file)}"
+
+    @staticmethod
+    def _blob_url(blob: FileBlob) -> str:
+        """URL of the blob itself, as handed out before files got URLs of their own"""
+        return f"{FILES_URL_PREFIX}{blob.path}"
+
+    @staticmethod
+    def _add_reference(db: Session, sha256: str) -> bool:
+        updated = db.query(FileBlob).filter(FileBlob.sha256 == sha256).update(
+            {FileBlob.ref_count: FileBlob.ref_count + 1, FileBlob.unreferenced_at: None},
+            synchronize_session=False
+        )
+        return updated == 1
+
+    @staticmethod
+    def _path_variants(path: str) -> List[str]:
+        alternate = alternate_path(path)
+        return [path] if alternate is None else [path, alternate]
+
+    def find(self, db: Session, path: str) -> Optional[FileBlob]:
+        """The blob stored at ``path`` in either directory layout"""
+        return db.query(FileBlob).filter(FileBlob.path.in_(self._path_variants(path))).first()
+
+    def _source_path(self, path: str) -> Optional[str]:
+        """Stored path of the file at public ``path``, or None if it is not served"""
+        file_id = parse_file_id(path)
+        if file_id is None and not _SHA256_NAME.match(path.rsplit("/", 1)[-1]):
+            # A random name from before content addressing
+            return path if path.count("/") == 1 else None
+        key = file_id or path
+        source = self._url_paths.get(key, _MISSING)
+        if source is not _MISSING:
+            return source
+        db = SessionLocal()
+        try:
+            if file_id is not None:
+                source = db.query(FileBlob.path).join(StoredFile.blob).filter(
+                    StoredFile.id == file_id,
+                    FileBlob.file_type == path.split("/", 1)[0]
+                ).scalar()
+                # Files from before content addressing are named by a uuid too
+                source = source or path
+            else:
+                url = f"{FILES_URL_PREFIX}{path}"
+                source = path if self._count_references(db, [url])[url] else None
+        finally:
+            db.close()
+        self._url_paths.set(key, source)
+        return source
+
+    def resolve_url_path(self, path: str) -> Optional[str]:
+        """Where the file or thumbnail at the URL ``/files/<path>`` is stored
+
+        Returns the path relative to the upload directory, or None if there
+        is no such file or it may not be served. ``<type>/<file id><ext>``
+        and its thumbnails ``<type>/thumbnails/<file id><ext>.<size>.webp``
+        are looked up through the ``files`` table. Older URLs that name the
+        stored file itself still work: random names from before content
+        addressing as they are, and blobs named by their hash, in either
+        layout, only while something references them.
+        """
+        parts = path.split("/")
+        # Empty and dot-prefixed parts cover "..", ".tmp" (uploads in progress) and double slashes
+        if parts[0] not in FILE_TYPES or any(not part or part.startswith(".") or "\0" in part for part in parts):
+            return None
+        # Variants are sent at the URL of their image
+        if len(parts) > 2 and parts[-2] == "variants":
+            return None
+        thumbnail = len(parts) > 2 and parts[-2] == "thumbnails"
+        if thumbnail:
+            source_name = thumbnail_source_name(parts[-1])
+            suffix = parts[-1][len(source_name):]
+            parts = parts[:-2] + [source_name]
+        source = self._source_path("/".join(parts))
+        if source is None:
+            return None
+        if thumbnail:
+            directory, name = source.rsplit("/", 1)
+            source = f"{directory}/thumbnails/{name}{suffix}"
+        return resolve_path(source)
+
+    def previews(self, db: Session, urls: Iterable[str]) -> Dict[str, str]:
+        """Inline previews of the images at ``urls``, in at most two queries"""
+        # File id, or stored path in either layout -> URL it was asked for
+        file_ids = {}
+        paths = {}
+        for url in urls:
+            if url and url.startswith(FILES_URL_PREFIX):
+                path = url[len(FILES_URL_PREFIX):]
+                file_id = parse_file_id(path)
+                if file_id is not None:
+                    file_ids[file_id] = url
+                else:
+                    for variant in self._path_variants(path):
+                        paths.setdefault(variant, url)
+        previews = {}
+        if file_ids:
+            for file_id, preview in db.query(StoredFile.id, FileBlob.preview).join(StoredFile.blob).filter(
+                StoredFile.id.in_(file_ids), FileBlob.preview.isnot(None)
+            ):
+                previews[file_ids[file_id]] = preview
+        if paths:
+            for path, preview in db.query(FileBlob.path, FileBlob.preview).filter(
+                FileBlob.path.in_(paths), FileBlob.preview.isnot(None)
+            ):
+                previews[paths[path]] = preview
+        return previews
+
+    def set_preview(self, db: Session, blob: FileBlob, preview: str) -> None:
+        blob.preview = preview
+        db.commit()
+
+    def usage(self, db: Session, user_id: int) -> StorageUsage:
+        """The user's storage counters, created from their files on first use"""
+        usage = db.get(StorageUsage, user_id)
+        if usage is None:
+            bytes_used, file_count = db.query(
+                func.coalesce(func.sum(StoredFile.size), 0), func.count(StoredFile.id)
+            ).filter(StoredFile.owner_id == user_id).one()
+            db.add(StorageUsage(user_id=user_id, bytes_used=bytes_used, file_count=file_count))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Created by a concurrent request
+                db.rollback()
+            usage = db.get(StorageUsage, user_id)
+        return usage
+
+    def check_quota(self, db: Session, user_id: int, size: int) -> None:
+        if self.quota and self.usage(db, user_id).bytes_used + size > self.quota:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Storage quota exceeded"
+            )
+
+    def remaining_quota(self, db: Session, user_id: int) -> Optional[int]:
+        """Bytes the user may still store; None without a quota"""
+        if not self.quota:
+            return None
+        return max(0, self.quota - self.usage(db, user_id).bytes_used)
+
+    def _charge(self, db: Session, owner_id: int, size: int) -> None:
+        query = db.query(StorageUsage).filter(StorageUsage.user_id == owner_id)
+        if self.quota:
+            query = query.filter(StorageUsage.bytes_used + size <= self.quota)
+        charged = query.update(
+            {StorageUsage.bytes_used: StorageUsage.bytes_used + size,
+             StorageUsage.file_count: StorageUsage.file_count + 1},
+            synchronize_session=False
+        )
+        if not charged:
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Storage quota exceeded"
+            )
+
+    def store(self, db: Session, owner_id: int, file_type: str, filename: str, mime_type: Optional[str],
+              size: int, sha256: str, source_path: str) -> Tuple[StoredFile, bool]:
+        """Add a file whose content is in ``source_path``
+
+        The source file is moved into place when its content is new and
+        removed otherwise, in both cases once the new rows are committed.
+        Returns the new file and whether a blob was written.
+        """
+        self.usage(db, owner_id)
+        created = False
+        if not self._add_reference(db, sha256):
+            db.add(FileBlob(
+                sha256=sha256,
+                file_type=file_type,
+                path=blob_path(file_type, sha256, os.path.splitext(filename)[1].lower()),
+                size=size,
+                mime_type=mime_type,
+                ref_count=1
+            ))
+            try:
+                db.flush()
+                created = True
+            except IntegrityError:
+                # The same content was stored by a concurrent upload
+                db.rollback()
+                if not self._add_reference(db, sha256):
+                    raise
+        self._charge(db, owner_id, size)
+
+        path = self.local_path(db.get(FileBlob, sha256))
+        # A known blob whose file was lost is restored from this upload
+        written = created or not os.path.exists(path)
+        stored_file = self._add_file(db, owner_id, file_type, filename, mime_type, size, sha256)
+
+        # Only now: if the commit fails, the source stays in the temp
+        # directory, which is swept, instead of becoming an untracked blob
+        if not written:
+            _remove(source_path)
+            return stored_file, written
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source_path, path)
+        except OSError:
+            self.release(db, [stored_file])
+            raise
+        return stored_file, written
+
+    def visible_file(self, db: Session, user_id: int, file_id: str) -> Optional[StoredFile]:
+        """The file ``file_id`` if the user owns it or it is attached to a message in one of their chats"""
+        stored_file = db.query(StoredFile).options(joinedload(StoredFile.blob)).filter(
+            StoredFile.id == file_id
+        ).first()
+        if stored_file is None or stored_file.owner_id == user_id:
+            return stored_file
+        shared = db.query(Message.id).join(
+            ChatParticipant, ChatParticipant.chat_id == Message.chat_id
+        ).filter(
+            Message.file_url == self.file_url(stored_file),
+            Message.is_deleted == False,
+            ChatParticipant.user_id == user_id,
+            ChatParticipant.is_active == True
+        ).first()
+        return stored_file if shared is not None else None
+
+    def link(self, db: Session, owner_id: int, file_type: str, filename: str, mime_type: Optional[str],
+             blob: FileBlob) -> Optional[StoredFile]:
+        """Add a file with the content of a stored blob; None if the blob was collected meanwhile"""
+        self.usage(db, owner_id)
+        if not self._add_reference(db, blob.sha256):
+            db.rollback()
+            return None
+        self._charge(db, owner_id, blob.size)
+        return self._add_file(db, owner_id, file_type, filename, mime_type, blob.size, blob.sha256)
+
+    @staticmethod
+    def _add_file(db: Session, owner_id: int, file_type: str, filename: str, mime_type: Optional[str],
+                  size: int, sha256: str) -> StoredFile:
+        stored_file = StoredFile(
+            id=str(uuid.uuid4()),
+            blob_sha256=sha256,
+            owner_id=owner_id,
+            filename=filename,
+            file_type=file_type,
+            mime_type=mime_type,
+            size=size,
+            ref_count=0
+        )
+        db.add(stored_file)
+        db.commit()
+        return stored_file
+
+    def release(self, db: Session, files: List[StoredFile]) -> int:
+        """Delete files that no message references; returns how many were deleted
+
+        Their blobs lose a reference and become collectable at zero, and the
+        owners' usage counters are reduced.
+        """
+        released = 0
+        for stored_file in files:
+            deleted = db.query(StoredFile).filter(
+                StoredFile.id == stored_file.id,
+                StoredFile.ref_count <= 0
+            ).delete(synchronize_session=False)
+            if not deleted:
+                continue
+            self._url_paths.pop(stored_file.id)
+            sha256 = stored_file.blob_sha256
+            db.query(FileBlob).filter(FileBlob.sha256 == sha256).update(
+                {FileBlob.ref_count: FileBlob.ref_count - 1}, synchronize_session=False
+            )
+            db.query(FileBlob).filter(FileBlob.sha256 == sha256, FileBlob.ref_count <= 0).update(
+                {FileBlob.unreferenced_at: datetime.utcnow()}, synchronize_session=False
+            )
+            db.query(StorageUsage).filter(StorageUsage.user_id == stored_file.owner_id).update(
+                {StorageUsage.bytes_used: StorageUsage.bytes_used - stored_file.size,
+                 StorageUsage.file_count: StorageUsage.file_count - 1},
+                synchronize_session=False
+            )
+            released += 1
+        db.commit()
+        return released
+
+    def attach(self, db: Session, owner_id: int, file_id: str) -> Optional[StoredFile]:
+        """Count a new message reference to one of the owner's files; the caller commits"""
+        stored_file = db.query(StoredFile).options(joinedload(StoredFile.blob)).filter(
+            StoredFile.id == file_id,
+            StoredFile.owner_id == owner_id
+        ).first()
+        if stored_file is not None:
+            db.query(StoredFile).filter(StoredFile.id == file_id).update(
+                {StoredFile.ref_count: StoredFile.ref_count + 1}, synchronize_session=False
+            )
+        return stored_file
+
+    def detach(self, db: Session, owner_id: int, file_url: str) -> None:
+        """Drop the reference of a deleted message to the owner's file at ``file_url``; the caller commits"""
+        if not file_url.startswith(FILES_URL_PREFIX):
+            return
+        path = file_url[len(FILES_URL_PREFIX):]
+        query = db.query(StoredFile.id).filter(
+            StoredFile.owner_id == owner_id,
+            StoredFile.ref_count > 0
+        )
+        file_id = parse_file_id(path)
+        if file_id is not None:
+            query = query.filter(StoredFile.id == file_id)
+        else:
+            # A message sent before files got URLs of their own
+            query = query.join(FileBlob).filter(FileBlob.path.in_(self._path_variants(path)))
+        file_id = query.limit(1).scalar()
+        if file_id is not None:
+            db.query(StoredFile).filter(StoredFile.id == file_id).update(
+                {StoredFile.ref_count: StoredFile.ref_count - 1}, synchronize_session=False
+            )
+
+    @classmethod
+    def _count_references(cls, db: Session, urls: Iterable[str]) -> Counter:
+        """Messages and avatars pointing at each of ``urls``, in either directory layout"""
+        # Every URL that may be stored for a file -> the URL it is counted under
+        queried = {}
+        for url in urls:
+            queried[url] = url
+            if url.startswith(FILES_URL_PREFIX):
+                for path in cls._path_variants(url[len(FILES_URL_PREFIX):]):
+                    queried.setdefault(f"{FILES_URL_PREFIX}{path}", url)
+        references = Counter()
+        if not queried:
+            return references
+        for column, *filters in (
+            (Message.file_url, Message.is_deleted == False),
+            (User.avatar_url,),
+            (Chat.avatar_url,),
+        ):
+            for url, count in db.query(column, func.count()).filter(column.in_(queried), *filters).group_by(column):
+                references[queried[url]] += count
+        return references
+
+    def sweep_orphans(self, max_batches: int = 100) -> int:
+        """Delete unreferenced files older than the orphan grace period, one batch per transaction"""
+        cutoff = datetime.utcnow() - self.orphan_grace_period
+        removed = 0
+        db = SessionLocal()
+        try:
+            for _ in range(max_batches):
+                files = db.query(StoredFile).options(joinedload(StoredFile.blob)).filter(
+                    StoredFile.ref_count <= 0,
+                    StoredFile.created_at < cutoff
+                ).limit(self.gc_batch_size).all()
+                if not files:
+                    break
+                # Messages and avatars from before files got URLs of their own point at the blob
+                urls = {
+                    stored_file.id: (self.file_url(stored_file), self._blob_url(stored_file.blob))
+                    for stored_file in files
+                }
+                references = self._count_references(db, {url for pair in urls.values() for url in pair})
+                orphans = []
+                for stored_file in files:
+                    count = sum(references[url] for url in urls[stored_file.id])
+                    if count:
+                        # Referenced without being counted (avatars, messages
+                        # sent before counting): repair the counter instead
+                        stored_file.ref_count = count
+                    else:
+                        orphans.append(stored_file)
+                removed += self.release(db, orphans)
+        finally:
+            db.close()
+        return removed
+
+    def _remove_untracked(self, db: Session, paths: List[str]) -> int:
+        variants = [variant for path in paths for variant in self._path_variants(path)]
+        tracked = {path for (path,) in db.query(FileBlob.path).filter(FileBlob.path.in_(variants))}
+        untracked = []
+        removed = 0
+        for path in paths:
+            if path in tracked:
+                continue
+            if alternate_path(path) in tracked:
+                # Left behind by an interrupted layout migration; the moved copy serves its URL
+                _remove_with_thumbnails(path)
+                removed += 1
+            else:
+                untracked.append(path)
+        references = self._count_references(db, (f"{FILES_URL_PREFIX}{path}" for path in untracked))
+        for path in untracked:
+            if not references[f"{FILES_URL_PREFIX}{path}"]:
+                _remove_with_thumbnails(path)
+                removed += 1
+        return removed
+
+    def sweep_untracked(self) -> int:
+        """Remove unreferenced files stored before content addressing and thumbnails without a source
+
+        Only files older than the orphan grace period are considered; their
+        references are looked up ``gc_batch_size`` files at a time. Only the
+        flat ``<file_type>/`` directories are scanned: sharded directories
+        hold nothing but blobs, whose thumbnails are removed with them.
+        """
+        cutoff = time.time() - self.orphan_grace_period.total_seconds()
+        removed = 0
+        db = SessionLocal()
+        try:
+            for file_type in FILE_TYPES:
+                directory = os.path.join(settings.upload_dir, file_type)
+                if not os.path.isdir(directory):
+                    continue
+                batch = []
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file() and entry.stat().st_mtime < cutoff:
+                            batch.append(f"{file_type}/{entry.name}")
+                        if len(batch) >= self.gc_batch_size:
+                            removed += self._remove_untracked(db, batch)
+                            batch = []
+                if batch:
+                    removed += self._remove_untracked(db, batch)
+
+                thumbnails_dir = os.path.join(directory, "thumbnails")
+                if not os.path.isdir(thumbnails_dir):
+                    continue
+                with os.scandir(thumbnails_dir) as entries:
+                    for entry in entries:
+                        source = os.path.join(directory, thumbnail_source_name(entry.name))
+                        if entry.stat().st_mtime < cutoff and not os.path.exists(source):
+                            _remove(entry.path)
+                            removed += 1
+        finally:
+            db.close()
+        return removed
+
+    def collect_garbage(self, max_batches: int = 100) -> int:
+        """Delete blobs unreferenced for longer than the grace period, one batch per transaction"""
+        cutoff = datetime.utcnow() - self.grace_period
+        collected = 0
+        db = SessionLocal()
+        try:
+            for _ in range(max_batches):
+                blobs = db.query(FileBlob.sha256, FileBlob.path).filter(
+                    FileBlob.ref_count <= 0,
+                    FileBlob.unreferenced_at < cutoff
+                ).limit(self.gc_batch_size).all()
+                if not blobs:
+                    break
+                for blob in blobs:
+                    # The job row references the blob; if the blob is referenced
+                    # again and kept, the transcoder recreates the job
+                    db.query(TranscodeJob).filter(TranscodeJob.blob_sha256 == blob.sha256).delete(
+                        synchronize_session=False
+                    )
+                    # Skip blobs that were referenced again since the query
+                    deleted = db.query(FileBlob).filter(
+                        FileBlob.sha256 == blob.sha256,
+                        FileBlob.ref_count <= 0
+                    ).delete(synchronize_session=False)
+                    if deleted:
+                        _remove_with_thumbnails(blob.path)
+                        collected += 1
+                db.commit()
+        finally:
+            db.close()
+        return collected
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        # Tables created before the file_url index existed do not get it from create_all
+        for index in Message.__table__.indexes:
+            await asyncio.to_thread(index.create, engine, checkfirst=True)
+        while True:
+            try:
+                orphans = await asyncio.to_thread(self.sweep_orphans)
+                untracked = await asyncio.to_thread(self.sweep_untracked)
+                collected = await asyncio.to_thread(self.collect_garbage)
+                if orphans or untracked or collected:
+                    logger.info(
+                        "Removed %s orphaned files, %s untracked files and thumbnails, %s unreferenced blobs",
+                        orphans, untracked, collected
+                    )
+            except Exception as exc:
+                logger.error("File storage cleanup failed: %s", exc)
+            await asyncio.sleep(self.gc_interval)
+
+
+blob_store = BlobStore(
+    quota=settings.user_storage_quota,
+    gc_interval=settings.blob_gc_interval,
+    grace_period=timedelta(seconds=settings.blob_gc_grace_period),
+    orphan_grace_period=timedelta(seconds=settings.file_orphan_grace_period),
+    gc_batch_size=settings.blob_gc_batch_size,
+    url_cache_ttl=settings.media_memory_cache_ttl,
+)
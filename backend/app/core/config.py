@@ -18,10 +18,16 @@ class Settings(BaseSettings):
     
     # Security & Encryption
     secret_key: str = secrets.token_urlsafe(32)
-    encryption_key: str = secrets.token_urlsafe(32)
+    encryption_key: str = ""  # required while encrypt_messages is on; must be the same in every worker
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 30
     refresh_token_expire_days: int = 7
+    auth_cache_ttl: int = 60  # seconds a decoded token is reused
+    auth_identity_cache_ttl: int = 5  # seconds another worker may still accept a deactivated user
+    auth_cache_max_entries: int = 10000
+    token_revocation_sync_interval: int = 5  # seconds between revocation syncs across workers
+    refresh_token_reuse_grace: int = 10  # seconds a just-rotated refresh token is refused without ending its session
+    session_purge_interval: int = 3600  # seconds between deletions of expired and revoked sessions
     
     # Password Security
     password_min_length: int = 8
@@ -35,17 +41,54 @@ class Settings(BaseSettings):
     rate_limit_window: int = 60
     rate_limit_sms: int = 5
     rate_limit_login: int = 10
+    rate_limit_max_keys: int = 200000  # tracked clients before LRU eviction
+    rate_limit_redis_timeout: float = 0.25  # seconds to connect to / wait for Redis before per-process limits apply
+    rate_limit_redis_max_backoff: float = 30.0  # longest pause, in seconds, before retrying a failing Redis
+    rate_limit_trusted_proxies: List[str] = []  # proxy IPs / networks whose X-Forwarded-For and X-Real-IP are believed
+    enable_rate_limiting: bool = True
     
     # Security Headers
     enable_security_headers: bool = False
     enable_csrf_protection: bool = True
     enable_helmet: bool = True
     
+    # Security audit (case-insensitive substrings logged when found in URL or user agent)
+    security_audit_patterns: List[str] = [
+        "script", "javascript:", "vbscript:", "onload=", "onerror=",
+        "union select", "drop table", "delete from", "insert into",
+        "../", "..\\", "/etc/passwd", "/proc/version"
+    ]
+    security_audit_scan_body: bool = False
+    security_audit_body_limit: int = 4096  # bytes of each request body scanned
+    
+    # WebSocket heartbeats
+    ws_heartbeat_interval: int = 30  # seconds between server pings
+    ws_heartbeat_timeout: int = 75  # seconds of silence before a socket is reaped
+    ws_heartbeat_tick: float = 1.0  # timer wheel resolution in seconds
+    ws_heartbeat_send_timeout: float = 5.0  # seconds a ping may wait on a stalled socket
+    
+    # Call signaling rooms
+    ws_call_room_ttl: int = 3600  # idle seconds before a call room expires
+    ws_call_max_participants: int = 16
+    ws_call_rate_limit: float = 20.0  # signaling frames per second per call
+    ws_call_rate_burst: int = 60
+    
     # SMS Service
     sms_api_key: str = ""
     sms_api_url: str = "https://api.sms-service.com"
     sms_rate_limit: int = 5
     
+    # Phone verification
+    verification_code_ttl: int = 300  # seconds
+    verification_max_attempts: int = 3
+    verification_audit_flush_interval: float = 2.0  # seconds between batched audit writes
+    verification_audit_retention_days: int = 30
+    verification_purge_interval: int = 3600  # seconds between purges of old audit rows
+    verification_purge_batch_size: int = 500
+    verification_redis_timeout: float = 0.5  # seconds to connect to / wait for Redis before answering 503
+    verification_redis_max_backoff: float = 10.0  # longest pause, in seconds, before retrying a failing Redis
+    verification_audit_max_pending: int = 10000  # queued audit rows; the oldest are dropped while the database lags
+    
     # File Storage & Security
     upload_dir: str = "uploads"
     max_file_size: int = 10485760
@@ -56,6 +99,32 @@ class Settings(BaseSettings):
         "application/pdf", "text/plain"
     ]
     scan_uploads_for_malware: bool = True
+    upload_session_ttl: int = 86400  # seconds a resumable upload survives without new chunks
+    upload_session_purge_interval: int = 3600
+    blob_gc_interval: int = 3600  # seconds between garbage collections of unreferenced blobs
+    blob_gc_grace_period: int = 3600  # seconds an unreferenced blob is kept for re-uploads
+    blob_gc_batch_size: int = 500
+    file_orphan_grace_period: int = 86400  # seconds an upload may wait to be attached to a message
+    user_storage_quota: int = 1073741824  # bytes per user, 0 disables the quota
+    thumbnail_sizes: List[int] = [90, 320, 800]  # px, longest side; WebP
+    thumbnail_default_size: int = 320
+    thumbnail_quality: int = 80
+    thumbnail_workers: int = 2  # processes rendering thumbnails off the event loop
+    image_preview_size: int = 20  # px, longest side of the preview inlined in file and message payloads
+    image_preview_max_bytes: int = 1024
+    image_variant_max_size: int = 2048  # px, longest side of the re-encoded images served by default
+    image_variant_quality: int = 82
+    transcode_workers: int = 1  # processes of its own, so a backfill never delays thumbnails of new uploads
+    transcode_poll_interval: int = 10  # seconds between checks for due jobs when idle
+    transcode_batch_size: int = 20  # image blobs given a job per check
+    transcode_max_attempts: int = 5
+    transcode_retry_delay: int = 30  # seconds before the first retry, doubled on every attempt
+    media_cache_max_age: int = 86400  # seconds; files with content-addressed names are cached for good
+    media_chunk_size: int = 262144  # bytes per read when the server has no zero-copy send
+    media_memory_cache_bytes: int = 67108864  # in-memory cache of small hot files; 0 disables it
+    media_memory_cache_max_file_size: int = 262144
+    media_memory_cache_ttl: int = 300  # seconds; bounds how long other workers serve a deleted file
+    user_search_candidates: int = 200  # index matches ranked per user search query
     
     # CORS & Security
     allowed_origins: List[str] = [
@@ -83,6 +152,8 @@ class Settings(BaseSettings):
     encrypt_personal_data: bool = True
     encrypt_messages: bool = True
     encrypt_files: bool = False
+    crypto_max_workers: int = 4  # threads for PBKDF2 / bulk encryption off the event loop
+    message_search_scan_limit: int = 5000  # latest messages of a chat decrypted per search when encrypted
     
     
     class Config:
@@ -3,18 +3,61 @@ from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import base64
+import functools
+import hmac
 import secrets
 import hashlib
-from typing import Union, Optional
+from typing import List, Sequence, Union
 import json
 from app.core.config import settings
 
+PBKDF2_ITERATIONS = 100000
+# Values of ENCRYPTION_KEY that mean it was never set
+UNSET_KEYS = ("", "your-encryption-key-here-change-in-production")
+
 
 class EncryptionManager:
-    def __init__(self):
-        self.encryption_key = self._derive_key(settings.encryption_key)
-        self.fernet = Fernet(self._create_fernet_key())
+    """AES-256-GCM encryption and PBKDF2 hashing of sensitive data.
+
+    The key is derived by ``prepare()`` at application startup rather than
+    at import time or in the first request that needs it, and the derived
+    key's AESGCM/Fernet objects are built once and reused. PBKDF2 releases
+    the GIL, so the ``*_async`` variants run it on a small bounded thread
+    pool and keep the event loop responsive.
+    """
+
+    def __init__(self, max_workers: int = settings.crypto_max_workers):
+        # Threads are only started on first use, so this is safe before forking
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="crypto")
+    
+    def prepare(self) -> None:
+        """Derive the key and build the cipher now instead of on first use
+
+        Refuses to run with message encryption on and no key configured:
+        a key made up per process would leave messages unreadable in other
+        workers and after a restart.
+        """
+        if settings.encrypt_messages and settings.encryption_key in UNSET_KEYS:
+            raise RuntimeError("ENCRYPTION_KEY must be set while ENCRYPT_MESSAGES is on")
+        self._aesgcm
+    
+    @functools.cached_property
+    def encryption_key(self) -> bytes:
+        return self._derive_key(settings.encryption_key)
+    
+    @functools.cached_property
+    def fernet(self) -> Fernet:
+        return Fernet(self._create_fernet_key())
+    
+    @functools.cached_property
+    def _aesgcm(self) -> AESGCM:
+        return AESGCM(self.encryption_key)
+    
+    def _run_in_pool(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
     
     def _derive_key(self, password: str) -> bytes:
         """Derive encryption key from password using PBKDF2"""
@@ -24,7 +67,7 @@ class EncryptionManager:
             algorithm=hashes.SHA256(),
             length=32,
             salt=salt,
-            iterations=100000,
+            iterations=PBKDF2_ITERATIONS,
         )
         return kdf.derive(password_bytes)
     
@@ -42,11 +85,8 @@ class EncryptionManager:
         # Generate random nonce
         nonce = secrets.token_bytes(12)
         
-        # Create AESGCM cipher
-        aesgcm = AESGCM(self.encryption_key)
-        
         # Encrypt data
-        encrypted_data = aesgcm.encrypt(nonce, data, None)
+        encrypted_data = self._aesgcm.encrypt(nonce, data, None)
         
         # Combine nonce and encrypted data
         combined = nonce + encrypted_data
@@ -64,11 +104,8 @@ class EncryptionManager:
             nonce = combined[:12]
             encrypted = combined[12:]
             
-            # Create AESGCM cipher
-            aesgcm = AESGCM(self.encryption_key)
-            
             # Decrypt data
-            decrypted_data = aesgcm.decrypt(nonce, encrypted, None)
+            decrypted_data = self._aesgcm.decrypt(nonce, encrypted, None)
             
             # Try to parse as JSON, fallback to string
             try:
@@ -79,6 +116,26 @@ class EncryptionManager:
         except Exception as e:
             raise ValueError(f"Failed to decrypt data: {str(e)}")
     
+    def decrypt_text(self, encrypted_data: str) -> str:
+        """Decrypt data that is known to be plain text (no JSON parsing)"""
+        try:
+            combined = base64.urlsafe_b64decode(encrypted_data.encode('utf-8'))
+            return self._aesgcm.decrypt(combined[:12], combined[12:], None).decode('utf-8')
+        except Exception as e:
+            raise ValueError(f"Failed to decrypt data: {str(e)}")
+    
+    def decrypt_many(self, items: Sequence[str]) -> List[str]:
+        """decrypt_text for a batch of values, with the cipher looked up once"""
+        decrypt = self._aesgcm.decrypt
+        b64decode = base64.urlsafe_b64decode
+        try:
+            return [
+                decrypt(combined[:12], combined[12:], None).decode('utf-8')
+                for combined in (b64decode(item.encode('utf-8')) for item in items)
+            ]
+        except Exception as e:
+            raise ValueError(f"Failed to decrypt data: {str(e)}")
+    
     def encrypt_message(self, message: str) -> str:
         """Encrypt message content"""
         if not settings.encrypt_messages:
@@ -89,7 +146,7 @@ class EncryptionManager:
         """Decrypt message content"""
         if not settings.encrypt_messages:
             return encrypted_message
-        return self.decrypt_data(encrypted_message)
+        return self.decrypt_text(encrypted_message)
     
     def encrypt_personal_data(self, data: dict) -> dict:
         """Encrypt personal data fields"""
@@ -126,17 +183,25 @@ class EncryptionManager:
     def hash_sensitive_data(self, data: str) -> str:
         """Create secure hash of sensitive data"""
         salt = secrets.token_hex(16)
-        hash_obj = hashlib.pbkdf2_hmac('sha256', data.encode('utf-8'), salt.encode('utf-8'), 100000)
+        hash_obj = hashlib.pbkdf2_hmac('sha256', data.encode('utf-8'), salt.encode('utf-8'), PBKDF2_ITERATIONS)
         return f"{salt}:{hash_obj.hex()}"
     
     def verify_hash(self, data: str, hashed_data: str) -> bool:
         """Verify hash of sensitive data"""
         try:
             salt, hash_hex = hashed_data.split(':')
-            hash_obj = hashlib.pbkdf2_hmac('sha256', data.encode('utf-8'), salt.encode('utf-8'), 100000)
-            return hash_obj.hex() == hash_hex
+            hash_obj = hashlib.pbkdf2_hmac('sha256', data.encode('utf-8'), salt.encode('utf-8'), PBKDF2_ITERATIONS)
+            return hmac.compare_digest(hash_obj.hex(), hash_hex)
         except (ValueError, AttributeError):
             return False
+    
+    async def hash_sensitive_data_async(self, data: str) -> str:
+        """hash_sensitive_data without blocking the event loop"""
+        return await self._run_in_pool(self.hash_sensitive_data, data)
+    
+    async def verify_hash_async(self, data: str, hashed_data: str) -> bool:
+        """verify_hash without blocking the event loop"""
+        return await self._run_in_pool(self.verify_hash, data, hashed_data)
 
 
 class SecureRandom:
@@ -163,18 +228,33 @@ class DataSanitizer:
     
     @staticmethod
     def sanitize_phone_number(phone: str) -> str:
-        """Sanitize and validate phone number"""
-        # Remove all non-digit characters
-        digits = ''.join(filter(str.isdigit, phone))
+        """Canonical E.164 form of a phone number, e.g. "+77001234567"
+        
+        Spaces, dashes, dots and brackets are dropped, a leading "00" becomes
+        "+", and national numbers (10 digits, or 11 starting with 7 or 8)
+        get the +7 country code. Raises ValueError for anything that is not
+        "+" and 7-15 digits then.
+        """
+        phone = phone.strip()
+        international = phone.startswith('+')
+        digits = phone[1:] if international else phone
+        for separator in " -.()":
+            digits = digits.replace(separator, '')
+        if not digits.isascii() or not digits.isdigit():
+            raise ValueError("Phone number may only contain digits, spaces, dashes, dots and brackets")
         
         # Add country code if missing
-        if not phone.startswith('+'):
-            if digits.startswith('7') and len(digits) == 11:
-                return f"+{digits}"
+        if not international:
+            if digits.startswith('00'):
+                digits = digits[2:]
+            elif len(digits) == 11 and digits[0] in '78':
+                digits = f"7{digits[1:]}"
             elif len(digits) == 10:
-                return f"+7{digits}"
+                digits = f"7{digits}"
         
-        return phone
+        if not 7 <= len(digits) <= 15 or digits.startswith('0'):
+            raise ValueError("Phone number must have a country code and 7 to 15 digits")
+        return f"+{digits}"
     
     @staticmethod
     def sanitize_username(username: str) -> str:
@@ -0,0 +1,392 @@
+"""
+Serving stored files over HTTP
+
+Blobs are named by the SHA-256 of their content, so their URL never
+changes meaning: they get a strong ETag made of the hash and an
+``immutable`` Cache-Control, and browsers stop asking for them at all.
+Other files - thumbnails and uploads from before content addressing - get
+an ETag from their size and mtime and are revalidated after
+``media_cache_max_age``.
+
+Responses answer ``If-None-Match`` / ``If-Modified-Since`` with 304 and a
+single ``Range`` with 206, so scrubbing a video or resuming a download
+only transfers the requested bytes. The body is handed to the server as a
+file descriptor when it supports the ASGI zero-copy send extension
+(``os.sendfile`` in the kernel), and otherwise read in large chunks off the
+event loop.
+
+Small files that many clients fetch - avatars, group images, thumbnails -
+are additionally kept in ``hot_media_cache``, a byte-budgeted LRU in
+memory, and served from there with precomputed headers.
+"""
+
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+import asyncio
+import mimetypes
+import os
+import re
+import threading
+import time
+from fastapi import Request
+from fastapi.responses import Response
+from app.core.config import settings
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+_CONTENT_ADDRESSED_NAME = re.compile(r"[0-9a-f]{64}(\.[A-Za-z0-9]+)?")
+_BYTE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def is_content_addressed(path: str) -> bool:
+    return _CONTENT_ADDRESSED_NAME.fullmatch(os.path.basename(path)) is not None
+
+
+def make_etag(path: str, stat_result: os.stat_result) -> str:
+    """Strong ETag: the content hash for blobs, size and mtime for anything else"""
+    name = os.path.basename(path)
+    if _CONTENT_ADDRESSED_NAME.fullmatch(name):
+        return f'"{name.split(".", 1)[0]}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires"""
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _not_modified_since(header: str, mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single-range ``Range`` header
+
+    Returns None when the whole file should be sent: malformed headers and
+    multiple ranges are ignored, as RFC 9110 allows.
+    """
+    match = _BYTE_RANGE.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+class FileRangeResponse(Response):
+    """Sends ``length`` bytes of a file from ``offset``
+
+    Stops reading as soon as the client disconnects, which is what most
+    range requests of a scrubbed video end with.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        offset: int,
+        length: int,
+        status_code: int,
+        headers: List[Tuple[bytes, bytes]],
+        send_body: bool = True,
+    ):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.raw_headers = headers
+        self.send_body = send_body
+        self.background = None
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.length == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        with open(self.path, "rb") as file:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "offset": self.offset,
+                    "count": self.length,
+                })
+                return
+            body = asyncio.ensure_future(self._send_chunks(file.fileno(), send))
+            disconnect = asyncio.ensure_future(self._wait_for_disconnect(receive))
+            done, pending = await asyncio.wait((body, disconnect), return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if body in done:
+                body.result()
+
+    async def _send_chunks(self, fd: int, send) -> None:
+        chunk_size = settings.media_chunk_size
+        position = self.offset
+        end = self.offset + self.length
+        while position < end:
+            chunk = await asyncio.to_thread(os.pread, fd, min(chunk_size, end - position), position)
+            if not chunk:
+                # The file shrank since it was stat-ed; the declared length cannot be met
+                raise RuntimeError(f"{self.path} ended before the declared Content-Length")
+            position += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": position < end})
+
+    @staticmethod
+    async def _wait_for_disconnect(receive) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+
+class MediaHeaders:
+    """Validators and precomputed response headers of one file"""
+
+    __slots__ = ("size", "mtime", "etag", "last_modified", "common", "typed", "full")
+
+    def __init__(self, path: str, stat_result: os.stat_result, media_type: Optional[str],
+                 immutable: Optional[bool], vary: Optional[str]):
+        self.size = stat_result.st_size
+        self.mtime = stat_result.st_mtime
+        self.etag = make_etag(path, stat_result)
+        self.last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        if immutable is None:
+            immutable = is_content_addressed(path)
+        cache_control = IMMUTABLE_CACHE_CONTROL if immutable else f"public, max-age={settings.media_cache_max_age}"
+        media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        # Sent with every response, 304 included
+        self.common = [
+            (b"etag", self.etag.encode("latin-1")),
+            (b"cache-control", cache_control.encode("latin-1")),
+            (b"last-modified", self.last_modified.encode("latin-1")),
+            (b"accept-ranges", b"bytes"),
+        ]
+        if vary is not None:
+            self.common.append((b"vary", vary.encode("latin-1")))
+        self.typed = self.common + [(b"content-type", media_type.encode("latin-1"))]
+        self.full = self.typed + [(b"content-length", str(self.size).encode("latin-1"))]
+
+
+def plan_response(request: Request, info: MediaHeaders) -> Tuple[int, int, int, List[Tuple[bytes, bytes]]]:
+    """Status, offset and length of the body, and headers of the response to ``request``"""
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if (if_none_match is not None and _etag_matches(if_none_match, info.etag)) or \
+            (if_none_match is None and if_modified_since is not None
+             and _not_modified_since(if_modified_since, info.mtime)):
+        return 304, 0, 0, info.common
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A Range conditional on an older version of the file gets the whole file
+    if range_header is None or (if_range is not None and if_range.strip() not in (info.etag, info.last_modified)):
+        return 200, 0, info.size, info.full
+    try:
+        byte_range = parse_range(range_header, info.size)
+    except RangeNotSatisfiable:
+        return 416, 0, 0, info.typed + [
+            (b"content-range", f"bytes */{info.size}".encode("latin-1")),
+            (b"content-length", b"0"),
+        ]
+    if byte_range is None:
+        return 200, 0, info.size, info.full
+    start, end = byte_range
+    return 206, start, end - start + 1, info.typed + [
+        (b"content-range", f"bytes {start}-{end}/{info.size}".encode("latin-1")),
+        (b"content-length", str(end - start + 1).encode("latin-1")),
+    ]
+
+
+def media_response(request: Request, path: str, media_type: Optional[str] = None,
+                   immutable: Optional[bool] = None, vary: Optional[str] = None) -> Response:
+    """Serve a local file with caching headers, conditional GET and byte ranges
+
+    The caller checks that ``path`` exists; a file removed in between is a
+    404. ``immutable`` defaults to whether the file name is a content hash;
+    ``vary`` names the request headers that chose the file.
+    """
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return Response(status_code=404)
+
+    status_code, offset, length, headers = plan_response(
+        request, MediaHeaders(path, stat_result, media_type, immutable, vary)
+    )
+    send_body = status_code in (200, 206) and request.method != "HEAD"
+    return FileRangeResponse(path, offset, length, status_code, headers, send_body)
+
+
+class MemoryResponse(Response):
+    """Sends a body already in memory with precomputed headers"""
+
+    def __init__(self, body: bytes, status_code: int, headers: List[Tuple[bytes, bytes]]):
+        self.body = body
+        self.status_code = status_code
+        self.raw_headers = headers
+        self.background = None
+
+
+class CachedMedia:
+    __slots__ = ("body", "info", "file_path", "expires_at")
+
+    def __init__(self, body: bytes, info: MediaHeaders, file_path: str, expires_at: float):
+        self.body = body
+        self.info = info
+        self.file_path = file_path
+        self.expires_at = expires_at
+
+
+class HotMediaCache:
+    """Byte-budgeted LRU of small, frequently requested files
+
+    Avatars, group images and thumbnails are fetched by every member of a
+    chat; a hit is answered from memory with precomputed headers, without
+    resolving, stat-ing or opening the file. Keys are what the request
+    asked for - the URL path and whatever picked the variant - and entries
+    point back at the local file, so deleting it can invalidate them. Files
+    over ``max_file_size`` are not kept. Entries expire after ``ttl``
+    seconds, which bounds how long other worker processes, which do not see
+    invalidations, may serve a removed file.
+
+    Safe to use from the event loop and from threads, like ``TTLCache``.
+    """
+
+    def __init__(self, max_bytes: int, max_file_size: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, CachedMedia]" = OrderedDict()
+        self._keys_by_file: Dict[str, Set[Hashable]] = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def get(self, key: Hashable) -> Optional[CachedMedia]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    async def load(self, key: Hashable, path: str, media_type: Optional[str] = None,
+                   immutable: Optional[bool] = None, vary: Optional[str] = None) -> Optional[CachedMedia]:
+        """Read the file at ``path`` into the cache under ``key``; None if it is too large or gone"""
+        if not self.enabled:
+            return None
+        try:
+            stat_result = os.stat(path)
+            if stat_result.st_size > self.max_file_size:
+                return None
+            body = await asyncio.to_thread(_read_file, path)
+        except FileNotFoundError:
+            return None
+        if len(body) != stat_result.st_size:
+            # Replaced while it was read
+            return None
+        entry = CachedMedia(body, MediaHeaders(path, stat_result, media_type, immutable, vary), path,
+                            time.monotonic() + self.ttl)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = entry
+            self._keys_by_file.setdefault(path, set()).add(key)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+        return entry
+
+    def response(self, request: Request, entry: CachedMedia) -> Response:
+        """The response to ``request`` from a cached file, conditional and range requests included"""
+        status_code, offset, length, headers = plan_response(request, entry.info)
+        if request.method == "HEAD" or status_code not in (200, 206):
+            body = b""
+        elif length == len(entry.body):
+            body = entry.body
+        else:
+            body = entry.body[offset:offset + length]
+        with self._lock:
+            self.bytes_saved += len(body)
+        # A copy: middleware such as CORS appends to the headers of the response
+        return MemoryResponse(body, status_code, list(headers))
+
+    def invalidate(self, path: str) -> None:
+        """Drop every entry read from the local file at ``path``"""
+        with self._lock:
+            for key in list(self._keys_by_file.get(path, ())):
+                self._pop(key)
+
+    def _pop(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= len(entry.body)
+        keys = self._keys_by_file[entry.file_path]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_file[entry.file_path]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_file.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+hot_media_cache = HotMediaCache(
+    max_bytes=settings.media_memory_cache_bytes,
+    max_file_size=settings.media_memory_cache_max_file_size,
+    ttl=settings.media_memory_cache_ttl,
+)
@@ -3,25 +3,240 @@ Advanced rate limiting system for Telegram Clone
 Provides multiple rate limiting strategies for different endpoints
 """
 
-from fastapi import Request, HTTPException, status
+from fastapi import HTTPException, Request, status
 from fastapi.responses import JSONResponse
 import time
-import hashlib
+import ipaddress
 from typing import Dict, Optional, Tuple
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
-import asyncio
+from collections import OrderedDict
+import logging
 from app.core.config import settings
+from app.core.cache import TTLCache
+from app.core.security import verify_token
+
+logger = logging.getLogger(__name__)
+
+
+class _KeyState:
+    """Fixed-size rate limit state for one key (sliding window counter)"""
+
+    __slots__ = ("window", "prev_count", "curr_count", "blocked_until", "failed_attempts", "idle_until")
+
+    def __init__(self, window: int):
+        self.window = window
+        self.prev_count = 0
+        self.curr_count = 0
+        self.blocked_until = 0.0
+        self.failed_attempts = 0
+        self.idle_until = 0.0
+
+
+# Result of one check: allowed, remaining, reset time (or block end), failed attempts
+HitResult = Tuple[bool, int, float, int]
+
+
+class MemoryRateLimitBackend:
+    """Per-process backend: sliding window counters in an LRU
+
+    Uses the sliding window counter approximation: each key keeps only the
+    request counts of the current and previous fixed windows and weights
+    the previous one by how much of it still overlaps the sliding window.
+    Memory per key is constant regardless of the limit, and keys that have
+    been idle for longer than their window and block are evicted in LRU
+    order, with ``max_keys`` as a hard cap.
+    """
+    
+    # Idle keys evicted per call; keeps eviction cost O(1) amortized
+    _EVICT_BATCH = 8
+    
+    def __init__(self, max_keys: int = settings.rate_limit_max_keys):
+        # In-memory storage for rate limiting, least recently used first
+        self.states: "OrderedDict[str, _KeyState]" = OrderedDict()
+        self.max_keys = max_keys
+    
+    def _evict_idle(self, now: float):
+        """Drop least recently used keys that are idle or over the key budget"""
+        states = self.states
+        for _ in range(self._EVICT_BATCH):
+            if not states:
+                return
+            oldest = next(iter(states.values()))
+            if oldest.idle_until > now and len(states) < self.max_keys:
+                return
+            states.popitem(last=False)
+    
+    def consume(self, key: str, limit: int, window: int, block_duration: int, now: float) -> HitResult:
+        """Count one request for ``key``"""
+        self._evict_idle(now)
+        
+        state = self.states.get(key)
+        if state is None:
+            state = _KeyState(int(now // window))
+            self.states[key] = state
+        else:
+            self.states.move_to_end(key)
+        
+        # Check if currently blocked
+        if state.blocked_until > now:
+            return False, 0, state.blocked_until, state.failed_attempts
+        
+        # Advance the key to the current window
+        window_index = int(now // window)
+        if window_index != state.window:
+            state.prev_count = state.curr_count if window_index == state.window + 1 else 0
+            state.curr_count = 0
+            state.window = window_index
+        overlap = 1.0 - (now - window_index * window) / window
+        current_requests = state.prev_count * overlap + state.curr_count
+        reset_time = (window_index + 1) * window
+        
+        if current_requests + 1 > limit:
+            # Rate limit exceeded
+            state.blocked_until = now + block_duration
+            state.failed_attempts += 1
+            state.idle_until = state.blocked_until + window
+            return False, 0, state.blocked_until, state.failed_attempts
+        
+        # Add current request
+        state.curr_count += 1
+        state.idle_until = max(state.idle_until, reset_time + window)
+        return True, max(0, int(limit - current_requests - 1)), reset_time, state.failed_attempts
+    
+    async def hit(self, key: str, limit: int, window: int, block_duration: int, now: float) -> HitResult:
+        return self.consume(key, limit, window, block_duration, now)
+
+
+# Same algorithm as MemoryRateLimitBackend.consume, run atomically inside
+# Redis. State is one hash per key; its TTL replaces LRU eviction.
+_SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local block_duration = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', KEYS[1], 'w', 'p', 'c', 'b', 'f')
+local index = math.floor(now / window)
+local w = tonumber(state[1]) or index
+local prev = tonumber(state[2]) or 0
+local curr = tonumber(state[3]) or 0
+local blocked_until = tonumber(state[4]) or 0
+local failed = tonumber(state[5]) or 0
+
+if blocked_until > now then
+    return {0, 0, tostring(blocked_until), failed}
+end
+
+if index ~= w then
+    if index == w + 1 then prev = curr else prev = 0 end
+    curr = 0
+    w = index
+end
+local current = prev * (1 - (now - index * window) / window) + curr
+
+if current + 1 > limit then
+    blocked_until = now + block_duration
+    failed = failed + 1
+    redis.call('HSET', KEYS[1], 'w', w, 'p', prev, 'c', curr, 'b', tostring(blocked_until), 'f', failed)
+    redis.call('EXPIRE', KEYS[1], math.ceil(block_duration + window))
+    return {0, 0, tostring(blocked_until), failed}
+end
+
+curr = curr + 1
+redis.call('HSET', KEYS[1], 'w', w, 'p', prev, 'c', curr, 'b', tostring(blocked_until), 'f', failed)
+redis.call('EXPIRE', KEYS[1], 2 * window)
+return {1, math.max(0, math.floor(limit - current - 1)), tostring((w + 1) * window), failed}
+"""
+
+
+class RedisRateLimitBackend:
+    """Backend shared by all workers; each check is one EVALSHA round trip
+
+    If Redis is unreachable, checks fall back to per-process counters, so an
+    outage degrades limits instead of failing requests. After a failure
+    Redis is left alone for a backoff that doubles up to ``max_backoff``
+    seconds while it keeps failing, and only one request at a time probes
+    it, so an outage does not add a connect timeout to every request.
+    """
+    
+    def __init__(self, client, prefix: str = "ratelimit:", min_backoff: float = 1.0,
+                 max_backoff: float = settings.rate_limit_redis_max_backoff):
+        self._redis = client
+        self._script = client.register_script(_SLIDING_WINDOW_SCRIPT)
+        self.prefix = prefix
+        self.fallback = MemoryRateLimitBackend()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._degraded = False
+        self._backoff = 0.0
+        self._retry_at = 0.0
+    
+    async def hit(self, key: str, limit: int, window: int, block_duration: int, now: float) -> HitResult:
+        if self._degraded:
+            monotonic = time.monotonic()
+            if monotonic < self._retry_at:
+                return self.fallback.consume(key, limit, window, block_duration, now)
+            # Requests arriving while this one probes Redis keep using the fallback
+            self._retry_at = monotonic + self._backoff
+        
+        try:
+            allowed, remaining, reset_time, failed = await self._script(
+                keys=[self.prefix + key],
+                args=[limit, window, block_duration, now]
+            )
+        except Exception as exc:
+            if not self._degraded:
+                logger.warning("Redis rate limiting unavailable, using per-process limits: %s", exc)
+                self._degraded = True
+                self._backoff = self.min_backoff
+            else:
+                self._backoff = min(self._backoff * 2, self.max_backoff)
+            self._retry_at = time.monotonic() + self._backoff
+            return self.fallback.consume(key, limit, window, block_duration, now)
+        
+        if self._degraded:
+            logger.info("Redis rate limiting restored")
+            self._degraded = False
+        return bool(allowed), int(remaining), float(reset_time), int(failed)
+
+
+def _create_backend():
+    if settings.use_redis:
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            logger.warning("redis package is not installed, rate limits are enforced per process")
+        else:
+            # Short timeouts: a slow Redis must not hold up every request
+            return RedisRateLimitBackend(aioredis.from_url(
+                settings.redis_url,
+                socket_connect_timeout=settings.rate_limit_redis_timeout,
+                socket_timeout=settings.rate_limit_redis_timeout
+            ))
+    return MemoryRateLimitBackend()
+
+
+def rate_limit_headers(info: Dict) -> Dict[str, str]:
+    """Build rate limit response headers from a check result"""
+    if 'limit' not in info:
+        return {}
+    return {
+        'X-RateLimit-Limit': str(info['limit']),
+        'X-RateLimit-Remaining': str(info['remaining']),
+        'X-RateLimit-Reset': str(int(info['reset_time'])),
+        'X-RateLimit-Window': str(info['window'])
+    }
 
 
 class RateLimiter:
-    """Advanced rate limiter with multiple strategies"""
+    """Advanced rate limiter with multiple strategies
     
-    def __init__(self):
-        # In-memory storage for rate limiting
-        self.requests: Dict[str, deque] = defaultdict(deque)
-        self.blocked_ips: Dict[str, float] = {}
-        self.failed_attempts: Dict[str, int] = defaultdict(int)
+    Counting is delegated to a backend: Redis when ``USE_REDIS`` is enabled,
+    so that limits hold across all workers, otherwise process memory.
+    """
+    
+    def __init__(self, backend=None, trusted_proxies=settings.rate_limit_trusted_proxies):
+        self.backend = backend if backend is not None else _create_backend()
+        self.trusted_proxies = [ipaddress.ip_network(proxy, strict=False) for proxy in trusted_proxies]
         
         # Rate limiting rules
         self.rules = {
@@ -49,131 +264,98 @@ class RateLimiter:
                 'requests': 100,
                 'window': 60,  # 1 minute
                 'block_duration': 300  # 5 minutes
+            },
+            # One request per chunk of a resumable upload
+            'upload_chunk': {
+                'requests': 600,
+                'window': 60,  # 1 minute
+                'block_duration': 60  # 1 minute
+            },
+            # Files and thumbnails; a chat screen loads many at once
+            'media': {
+                'requests': 1200,
+                'window': 60,  # 1 minute
+                'block_duration': 60  # 1 minute
             }
         }
     
+    def _is_trusted_proxy(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+    
     def _get_client_ip(self, request: Request) -> str:
-        """Extract client IP address"""
-        # Check for forwarded headers first
+        """Extract client IP address
+        
+        X-Forwarded-For and X-Real-IP are only believed when the connection
+        comes from one of ``RATE_LIMIT_TRUSTED_PROXIES``; anyone else could
+        set them to get a fresh limit on every request.
+        """
+        peer = request.client.host if request.client else 'unknown'
+        if not self._is_trusted_proxy(peer):
+            return peer
+        
         forwarded_for = request.headers.get('X-Forwarded-For')
         if forwarded_for:
-            return forwarded_for.split(',')[0].strip()
+            # Proxies append, so the client is the last address not added by our own proxies
+            addresses = [address.strip() for address in forwarded_for.split(',') if address.strip()]
+            for address in reversed(addresses):
+                if not self._is_trusted_proxy(address):
+                    return address
+            if addresses:
+                return addresses[0]
         
         real_ip = request.headers.get('X-Real-IP')
         if real_ip:
-            return real_ip
+            return real_ip.strip()
         
-        # Fallback to direct connection
-        return request.client.host if request.client else 'unknown'
+        return peer
     
     def _get_rate_limit_key(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> str:
         """Generate rate limit key"""
-        client_ip = self._get_client_ip(request)
-        
         if user_id:
             # User-based rate limiting
             return f"user:{user_id}:{rule_type}"
         else:
             # IP-based rate limiting
-            return f"ip:{client_ip}:{rule_type}"
+            return f"ip:{self._get_client_ip(request)}:{rule_type}"
     
-    def _cleanup_old_requests(self, key: str, window: int):
-        """Clean up old requests outside the window"""
-        current_time = time.time()
-        cutoff_time = current_time - window
+    async def hit(self, key: str, rule_type: str) -> Tuple[bool, Dict]:
+        """Count one request for ``key`` under ``rule_type``
         
-        # Remove old requests
-        while self.requests[key] and self.requests[key][0] < cutoff_time:
-            self.requests[key].popleft()
-    
-    def _is_blocked(self, key: str) -> bool:
-        """Check if key is currently blocked"""
-        if key in self.blocked_ips:
-            if time.time() < self.blocked_ips[key]:
-                return True
-            else:
-                # Remove expired block
-                del self.blocked_ips[key]
-        return False
-    
-    def _block_key(self, key: str, duration: int):
-        """Block key for specified duration"""
-        self.blocked_ips[key] = time.time() + duration
-    
-    def _increment_failed_attempts(self, key: str):
-        """Increment failed attempts counter"""
-        self.failed_attempts[key] += 1
-    
-    def _reset_failed_attempts(self, key: str):
-        """Reset failed attempts counter"""
-        self.failed_attempts[key] = 0
-    
-    def check_rate_limit(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> Tuple[bool, Dict]:
-        """Check if request is within rate limits"""
+        The returned info carries everything needed for the response
+        headers (see ``rate_limit_headers``), so no second lookup is needed.
+        """
         if rule_type not in self.rules:
             return True, {}
         
         rule = self.rules[rule_type]
-        key = self._get_rate_limit_key(request, rule_type, user_id)
-        
-        # Check if currently blocked
-        if self._is_blocked(key):
-            return False, {
-                'error': 'Rate limit exceeded',
-                'retry_after': int(self.blocked_ips[key] - time.time()),
-                'blocked': True
-            }
-        
-        # Clean up old requests
-        self._cleanup_old_requests(key, rule['window'])
-        
-        # Check current request count
-        current_requests = len(self.requests[key])
-        
-        if current_requests >= rule['requests']:
-            # Rate limit exceeded
-            self._block_key(key, rule['block_duration'])
-            self._increment_failed_attempts(key)
-            
-            return False, {
-                'error': 'Rate limit exceeded',
-                'retry_after': rule['block_duration'],
-                'blocked': True,
-                'failed_attempts': self.failed_attempts[key]
-            }
-        
-        # Add current request
-        self.requests[key].append(time.time())
-        
-        # Calculate remaining requests
-        remaining = rule['requests'] - current_requests - 1
-        
-        return True, {
+        now = time.time()
+        allowed, remaining, reset_time, failed_attempts = await self.backend.hit(
+            key, rule['requests'], rule['window'], rule['block_duration'], now
+        )
+        info = {
+            'limit': rule['requests'],
             'remaining': remaining,
-            'reset_time': time.time() + rule['window'],
-            'failed_attempts': self.failed_attempts[key]
+            'reset_time': reset_time,
+            'failed_attempts': failed_attempts,
+            'window': rule['window']
         }
+        if not allowed:
+            info.update({
+                'error': 'Rate limit exceeded',
+                'retry_after': max(1, int(reset_time - now)),
+                'blocked': True
+            })
+        return allowed, info
     
-    def get_rate_limit_headers(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> Dict[str, str]:
-        """Get rate limit headers for response"""
+    async def check_rate_limit(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> Tuple[bool, Dict]:
+        """Check if request is within rate limits"""
         if rule_type not in self.rules:
-            return {}
-        
-        rule = self.rules[rule_type]
-        key = self._get_rate_limit_key(request, rule_type, user_id)
-        
-        # Clean up old requests
-        self._cleanup_old_requests(key, rule['window'])
-        
-        current_requests = len(self.requests[key])
-        remaining = max(0, rule['requests'] - current_requests)
-        
-        return {
-            'X-RateLimit-Limit': str(rule['requests']),
-            'X-RateLimit-Remaining': str(remaining),
-            'X-RateLimit-Reset': str(int(time.time() + rule['window'])),
-            'X-RateLimit-Window': str(rule['window'])
-        }
+            return True, {}
+        return await self.hit(self._get_rate_limit_key(request, rule_type, user_id), rule_type)
 
 
 class AdvancedRateLimiter:
@@ -181,15 +363,22 @@ class AdvancedRateLimiter:
     
     def __init__(self):
         self.rate_limiter = RateLimiter()
-        self.suspicious_ips: Dict[str, int] = defaultdict(int)
+        # Strike counts per IP, forgotten an hour after the last strike
+        self.suspicious_ips = TTLCache(maxsize=settings.rate_limit_max_keys, ttl=3600)
         self.geo_blocking: Dict[str, bool] = {}
     
-    def check_request(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> Tuple[bool, Dict]:
-        """Check if request should be allowed"""
+    async def check_request(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> Tuple[bool, Dict]:
+        """Check if request should be allowed
+        
+        With ``user_id`` the request is counted, and marked suspicious, per
+        user rather than per IP, so users sharing an address are not
+        blocked for each other.
+        """
         client_ip = self.rate_limiter._get_client_ip(request)
+        subject = f"user:{user_id}" if user_id else client_ip
         
         # Check for suspicious activity
-        if self._is_suspicious_ip(client_ip):
+        if self._is_suspicious_ip(subject):
             return False, {
                 'error': 'Suspicious activity detected',
                 'retry_after': 3600,
@@ -205,12 +394,12 @@ class AdvancedRateLimiter:
             }
         
         # Check rate limits
-        allowed, info = self.rate_limiter.check_rate_limit(request, rule_type, user_id)
+        allowed, info = await self.rate_limiter.check_rate_limit(request, rule_type, user_id)
         
         if not allowed:
             # Mark IP as suspicious after multiple failures
             if info.get('failed_attempts', 0) > 5:
-                self._mark_suspicious_ip(client_ip)
+                self._mark_suspicious_ip(subject)
         
         return allowed, info
     
@@ -220,65 +409,124 @@ class AdvancedRateLimiter:
     
     def _mark_suspicious_ip(self, ip: str):
         """Mark IP as suspicious"""
-        self.suspicious_ips[ip] += 1
+        self.suspicious_ips.set(ip, self.suspicious_ips.get(ip, 0) + 1)
     
     def _is_geo_blocked(self, ip: str) -> bool:
         """Check if IP is geo-blocked"""
         # In production, implement actual geo-blocking
         return False
-    
-    def get_rate_limit_headers(self, request: Request, rule_type: str, user_id: Optional[str] = None) -> Dict[str, str]:
-        """Get rate limit headers"""
-        return self.rate_limiter.get_rate_limit_headers(request, rule_type, user_id)
 
 
 # Global rate limiter instance
 rate_limiter = AdvancedRateLimiter()
 
 
-def rate_limit(rule_type: str, user_based: bool = False):
-    """Decorator for rate limiting endpoints"""
-    def decorator(func):
-        async def wrapper(*args, **kwargs):
-            # Extract request from arguments
-            request = None
-            user_id = None
-            
-            for arg in args:
-                if isinstance(arg, Request):
-                    request = arg
-                    break
-            
-            if not request:
-                return await func(*args, **kwargs)
-            
-            # Get user ID if user-based rate limiting
-            if user_based:
-                # This would need to be implemented based on your auth system
-                pass
-            
-            # Check rate limit
-            allowed, info = rate_limiter.check_request(request, rule_type, user_id)
-            
-            if not allowed:
-                headers = rate_limiter.get_rate_limit_headers(request, rule_type, user_id)
-                return JSONResponse(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    content={
-                        'detail': info.get('error', 'Rate limit exceeded'),
-                        'retry_after': info.get('retry_after', 60)
-                    },
-                    headers=headers
-                )
-            
-            # Add rate limit headers to response
-            response = await func(*args, **kwargs)
-            if hasattr(response, 'headers'):
-                headers = rate_limiter.get_rate_limit_headers(request, rule_type, user_id)
-                for key, value in headers.items():
-                    response.headers[key] = value
-            
-            return response
+# Rate limit rule per (method, path); other API requests use 'general'
+ROUTE_RULES: Dict[Tuple[str, str], str] = {
+    ('POST', '/api/v1/auth/send-verification'): 'sms',
+    ('POST', '/api/v1/auth/verify-code'): 'login',
+    ('POST', '/api/v1/auth/refresh-token'): 'login',
+    ('POST', '/api/v1/files/upload'): 'upload',
+    ('POST', '/api/v1/files/uploads'): 'upload',
+    ('POST', '/api/v1/messages'): 'message',
+}
+
+# Routes with path parameters
+UPLOAD_CHUNK_PREFIX = '/api/v1/files/uploads/'
+MEDIA_PREFIXES = tuple(f'/api/v1/files/{file_type}/' for file_type in ('image', 'video', 'audio', 'document'))
+
+RATE_LIMITED_PREFIX = '/api/'
+
+# Counted per client IP even with a valid token: they guard getting a token
+IP_RULES = frozenset({'sms', 'login'})
+
+
+def resolve_rule(method: str, path: str) -> Optional[str]:
+    """Rate limit rule for a request, or None if it is not limited"""
+    if method == 'OPTIONS' or not path.startswith(RATE_LIMITED_PREFIX):
+        return None
+    rule = ROUTE_RULES.get((method, path.rstrip('/')))
+    if rule is not None:
+        return rule
+    if method == 'PUT' and path.startswith(UPLOAD_CHUNK_PREFIX):
+        return 'upload_chunk'
+    if method in ('GET', 'HEAD') and path.startswith(MEDIA_PREFIXES):
+        return 'media'
+    return 'general'
+
+
+def token_user_id(scope) -> Optional[str]:
+    """User id of a valid bearer access token sent with the request, if any
+    
+    Decoded tokens are cached by ``verify_token``, so this is a dictionary
+    lookup for all but the first request with a token.
+    """
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            scheme, _, token = value.decode('latin-1').partition(' ')
+            if scheme.lower() != 'bearer' or not token.strip():
+                return None
+            try:
+                payload = verify_token(token.strip())
+            except HTTPException:
+                return None
+            user_id = payload.get('user_id')
+            return str(user_id) if user_id is not None else None
+    return None
+
+
+class RateLimitMiddleware:
+    """Pure ASGI rate limiting middleware
+    
+    Picks the rule from ``ROUTE_RULES`` by method and path, and checks it
+    before the request body is read or any endpoint dependency (such as
+    the database session) runs. Requests with a valid bearer token are
+    counted per user, others - and the rules in ``IP_RULES`` - per client
+    IP. Excess requests get a 429 straight away;
+    allowed ones get the rate limit headers added to the response start
+    message, computed once from the check result.
+    """
+    
+    def __init__(self, app, limiter: Optional["AdvancedRateLimiter"] = None):
+        self.app = app
+        self.limiter = limiter if limiter is not None else rate_limiter
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        rule_type = resolve_rule(scope['method'], scope['path'])
+        if rule_type is None:
+            await self.app(scope, receive, send)
+            return
+        
+        user_id = None if rule_type in IP_RULES else token_user_id(scope)
+        allowed, info = await self.limiter.check_request(Request(scope), rule_type, user_id)
+        headers = rate_limit_headers(info)
+        
+        if not allowed:
+            logger.info("Rate limit exceeded: rule=%s path=%s", rule_type, scope['path'])
+            response = JSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={
+                    'detail': info.get('error', 'Rate limit exceeded'),
+                    'retry_after': info.get('retry_after', 60)
+                },
+                headers={
+                    **headers,
+                    'Retry-After': str(info.get('retry_after', 60)),
+                    'Access-Control-Allow-Origin': '*',
+                }
+            )
+            await response(scope, receive, send)
+            return
+        
+        raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+        
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + raw_headers
+            await send(message)
         
-        return wrapper
-    return decorator
+        await self.app(scope, receive, send_with_headers)
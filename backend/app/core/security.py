@@ -1,15 +1,63 @@
 from datetime import datetime, timedelta
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status
 from app.core.config import settings
+from app.core.cache import TTLCache
 import random
 import secrets
+import threading
+import time
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Decoded token payloads, so repeat requests skip signature verification.
+# Entries never outlive the token's own expiry.
+token_cache = TTLCache(maxsize=settings.auth_cache_max_entries, ttl=settings.auth_cache_ttl)
+
+
+class TokenRevocationList:
+    """In-memory set of revoked token ids (``jti``) checked on every request.
+
+    Each entry remembers the token's expiry and is dropped once it passes,
+    because an expired token is rejected by the signature check anyway.
+    The set is filled locally on logout and from the shared
+    ``revoked_tokens`` table by the sync task in ``app.core.sessions``.
+    """
+
+    def __init__(self):
+        self._revoked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def revoke(self, jti: str, expires_at: float) -> None:
+        if expires_at > time.time():
+            with self._lock:
+                self._revoked[jti] = expires_at
+
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, exp in self._revoked.items() if exp <= now]
+            for jti in expired:
+                del self._revoked[jti]
+        return len(expired)
+
+
+revocation_list = TokenRevocationList()
+
+
+def new_token_id() -> str:
+    """Generate a unique JWT id (jti)"""
+    return secrets.token_hex(16)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
     return pwd_context.verify(plain_password, hashed_password)
@@ -26,6 +74,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
     
+    to_encode.setdefault("jti", new_token_id())
     to_encode.update({"exp": expire, "type": "access"})
     encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
@@ -34,25 +83,39 @@ def create_refresh_token(data: dict) -> str:
     """Create JWT refresh token"""
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(days=settings.refresh_token_expire_days)
+    to_encode.setdefault("jti", new_token_id())
     to_encode.update({"exp": expire, "type": "refresh"})
     encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
 def verify_token(token: str, token_type: str = "access") -> dict:
     """Verify and decode JWT token"""
-    try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
-        if payload.get("type") != token_type:
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+        except JWTError:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token type"
+                detail="Could not validate credentials"
             )
-        return payload
-    except JWTError:
+        exp = payload.get("exp")
+        if exp is not None:
+            token_cache.set(token, payload, ttl=exp - time.time())
+    
+    if payload.get("type") != token_type:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token type"
+        )
+    
+    jti = payload.get("jti")
+    if jti is not None and revocation_list.is_revoked(jti):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials"
+            detail="Token has been revoked"
         )
+    return payload
 
 def generate_verification_code() -> str:
     """Generate 4-digit verification code"""
@@ -3,273 +3,297 @@ Advanced security headers middleware for Telegram Clone
 Provides comprehensive security headers and protection
 """
 
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.middleware.base import RequestResponseEndpoint
-from starlette.responses import Response as StarletteResponse
+from logging.handlers import QueueHandler, QueueListener
+from starlette.responses import PlainTextResponse
+from urllib.parse import unquote_plus
+import logging
+import os
+import queue
+import re
 import time
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Tuple
 from app.core.config import settings
 
+logger = logging.getLogger('security')
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    """Advanced security headers middleware"""
-    
-    def __init__(self, app):
-        super().__init__(app)
-        self.security_headers = self._get_security_headers()
+# Request bodies of these types are scanned when SECURITY_AUDIT_SCAN_BODY is on
+SCANNED_BODY_TYPES = (b'application/json', b'application/x-www-form-urlencoded', b'text/')
+
+
+def _get_security_headers() -> Dict[str, str]:
+    """Get comprehensive security headers"""
+    headers = {}
     
-    def _get_security_headers(self) -> Dict[str, str]:
-        """Get comprehensive security headers"""
-        headers = {}
+    if settings.enable_security_headers:
+        # Content Security Policy
+        headers['Content-Security-Policy'] = (
+            "default-src 'self'; "
+            "script-src 'self' 'unsafe-inline' 'unsafe-eval'; "
+            "style-src 'self' 'unsafe-inline'; "
+            "img-src 'self' data: https:; "
+            "font-src 'self' data:; "
+            "connect-src 'self' wss: ws:; "
+            "frame-ancestors 'none'; "
+            "base-uri 'self'; "
+            "form-action 'self'"
+        )
         
-        if settings.enable_security_headers:
-            # Content Security Policy
-            headers['Content-Security-Policy'] = (
-                "default-src 'self'; "
-                "script-src 'self' 'unsafe-inline' 'unsafe-eval'; "
-                "style-src 'self' 'unsafe-inline'; "
-                "img-src 'self' data: https:; "
-                "font-src 'self' data:; "
-                "connect-src 'self' wss: ws:; "
-                "frame-ancestors 'none'; "
-                "base-uri 'self'; "
-                "form-action 'self'"
-            )
-            
-            # X-Frame-Options
-            headers['X-Frame-Options'] = 'DENY'
-            
-            # X-Content-Type-Options
-            headers['X-Content-Type-Options'] = 'nosniff'
-            
-            # X-XSS-Protection
-            headers['X-XSS-Protection'] = '1; mode=block'
-            
-            # Referrer Policy
-            headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-            
-            # Permissions Policy
-            headers['Permissions-Policy'] = (
-                "geolocation=(), "
-                "microphone=(), "
-                "camera=(), "
-                "payment=(), "
-                "usb=(), "
-                "magnetometer=(), "
-                "gyroscope=(), "
-                "speaker=()"
+        # X-Frame-Options
+        headers['X-Frame-Options'] = 'DENY'
+        
+        # X-Content-Type-Options
+        headers['X-Content-Type-Options'] = 'nosniff'
+        
+        # X-XSS-Protection
+        headers['X-XSS-Protection'] = '1; mode=block'
+        
+        # Referrer Policy
+        headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
+        
+        # Permissions Policy
+        headers['Permissions-Policy'] = (
+            "geolocation=(), "
+            "microphone=(), "
+            "camera=(), "
+            "payment=(), "
+            "usb=(), "
+            "magnetometer=(), "
+            "gyroscope=(), "
+            "speaker=()"
+        )
+        
+        # Strict Transport Security (HTTPS only)
+        if settings.is_production():
+            headers['Strict-Transport-Security'] = (
+                'max-age=31536000; '
+                'includeSubDomains; '
+                'preload'
             )
-            
-            # Strict Transport Security (HTTPS only)
-            if settings.is_production():
-                headers['Strict-Transport-Security'] = (
-                    'max-age=31536000; '
-                    'includeSubDomains; '
-                    'preload'
-                )
-            
-            # Cross-Origin Policies
-            headers['Cross-Origin-Embedder-Policy'] = 'require-corp'
-            headers['Cross-Origin-Opener-Policy'] = 'same-origin'
-            headers['Cross-Origin-Resource-Policy'] = 'same-origin'
-            
-            # Additional security headers
-            headers['X-Permitted-Cross-Domain-Policies'] = 'none'
-            headers['X-Download-Options'] = 'noopen'
-            headers['X-DNS-Prefetch-Control'] = 'off'
-            
-            # Server information hiding
-            headers['Server'] = 'Telegram Clone API'
-            
-            # Cache control for sensitive endpoints
-            headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, proxy-revalidate'
-            headers['Pragma'] = 'no-cache'
-            headers['Expires'] = '0'
         
-        return headers
-    
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> StarletteResponse:
-        """Process request and add security headers"""
-        start_time = time.time()
+        # Cross-Origin Policies
+        headers['Cross-Origin-Embedder-Policy'] = 'require-corp'
+        headers['Cross-Origin-Opener-Policy'] = 'same-origin'
+        headers['Cross-Origin-Resource-Policy'] = 'same-origin'
         
-        # Add security headers to response
-        response = await call_next(request)
+        # Additional security headers
+        headers['X-Permitted-Cross-Domain-Policies'] = 'none'
+        headers['X-Download-Options'] = 'noopen'
+        headers['X-DNS-Prefetch-Control'] = 'off'
         
-        # Add all security headers
-        for header, value in self.security_headers.items():
-            response.headers[header] = value
+        # Server information hiding
+        headers['Server'] = 'Telegram Clone API'
         
-        # Add timing headers
-        process_time = time.time() - start_time
-        response.headers['X-Process-Time'] = str(process_time)
+        # Cache control for sensitive endpoints
+        headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, proxy-revalidate'
+        headers['Pragma'] = 'no-cache'
+        headers['Expires'] = '0'
+    
+    return headers
+
+
+def _get_helmet_headers() -> Dict[str, str]:
+    """Get Helmet.js equivalent headers"""
+    headers = {}
+    
+    if settings.enable_helmet:
+        # DNS Prefetch Control
+        headers['X-DNS-Prefetch-Control'] = 'off'
         
-        # Add request ID for tracking
-        request_id = getattr(request.state, 'request_id', None)
-        if request_id:
-            response.headers['X-Request-ID'] = request_id
+        # Expect-CT
+        if settings.is_production():
+            headers['Expect-CT'] = 'max-age=86400, enforce'
         
-        return response
+        # Feature Policy
+        headers['Feature-Policy'] = (
+            "geolocation 'none'; "
+            "microphone 'none'; "
+            "camera 'none'; "
+            "payment 'none'; "
+            "usb 'none'"
+        )
+    
+    return headers
 
 
-class CSRFProtectionMiddleware(BaseHTTPMiddleware):
-    """CSRF protection middleware"""
+class PatternScanner:
+    """Case-insensitive multi-pattern matcher, compiled once
     
-    def __init__(self, app):
-        super().__init__(app)
-        self.csrf_token_header = 'X-CSRF-Token'
-        self.csrf_cookie_name = 'csrf_token'
+    All patterns are joined into a single alternation, so one left-to-right
+    pass over the text finds the first occurrence of any of them: the cost
+    grows with the length of the text, not with repeated lowercasing and
+    substring searches per pattern.
+    """
     
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> StarletteResponse:
-        """Process request with CSRF protection"""
-        if settings.enable_csrf_protection:
-            # Skip CSRF for safe methods
-            if request.method in ['GET', 'HEAD', 'OPTIONS']:
-                response = await call_next(request)
-                return response
-            
-            # Check CSRF token for state-changing methods
-            if request.method in ['POST', 'PUT', 'PATCH', 'DELETE']:
-                csrf_token = request.headers.get(self.csrf_token_header)
-                if not csrf_token:
-                    return StarletteResponse(
-                        content='CSRF token missing',
-                        status_code=403
-                    )
-                
-                # In production, validate CSRF token
-                # For now, just check if it exists
-                if not self._validate_csrf_token(csrf_token):
-                    return StarletteResponse(
-                        content='Invalid CSRF token',
-                        status_code=403
-                    )
-        
-        response = await call_next(request)
-        return response
+    def __init__(self, patterns: Iterable[str]):
+        # Longest first, so the most specific of overlapping patterns is reported
+        ordered = sorted({pattern for pattern in patterns if pattern}, key=len, reverse=True)
+        self.max_length = max((len(pattern.encode('utf-8')) for pattern in ordered), default=0)
+        self._text = re.compile('|'.join(map(re.escape, ordered)), re.IGNORECASE) if ordered else None
+        self._bytes = re.compile(
+            b'|'.join(re.escape(pattern.encode('utf-8')) for pattern in ordered), re.IGNORECASE
+        ) if ordered else None
     
-    def _validate_csrf_token(self, token: str) -> bool:
-        """Validate CSRF token"""
-        # In production, implement proper CSRF token validation
-        # For now, just check if token exists and is not empty
-        return bool(token and len(token) > 10)
+    def search(self, text: str) -> Optional[str]:
+        """Return the first pattern found in ``text``, lowercased"""
+        match = self._text.search(text) if self._text is not None else None
+        return match.group(0).lower() if match else None
+    
+    def search_bytes(self, data: bytes) -> Optional[str]:
+        match = self._bytes.search(data) if self._bytes is not None else None
+        return match.group(0).decode('utf-8', 'replace').lower() if match else None
 
 
-class HelmetMiddleware(BaseHTTPMiddleware):
-    """Helmet.js equivalent middleware for Python"""
+class AuditLogQueue:
+    """Hand ``security`` log records to a background thread
     
-    def __init__(self, app):
-        super().__init__(app)
-        self.helmet_headers = self._get_helmet_headers()
+    Suspicious-activity warnings are put on an in-memory queue from the
+    request path and written by a ``QueueListener`` thread through the root
+    logger's handlers, so a slow log sink never stalls the event loop.
+    """
     
-    def _get_helmet_headers(self) -> Dict[str, str]:
-        """Get Helmet.js equivalent headers"""
-        headers = {}
-        
-        if settings.enable_helmet:
-            # DNS Prefetch Control
-            headers['X-DNS-Prefetch-Control'] = 'off'
-            
-            # Hide X-Powered-By
-            headers['X-Powered-By'] = ''
-            
-            # Expect-CT
-            if settings.is_production():
-                headers['Expect-CT'] = 'max-age=86400, enforce'
-            
-            # Feature Policy
-            headers['Feature-Policy'] = (
-                "geolocation 'none'; "
-                "microphone 'none'; "
-                "camera 'none'; "
-                "payment 'none'; "
-                "usb 'none'"
-            )
-        
-        return headers
+    def __init__(self):
+        self._queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._handler = QueueHandler(self._queue)
+        self._listener: Optional[QueueListener] = None
     
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> StarletteResponse:
-        """Process request with Helmet protection"""
-        response = await call_next(request)
-        
-        # Add Helmet headers
-        for header, value in self.helmet_headers.items():
-            if value:
-                response.headers[header] = value
-        
-        return response
+    def start(self) -> None:
+        if self._listener is not None:
+            return
+        handlers = logging.getLogger().handlers or [logging.StreamHandler()]
+        self._listener = QueueListener(self._queue, *handlers, respect_handler_level=True)
+        self._listener.start()
+        logger.addHandler(self._handler)
+        logger.propagate = False
+    
+    def stop(self) -> None:
+        if self._listener is None:
+            return
+        logger.removeHandler(self._handler)
+        logger.propagate = True
+        self._listener.stop()
+        self._listener = None
 
 
-class RequestIDMiddleware(BaseHTTPMiddleware):
-    """Add request ID to all requests for tracking"""
+audit_log_queue = AuditLogQueue()
+
+
+class SecurityMiddleware:
+    """Request IDs, security headers, CSRF protection and audit logging
+    
+    A single pure ASGI layer: the response body is never buffered or copied,
+    so streaming and file responses pass through untouched. Header name and
+    value bytes are computed once at startup and appended to the
+    ``http.response.start`` message; headers the endpoint set itself (for
+    example ``Cache-Control`` on static files) are left as they are.
+    """
+    
+    csrf_token_header = b'x-csrf-token'
     
     def __init__(self, app):
-        super().__init__(app)
+        self.app = app
+        headers = {**_get_helmet_headers(), **_get_security_headers()}
+        self.security_headers: List[Tuple[bytes, bytes]] = [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()
+        ]
+        self.scanner = PatternScanner(settings.security_audit_patterns)
+        self.scan_body = settings.security_audit_scan_body and self.scanner.max_length > 0
+        self.body_limit = settings.security_audit_body_limit
     
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> StarletteResponse:
-        """Add request ID to request and response"""
-        import uuid
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
         
-        # Generate unique request ID
-        request_id = str(uuid.uuid4())
-        request.state.request_id = request_id
+        start_time = time.perf_counter()
         
-        # Process request
-        response = await call_next(request)
+        # Generate unique request ID, visible to endpoints as request.state.request_id
+        request_id = os.urandom(16).hex()
+        scope.setdefault('state', {})['request_id'] = request_id
         
-        # Add request ID to response headers
-        response.headers['X-Request-ID'] = request_id
+        # ASGI header names are already lowercase
+        request_headers = dict(scope['headers'])
+        self._audit(scope, request_headers)
+        if self.scan_body and request_headers.get(b'content-type', b'').lower().startswith(SCANNED_BODY_TYPES):
+            receive = self._scan_body(scope, receive)
         
-        return response
-
-
-class SecurityAuditMiddleware(BaseHTTPMiddleware):
-    """Security audit middleware for logging suspicious activity"""
+        if settings.enable_csrf_protection and self._is_csrf_rejected(scope['method'], request_headers):
+            response = PlainTextResponse('CSRF token missing or invalid', status_code=403)
+            await response(scope, receive, self._add_headers(send, request_id, start_time))
+            return
+        
+        await self.app(scope, receive, self._add_headers(send, request_id, start_time))
     
-    def __init__(self, app):
-        super().__init__(app)
-        self.suspicious_patterns = [
-            'script', 'javascript:', 'vbscript:', 'onload=', 'onerror=',
-            'union select', 'drop table', 'delete from', 'insert into',
-            '../', '..\\', '/etc/passwd', '/proc/version'
-        ]
+    def _add_headers(self, send, request_id: str, start_time: float):
+        security_headers = self.security_headers
+        
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                present = {name.lower() for name, _ in headers}
+                headers.extend(pair for pair in security_headers if pair[0] not in present)
+                headers.append((b'x-process-time', str(time.perf_counter() - start_time).encode('latin-1')))
+                headers.append((b'x-request-id', request_id.encode('latin-1')))
+                message['headers'] = headers
+            await send(message)
+        
+        return send_with_headers
+    
+    def _is_csrf_rejected(self, method: str, headers: Dict[bytes, bytes]) -> bool:
+        """Check CSRF token for state-changing methods
+        
+        Only cookie-carrying requests without an Authorization header can be
+        forged cross-site; bearer-token API calls are never checked.
+        """
+        if method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            return False
+        if b'authorization' in headers or b'cookie' not in headers:
+            return False
+        return not self._validate_csrf_token(headers.get(self.csrf_token_header))
+    
+    def _validate_csrf_token(self, token: Optional[bytes]) -> bool:
+        """Validate CSRF token"""
+        # In production, implement proper CSRF token validation
+        # For now, just check if token exists and is not empty
+        return bool(token and len(token) > 10)
+    
+    def _audit(self, scope, headers: Dict[bytes, bytes]):
+        """Check for suspicious patterns in URL and headers"""
+        url = scope['path']
+        if scope['query_string']:
+            url = f"{url}?{unquote_plus(scope['query_string'].decode('latin-1'))}"
+        
+        pattern = self.scanner.search(url) or self.scanner.search_bytes(headers.get(b'user-agent', b''))
+        if pattern:
+            # Log suspicious activity
+            self._log_suspicious_activity(scope, pattern)
     
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> StarletteResponse:
-        """Audit request for suspicious activity"""
-        # Check for suspicious patterns in URL and headers
-        url = str(request.url)
-        user_agent = request.headers.get('user-agent', '')
+    def _scan_body(self, scope, receive):
+        """Wrap ``receive`` to scan the first ``body_limit`` bytes as the app reads them"""
+        remaining = self.body_limit
+        # Keep the end of the previous chunk so matches across chunk borders are found
+        overlap = self.scanner.max_length - 1
+        tail = b''
         
-        for pattern in self.suspicious_patterns:
-            if pattern.lower() in url.lower() or pattern.lower() in user_agent.lower():
-                # Log suspicious activity
-                self._log_suspicious_activity(request, pattern)
-                
-                # In production, you might want to block or rate limit
-                # For now, just log and continue
-                break
+        async def receive_and_scan():
+            nonlocal remaining, tail
+            message = await receive()
+            if remaining > 0 and message['type'] == 'http.request':
+                chunk = message.get('body', b'')[:remaining]
+                remaining -= len(chunk)
+                window = tail + chunk
+                pattern = self.scanner.search_bytes(window)
+                if pattern:
+                    self._log_suspicious_activity(scope, pattern, 'request body')
+                    remaining = 0
+                tail = window[-overlap:] if overlap else b''
+            return message
         
-        response = await call_next(request)
-        return response
+        return receive_and_scan
     
-    def _log_suspicious_activity(self, request: Request, pattern: str):
+    def _log_suspicious_activity(self, scope, pattern: str, location: str = 'request'):
         """Log suspicious activity"""
-        import logging
-        
-        logger = logging.getLogger('security')
+        client = scope.get('client')
         logger.warning(
-            f"Suspicious activity detected: {pattern} "
-            f"from {request.client.host if request.client else 'unknown'} "
-            f"to {request.url}"
+            "Suspicious activity detected: %s in %s from %s to %s %s",
+            pattern, location, client[0] if client else 'unknown', scope['method'], scope['path']
         )
-
-
-def get_security_middleware() -> List[BaseHTTPMiddleware]:
-    """Get list of security middleware"""
-    return [
-        RequestIDMiddleware,
-        SecurityHeadersMiddleware,
-        CSRFProtectionMiddleware,
-        HelmetMiddleware,
-        SecurityAuditMiddleware
-    ]
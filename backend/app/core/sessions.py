@@ -0,0 +1,260 @@
+"""
+Server-side login sessions with refresh-token rotation and revocation
+
+Every login creates a ``UserSession`` row that stores the id of the only
+refresh token still valid for it. Refreshing rotates that id with a
+conditional update, so of two concurrent refreshes with the same token only
+one succeeds, and replaying an old refresh token is detected and revokes
+the whole session - unless the session was rotated within
+``refresh_token_reuse_grace`` seconds, which is the losing side of such a
+race rather than a leak. Access
+tokens are revoked by ``jti``: revocations are written to the
+``revoked_tokens`` table and mirrored into the in-memory
+``revocation_list`` of every worker by ``RevocationSync``, which keeps
+``verify_token`` free of database lookups. The same task deletes expired
+and revoked sessions every ``session_purge_interval`` seconds.
+"""
+
+from datetime import datetime, timedelta
+from typing import Optional
+import asyncio
+import calendar
+import logging
+import time
+from fastapi import HTTPException, status
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.security import (
+    create_access_token,
+    create_refresh_token,
+    new_token_id,
+    revocation_list,
+)
+from app.models.session import UserSession, RevokedToken
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+
+def _epoch(value: datetime) -> float:
+    return calendar.timegm(value.utctimetuple())
+
+
+def issue_tokens(db: Session, user: User, session: Optional[UserSession] = None,
+                 refresh_jti: Optional[str] = None) -> dict:
+    """Create (or rotate) a session and return a fresh token pair for it
+
+    ``refresh_jti`` is the id the session's refresh token was already
+    rotated to, see ``rotate_refresh_token``.
+    """
+    now = datetime.utcnow()
+    access_expires_at = now + timedelta(minutes=settings.access_token_expire_minutes)
+    refresh_jti = refresh_jti or new_token_id()
+    access_jti = new_token_id()
+
+    if session is None:
+        session = UserSession(user_id=user.id)
+        db.add(session)
+    elif session.access_jti:
+        # The access token issued with the previous refresh token dies with it
+        _revoke_access_token(db, session.access_jti, session.access_expires_at)
+
+    session.refresh_jti = refresh_jti
+    session.access_jti = access_jti
+    session.access_expires_at = access_expires_at
+    session.expires_at = now + timedelta(days=settings.refresh_token_expire_days)
+    session.refreshed_at = now
+    db.flush()
+
+    claims = {"user_id": user.id, "phone_number": user.phone_number, "sid": session.id}
+    access_token = create_access_token(
+        data={**claims, "jti": access_jti},
+        expires_delta=access_expires_at - now,
+    )
+    refresh_token = create_refresh_token(data={**claims, "jti": refresh_jti})
+    db.commit()
+
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer"
+    }
+
+
+def rotate_refresh_token(db: Session, payload: dict) -> dict:
+    """Exchange a verified refresh token payload for a new token pair"""
+    invalid = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token"
+    )
+    jti = payload.get("jti")
+    if jti is None:
+        raise invalid
+
+    session = db.query(UserSession).filter(UserSession.refresh_jti == jti).first()
+    if session is None:
+        # A signed refresh token whose id was already rotated away is being
+        # replayed: assume it leaked and end the session it belonged to.
+        sid = payload.get("sid")
+        stolen = db.query(UserSession).filter(UserSession.id == sid).first() if sid else None
+        if stolen is not None and stolen.revoked_at is None and not _just_rotated(stolen):
+            logger.warning("Refresh token reuse detected: session_id=%s user_id=%s", stolen.id, stolen.user_id)
+            revoke_session(db, stolen)
+        raise invalid
+
+    now = datetime.utcnow()
+    if session.revoked_at is not None or session.expires_at <= now:
+        raise invalid
+
+    user = db.query(User).filter(User.id == session.user_id).first()
+    if not user or not user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found or inactive"
+        )
+
+    # Claim the token: a concurrent refresh with it that got here first has
+    # already rotated it, and only one of them may get a new pair
+    refresh_jti = new_token_id()
+    claimed = db.query(UserSession).filter(
+        UserSession.id == session.id,
+        UserSession.refresh_jti == jti,
+        UserSession.revoked_at.is_(None)
+    ).update({UserSession.refresh_jti: refresh_jti, UserSession.refreshed_at: now}, synchronize_session=False)
+    if not claimed:
+        db.rollback()
+        raise invalid
+    return issue_tokens(db, user, session, refresh_jti)
+
+
+def _just_rotated(session: UserSession) -> bool:
+    return session.refreshed_at is not None and (
+        datetime.utcnow() - session.refreshed_at < timedelta(seconds=settings.refresh_token_reuse_grace)
+    )
+
+
+def revoke_session(db: Session, session: UserSession) -> None:
+    """End a session: its refresh token stops working and its access token is revoked"""
+    session.revoked_at = datetime.utcnow()
+    if session.access_jti:
+        _revoke_access_token(db, session.access_jti, session.access_expires_at)
+    db.commit()
+
+
+def logout(db: Session, payload: dict) -> None:
+    """Revoke the access token in ``payload`` and the session it belongs to"""
+    jti = payload.get("jti")
+    exp = payload.get("exp")
+    session = None
+    sid = payload.get("sid")
+    if sid is not None:
+        session = db.query(UserSession).filter(UserSession.id == sid).first()
+
+    if session is not None and session.revoked_at is None:
+        revoke_session(db, session)
+    if jti and exp and (session is None or session.access_jti != jti):
+        _revoke_access_token(db, jti, datetime.utcfromtimestamp(exp))
+        db.commit()
+
+
+def _revoke_access_token(db: Session, jti: str, expires_at: Optional[datetime]) -> None:
+    if expires_at is None or expires_at <= datetime.utcnow():
+        return
+    revocation_list.revoke(jti, _epoch(expires_at))
+    if db.get(RevokedToken, jti) is None:
+        db.add(RevokedToken(jti=jti, expires_at=expires_at, revoked_at=datetime.utcnow()))
+
+
+class RevocationSync:
+    """Mirror the shared ``revoked_tokens`` table into this worker's memory.
+
+    Polls for revocations newer than the last one seen every ``interval``
+    seconds, so a token revoked on another worker is rejected here within
+    one interval. Expired rows are purged from the table and the set, and
+    every ``purge_interval`` seconds sessions that can no longer be
+    refreshed are deleted.
+    """
+
+    # Revocations committed slightly out of order must not be skipped
+    _OVERLAP = timedelta(seconds=5)
+
+    def __init__(self, interval: float, purge_interval: float):
+        self.interval = interval
+        self.purge_interval = purge_interval
+        self._since: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def sync(self) -> int:
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            query = db.query(RevokedToken.jti, RevokedToken.expires_at, RevokedToken.revoked_at).filter(
+                RevokedToken.expires_at > now
+            )
+            if self._since is not None:
+                query = query.filter(RevokedToken.revoked_at > self._since - self._OVERLAP)
+
+            loaded = 0
+            for jti, expires_at, revoked_at in query:
+                revocation_list.revoke(jti, _epoch(expires_at))
+                if self._since is None or revoked_at > self._since:
+                    self._since = revoked_at
+                loaded += 1
+
+            db.query(RevokedToken).filter(RevokedToken.expires_at <= now).delete(synchronize_session=False)
+            db.commit()
+            revocation_list.purge_expired()
+            return loaded
+        finally:
+            db.close()
+
+    def purge_sessions(self) -> int:
+        """Delete expired and revoked sessions; returns how many were deleted"""
+        db = SessionLocal()
+        try:
+            deleted = db.query(UserSession).filter(or_(
+                UserSession.expires_at <= datetime.utcnow(),
+                UserSession.revoked_at.isnot(None)
+            )).delete(synchronize_session=False)
+            db.commit()
+            return deleted
+        finally:
+            db.close()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        next_purge = time.monotonic()
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as exc:
+                logger.error("Token revocation sync failed: %s", exc)
+            if time.monotonic() >= next_purge:
+                next_purge = time.monotonic() + self.purge_interval
+                try:
+                    deleted = await asyncio.to_thread(self.purge_sessions)
+                    if deleted:
+                        logger.info("Deleted %s expired or revoked sessions", deleted)
+                except Exception as exc:
+                    logger.error("Session purge failed: %s", exc)
+            await asyncio.sleep(self.interval)
+
+
+revocation_sync = RevocationSync(
+    interval=settings.token_revocation_sync_interval,
+    purge_interval=settings.session_purge_interval,
+)
@@ -0,0 +1,553 @@
+"""
+Streaming storage for uploaded files
+
+Uploads are parsed straight from the request stream instead of being
+buffered by the form parser: file data is appended chunk by chunk to a
+temporary file inside the upload directory while its size is checked, its
+SHA-256 is computed and its first bytes are sniffed for the real format.
+Only a complete, valid upload is atomically renamed into place, so readers
+never see partial files and at most a few chunks of each upload are held
+in memory.
+"""
+
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+import aiofiles
+from fastapi import HTTPException, Request, status
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from app.core.config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: chunks are then serialised within one process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SNIFF_BYTES = 64
+HASH_BLOCK_SIZE = 1024 * 1024
+MAX_FORM_FIELDS = 16
+MAX_FIELD_SIZE = 1024
+
+# (offset, signature, MIME type); checked in order
+MAGIC_NUMBERS = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"AVI ", "video/avi"),
+    (8, b"WAVE", "audio/wav"),
+    (0, b"\x1a\x45\xdf\xa3", "video/webm"),
+    (0, b"ID3", "audio/mp3"),
+    (0, b"\xff\xfb", "audio/mp3"),
+    (0, b"\xff\xf3", "audio/mp3"),
+    (0, b"\xff\xf2", "audio/mp3"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"Rar!\x1a\x07", "application/x-rar-compressed"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/msword"),
+]
+
+
+# MP4-family files start with an "ftyp" box whose major brand tells audio
+# from video; generic brands such as "isom" and "mp42" are used for both
+FTYP_BRANDS = {
+    b"M4A ": "audio/m4a",
+    b"M4B ": "audio/m4a",
+    b"M4P ": "audio/m4a",
+    b"F4A ": "audio/m4a",
+    b"F4B ": "audio/m4a",
+    b"qt  ": "video/mov",
+    b"M4V ": "video/mp4",
+    b"M4VH": "video/mp4",
+    b"M4VP": "video/mp4",
+    b"f4v ": "video/mp4",
+}
+# Any other brand: an MP4 container that may hold audio or video
+FTYP_GENERIC = "application/mp4"
+
+
+def sniff_mime_type(head: bytes) -> Optional[str]:
+    """Guess the MIME type from the first bytes of a file; None if unknown"""
+    if head[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(head[8:12], FTYP_GENERIC)
+    for offset, signature, mime_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(signature)] == signature:
+            return mime_type
+    return None
+
+
+def temp_dir() -> str:
+    # Inside the upload directory, so the final rename never crosses filesystems
+    path = os.path.join(settings.upload_dir, ".tmp")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class IncomingFile:
+    """A file being received into a temporary file
+
+    ``write`` rejects the upload as soon as it grows past ``max_size``; the
+    closed ``temp_path`` is handed to the blob store, which moves it into place.
+    """
+
+    def __init__(self, filename: str, content_type: Optional[str], max_size: int, too_large_detail: str):
+        self.filename = filename
+        self.content_type = content_type
+        self.max_size = max_size
+        self.too_large_detail = too_large_detail
+        self.size = 0
+        self.head = b""
+        self.temp_path = os.path.join(temp_dir(), f"{uuid.uuid4().hex}.part")
+        self._hash = hashlib.sha256()
+        self._file = None
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def sniffed_type(self) -> Optional[str]:
+        return sniff_mime_type(self.head)
+
+    async def open(self) -> None:
+        self._file = await aiofiles.open(self.temp_path, "wb")
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=self.too_large_detail
+            )
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+        self._hash.update(data)
+        await self._file.write(data)
+
+    async def close(self) -> None:
+        if self._file is not None:
+            await self._file.close()
+            self._file = None
+
+    async def discard(self) -> None:
+        await self.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+# Called when the file part starts with the form fields received before it,
+# the client filename and the declared content type; validates them and
+# returns (max_size, detail reported when the file exceeds it).
+FileOpener = Callable[[Dict[str, str], str, Optional[str]], Tuple[int, str]]
+
+
+class _StreamingFormParser:
+    """Feed a multipart body to python-multipart and route parts as they arrive"""
+
+    def __init__(self, boundary: bytes, open_file: FileOpener):
+        self.open_file = open_file
+        self._fields: Dict[str, bytes] = {}
+        self.file: Optional[IncomingFile] = None
+        # Parser callbacks are synchronous; they queue (kind, payload) events
+        # that feed() then handles with awaits
+        self._events: List[Tuple[str, object]] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._current_field: Optional[str] = None
+        self._file_part = False
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    @property
+    def fields(self) -> Dict[str, str]:
+        return {name: value.decode("utf-8", "replace") for name, value in self._fields.items()}
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        self._events.append(("part", self._headers))
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        self._events.append(("data", data[start:end]))
+
+    async def feed(self, chunk: bytes) -> None:
+        try:
+            self._parser.write(chunk)
+        except MultipartParseError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Malformed multipart body"
+            )
+        events, self._events = self._events, []
+        for kind, data in events:
+            if kind == "part":
+                await self._begin_part(data)
+            elif self._current_field is not None:
+                value = self._fields[self._current_field] + data
+                if len(value) > MAX_FIELD_SIZE:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Form field too large"
+                    )
+                self._fields[self._current_field] = value
+            elif self._file_part:
+                await self.file.write(data)
+
+    async def _begin_part(self, headers: Dict[bytes, bytes]) -> None:
+        _, options = parse_options_header(headers.get(b"content-disposition"))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._current_field = None
+        self._file_part = False
+
+        if b"filename" not in options:
+            if len(self._fields) >= MAX_FORM_FIELDS:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Too many form fields"
+                )
+            self._current_field = name
+            self._fields[name] = b""
+            return
+
+        if name != "file" or self.file is not None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Exactly one file is expected in the 'file' field"
+            )
+        filename = options[b"filename"].decode("utf-8", "replace")
+        content_type = headers.get(b"content-type")
+        content_type = content_type.decode("latin-1") if content_type else None
+        max_size, too_large_detail = self.open_file(self.fields, filename, content_type)
+        self.file = IncomingFile(filename, content_type, max_size, too_large_detail)
+        await self.file.open()
+        self._file_part = True
+
+
+async def receive_upload(
+    request: Request,
+    open_file: FileOpener,
+    max_body_size: int
+) -> Tuple[Dict[str, str], IncomingFile]:
+    """Stream a multipart upload into a temporary file
+
+    Returns the text form fields and the received, closed file, which the
+    caller must store or ``discard``. Raises ``HTTPException`` as soon as the
+    body or the file exceeds its limit; the temporary file is removed then.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Expected a multipart/form-data body"
+        )
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_body_size:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="Upload too large"
+        )
+
+    form = _StreamingFormParser(params[b"boundary"], open_file)
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_body_size:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail="Upload too large"
+                )
+            await form.feed(chunk)
+        if form.file is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No file in upload"
+            )
+        await form.file.close()
+    except BaseException:
+        if form.file is not None:
+            await form.file.discard()
+        raise
+    return form.fields, form.file
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_head(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(SNIFF_BYTES)
+
+
+class UploadSession:
+    """Metadata of a resumable upload; the received bytes live in ``data_path``"""
+
+    def __init__(self, id: str, user_id: int, file_type: str, filename: str, content_type: str,
+                 size: int, created_at: float, expires_at: float):
+        self.id = id
+        self.user_id = user_id
+        self.file_type = file_type
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.created_at = created_at
+        self.expires_at = expires_at
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(temp_dir(), f"{self.id}.part")
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(temp_dir(), f"{self.id}.json")
+
+    @property
+    def offset(self) -> int:
+        """Bytes committed so far: the size of the data file is the source of truth"""
+        try:
+            return os.path.getsize(self.data_path)
+        except FileNotFoundError:
+            return 0
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "file_type": self.file_type,
+            "filename": self.filename,
+            "content_type": self.content_type,
+            "size": self.size,
+            "created_at": self.created_at,
+            "expires_at": self.expires_at,
+        }
+
+
+class UploadSessionStore:
+    """Resumable uploads kept on disk next to the streaming temp files
+
+    Each session is a ``<id>.json`` metadata file and a ``<id>.part`` data
+    file in ``uploads/.tmp``. Chunks are appended at the committed offset,
+    so an interrupted upload continues where it stopped; finalizing hands
+    the data file to the blob store, which renames it into place without
+    copying it. Sessions expire
+    ``ttl`` seconds after their last chunk and are removed by a background
+    task, together with temp files abandoned by interrupted streaming uploads.
+    """
+
+    _ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+    def __init__(self, ttl: int, purge_interval: float):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        # Running SHA-256 per session while its chunks arrive in this process
+        self._hashers: Dict[str, Tuple[int, "hashlib._Hash"]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _save(self, session: UploadSession) -> None:
+        temp_path = f"{session.meta_path}.new"
+        with open(temp_path, "w") as f:
+            json.dump(session.to_dict(), f)
+        os.replace(temp_path, session.meta_path)
+
+    def create(self, user_id: int, file_type: str, filename: str, content_type: str, size: int) -> UploadSession:
+        now = time.time()
+        session = UploadSession(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            file_type=file_type,
+            filename=filename,
+            content_type=content_type,
+            size=size,
+            created_at=now,
+            expires_at=now + self.ttl,
+        )
+        open(session.data_path, "wb").close()
+        self._save(session)
+        self._hashers[session.id] = (0, hashlib.sha256())
+        return session
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        if not self._ID_PATTERN.fullmatch(upload_id):
+            return None
+        try:
+            with open(os.path.join(temp_dir(), f"{upload_id}.json")) as f:
+                session = UploadSession(**json.load(f))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+        if session.expires_at <= time.time():
+            return None
+        return session
+
+    @staticmethod
+    def _lock_data_file(fd: int) -> None:
+        """Lock a session's open data file against other worker processes
+
+        The lock is released when the file is closed. A chunk that is still
+        being written by another worker gets a 409 instead of waiting.
+        """
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Another chunk of this upload is being written"
+            )
+
+    async def append(self, session: UploadSession, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """Append a chunk stream at ``offset``; return the new committed offset"""
+        async with self._locks.setdefault(session.id, asyncio.Lock()):
+            async with aiofiles.open(session.data_path, "ab") as f:
+                self._lock_data_file(f.fileno())
+                # Read under the lock: another worker may have appended since the request came in
+                current = os.fstat(f.fileno()).st_size
+                if offset != current:
+                    raise HTTPException(
+                        status_code=status.HTTP_409_CONFLICT,
+                        detail=f"Upload offset mismatch, current offset is {current}"
+                    )
+                hashed_to, sha256 = self._hashers.get(session.id, (None, None))
+                if hashed_to != current:
+                    # Earlier chunks went to another process; hash on finalize instead
+                    sha256 = None
+                    self._hashers.pop(session.id, None)
+
+                try:
+                    async for chunk in chunks:
+                        if current + len(chunk) > session.size:
+                            raise HTTPException(
+                                status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Chunk exceeds the declared upload size"
+                            )
+                        await f.write(chunk)
+                        if sha256 is not None:
+                            sha256.update(chunk)
+                        current += len(chunk)
+                finally:
+                    if sha256 is not None:
+                        self._hashers[session.id] = (current, sha256)
+                    session.expires_at = time.time() + self.ttl
+                    self._save(session)
+            return current
+
+    async def finalize(self, session: UploadSession, commit: Callable[[str, str], Awaitable[T]]) -> T:
+        """End a complete upload by handing its data file and SHA-256 to ``commit``"""
+        async with self._locks.setdefault(session.id, asyncio.Lock()):
+            # Opened like in append, so a missing data file counts as empty
+            with open(session.data_path, "ab") as f:
+                # Held until the data file has been handed over, so no worker appends meanwhile
+                self._lock_data_file(f.fileno())
+                if os.fstat(f.fileno()).st_size != session.size:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Upload is incomplete"
+                    )
+                hashed_to, sha256 = self._hashers.pop(session.id, (None, None))
+                if hashed_to == session.size:
+                    digest = sha256.hexdigest()
+                else:
+                    digest = await asyncio.to_thread(hash_file, session.data_path)
+                result = await commit(session.data_path, digest)
+            os.remove(session.meta_path)
+        self._locks.pop(session.id, None)
+        return result
+
+    def discard(self, upload_id: str) -> None:
+        self._hashers.pop(upload_id, None)
+        self._locks.pop(upload_id, None)
+        for extension in (".part", ".json"):
+            try:
+                os.remove(os.path.join(temp_dir(), f"{upload_id}{extension}"))
+            except FileNotFoundError:
+                pass
+
+    def purge_expired(self) -> int:
+        """Remove expired sessions and temp files idle for longer than the TTL"""
+        now = time.time()
+        removed = 0
+        with os.scandir(temp_dir()) as entries:
+            for entry in entries:
+                name, extension = os.path.splitext(entry.name)
+                if extension == ".json":
+                    session = self.get(name)
+                    if session is None:
+                        self.discard(name)
+                        removed += 1
+                elif extension == ".part" and not os.path.exists(os.path.join(temp_dir(), f"{name}.json")):
+                    try:
+                        if entry.stat().st_mtime < now - self.ttl:
+                            os.remove(entry.path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.purge_expired)
+                if removed:
+                    logger.info("Removed %s expired upload sessions and temp files", removed)
+            except Exception as exc:
+                logger.error("Upload session cleanup failed: %s", exc)
+            await asyncio.sleep(self.purge_interval)
+
+
+upload_sessions = UploadSessionStore(
+    ttl=settings.upload_session_ttl,
+    purge_interval=settings.upload_session_purge_interval,
+)
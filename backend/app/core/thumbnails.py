@@ -0,0 +1,212 @@
+"""
+Image thumbnails rendered off the event loop
+
+Decoding and resizing images is CPU-bound, so thumbnails are rendered by a
+small process pool fed from an asyncio job queue: uploads only enqueue the
+source image and return, and thumbnails appear on disk when ready. Each
+job decodes the source once - JPEGs in draft mode, which lets libjpeg
+downscale while decoding - and writes every size in ``THUMBNAIL_SIZES`` as
+WebP, each one resized from the previous, larger one.
+
+A thumbnail of ``<type>/<name>`` is stored as
+``<type>/thumbnails/<name>.<size>.webp``.
+
+Images also get a preview of a few pixels - a WebP data URI under a
+kilobyte - that is rendered by the same pool while the upload request
+waits, so it can be stored with the file and inlined in message payloads.
+"""
+
+from typing import Callable, Dict, List, Optional, Sequence, Set, TypeVar
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import base64
+import io
+import logging
+import os
+import re
+from PIL import Image, ImageOps
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = tuple(sorted(settings.thumbnail_sizes))
+T = TypeVar("T")
+_THUMBNAIL_NAME = re.compile(r"(.+)\.\d+\.webp")
+
+
+def thumbnail_name(name: str, size: int) -> str:
+    return f"{name}.{size}.webp"
+
+
+def thumbnail_source_name(thumbnail: str) -> str:
+    """Name of the source file of a thumbnail; older thumbnails share it"""
+    match = _THUMBNAIL_NAME.fullmatch(thumbnail)
+    return match.group(1) if match else thumbnail
+
+
+def thumbnail_url(path: str, size: int) -> str:
+    """URL of a thumbnail of the file at ``path``, relative to the upload directory"""
+    directory, name = os.path.split(path)
+    return f"/files/{directory}/thumbnails/{thumbnail_name(name, size)}"
+
+
+def thumbnail_paths(path: str) -> List[str]:
+    """Local paths of every thumbnail of ``path``, including the older single-size one"""
+    directory, name = os.path.split(path)
+    thumbnails_dir = os.path.join(settings.upload_dir, directory, "thumbnails")
+    return [os.path.join(thumbnails_dir, thumbnail_name(name, size)) for size in THUMBNAIL_SIZES] + \
+        [os.path.join(thumbnails_dir, name)]
+
+
+def render_thumbnails(source_path: str, sizes: Sequence[int], quality: int) -> List[str]:
+    """Write WebP thumbnails of an image in ``sizes``; runs in a worker process"""
+    directory, name = os.path.split(source_path)
+    thumbnails_dir = os.path.join(directory, "thumbnails")
+    os.makedirs(thumbnails_dir, exist_ok=True)
+    written = []
+    with Image.open(source_path) as img:
+        largest = max(sizes)
+        # JPEG only: decode at the smallest scale that still covers the largest size
+        img.draft("RGB", (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        for size in sorted(sizes, reverse=True):
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+            thumbnail_path = os.path.join(thumbnails_dir, thumbnail_name(name, size))
+            temp_path = f"{thumbnail_path}.tmp"
+            img.save(temp_path, "WEBP", quality=quality, method=4)
+            os.replace(temp_path, thumbnail_path)
+            written.append(thumbnail_path)
+    return written
+
+
+def render_preview(source_path: str, size: int, max_bytes: int) -> Optional[str]:
+    """WebP data URI of an image scaled to ``size``, or None if it cannot fit in ``max_bytes``"""
+    with Image.open(source_path) as img:
+        img.draft("RGB", (size, size))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        img.thumbnail((size, size), Image.Resampling.BILINEAR)
+        for quality in (50, 30, 10):
+            buffer = io.BytesIO()
+            img.save(buffer, "WEBP", quality=quality, method=6)
+            data = f"data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+            if len(data) <= max_bytes:
+                return data
+    return None
+
+
+class ThumbnailQueue:
+    """Job queue that renders thumbnails in a process pool
+
+    ``submit`` is cheap and idempotent: a source already queued or being
+    rendered is not queued again. ``workers`` jobs run at a time, one per
+    pool process; the rest wait in the queue.
+    """
+
+    def __init__(self, sizes: Sequence[int], quality: int, workers: int, preview_size: int, preview_max_bytes: int):
+        self.sizes = tuple(sizes)
+        self.quality = quality
+        self.workers = workers
+        self.preview_size = preview_size
+        self.preview_max_bytes = preview_max_bytes
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Set[str] = set()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def is_ready(self, path: str) -> bool:
+        """Whether every thumbnail of ``path`` (relative to the upload directory) exists"""
+        return all(os.path.exists(thumbnail) for thumbnail in thumbnail_paths(path)[:len(self.sizes)])
+
+    def urls(self, path: str) -> Dict[str, str]:
+        return {str(size): thumbnail_url(path, size) for size in self.sizes}
+
+    def submit(self, path: str) -> None:
+        """Queue rendering of the thumbnails of ``path``, relative to the upload directory"""
+        if path in self._pending:
+            return
+        if self._queue is None:
+            logger.warning("Thumbnail queue is not running, skipping %s", path)
+            return
+        self._pending.add(path)
+        self._queue.put_nowait(path)
+
+    async def run_in_pool(self, func: Callable[..., T], *args) -> T:
+        """Run ``func(*args)`` in a worker process; inline previews share the pool with thumbnails"""
+        if self._executor is None:
+            raise RuntimeError("Thumbnail queue is not running")
+        executor = self._executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for memory; the pool cannot be reused
+            if self._executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            raise
+
+    async def render_preview(self, path: str) -> Optional[str]:
+        """Render the inline preview of ``path`` in the pool; None if that fails"""
+        try:
+            return await self.run_in_pool(
+                render_preview,
+                os.path.join(settings.upload_dir, path), self.preview_size, self.preview_max_bytes
+            )
+        except Exception as exc:
+            logger.error("Error generating the preview of %s: %s", path, exc)
+            return None
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        # The first job forks every worker; do it now, while the application
+        # has not started its own threads yet
+        executor.submit(os.getpid)
+        return executor
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._executor = self._create_executor()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._queue = None
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self) -> None:
+        while True:
+            path = await self._queue.get()
+            try:
+                await self.run_in_pool(
+                    render_thumbnails,
+                    os.path.join(settings.upload_dir, path), self.sizes, self.quality
+                )
+            except Exception as exc:
+                logger.error("Error generating thumbnails for %s: %s", path, exc)
+            finally:
+                self._pending.discard(path)
+
+
+thumbnail_queue = ThumbnailQueue(
+    sizes=THUMBNAIL_SIZES,
+    quality=settings.thumbnail_quality,
+    workers=settings.thumbnail_workers,
+    preview_size=settings.image_preview_size,
+    preview_max_bytes=settings.image_preview_max_bytes,
+)
@@ -0,0 +1,281 @@
+"""
+Re-encoded variants of uploaded images
+
+Images are stored as uploaded, but a background job re-encodes every image
+blob into variants no larger than ``image_variant_max_size`` with EXIF and
+other metadata stripped: a WebP for clients whose ``Accept`` header lists
+it and a JPEG - PNG for images with transparency - for the rest. The blob
+URL serves the variant that suits the client once it exists, and the
+original with ``?original=1``.
+
+Jobs are rows of ``transcode_jobs``, so they survive restarts and are
+shared by every worker process. The poller creates a job for each image
+blob that has none, claims due jobs with conditional updates, runs them in
+a process pool of its own and retries failures with exponential backoff.
+Only as many jobs as that pool has processes are claimed at a time, and
+thumbnails and previews of new uploads have the thumbnail pool to
+themselves, so a backfill of many images never delays them.
+
+Variants of ``<dir>/<name>`` are stored as ``<dir>/variants/<name>.webp``
+and ``<dir>/variants/<name>.jpg`` or ``.png``.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import asyncio
+import logging
+import os
+from PIL import Image, ImageOps
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.file import FileBlob, TranscodeJob
+
+logger = logging.getLogger(__name__)
+
+# Extension -> media type, in order of preference for clients that accept WebP
+VARIANT_TYPES = {".webp": "image/webp", ".jpg": "image/jpeg", ".png": "image/png"}
+# A job still running after this long belongs to a worker that died
+RUNNING_TIMEOUT = timedelta(minutes=10)
+
+
+def variant_paths(path: str) -> List[str]:
+    """Local paths of every possible variant of ``path``, relative to the upload directory"""
+    directory, name = os.path.split(path)
+    variants_dir = os.path.join(settings.upload_dir, directory, "variants")
+    return [os.path.join(variants_dir, f"{name}{extension}") for extension in VARIANT_TYPES]
+
+
+def is_original_image(path: str) -> bool:
+    """Whether ``path`` is an uploaded image rather than a thumbnail or variant of one"""
+    parts = path.split("/")
+    return parts[0] == "image" and len(parts) > 1 and parts[-2] not in ("thumbnails", "variants")
+
+
+def choose_variant(path: str, accept: str) -> Optional[Tuple[str, str]]:
+    """Local path and media type of the variant of an image to send for ``accept``
+
+    None while the image has no suitable variant yet.
+    """
+    accepts_webp = "image/webp" in accept
+    for variant, media_type in zip(variant_paths(path), VARIANT_TYPES.values()):
+        if (media_type != "image/webp" or accepts_webp) and os.path.exists(variant):
+            return variant, media_type
+    return None
+
+
+def transcode_image(source_path: str, max_size: int, quality: int) -> List[str]:
+    """Write the variants of an image; runs in a worker process"""
+    directory, name = os.path.split(source_path)
+    variants_dir = os.path.join(directory, "variants")
+    os.makedirs(variants_dir, exist_ok=True)
+    written = []
+    with Image.open(source_path) as img:
+        if getattr(img, "is_animated", False):
+            # Re-encoding would keep only the first frame
+            return written
+        img.draft("RGB", (max_size, max_size))
+        icc_profile = img.info.get("icc_profile")
+        # Apply the EXIF orientation before the EXIF block is dropped
+        img = ImageOps.exif_transpose(img)
+        has_alpha = "A" in img.getbands() or "transparency" in img.info
+        img = img.convert("RGBA" if has_alpha else "RGB")
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        outputs = [(".webp", "WEBP", {"quality": quality, "method": 4})]
+        if has_alpha:
+            outputs.append((".png", "PNG", {"optimize": True}))
+        else:
+            outputs.append((".jpg", "JPEG", {"quality": quality, "optimize": True, "progressive": True}))
+        for extension, image_format, options in outputs:
+            variant_path = os.path.join(variants_dir, f"{name}{extension}")
+            temp_path = f"{variant_path}.tmp"
+            # Only the colour profile is kept: no exif= or xmp= is passed
+            img.save(temp_path, image_format, icc_profile=icc_profile, **options)
+            os.replace(temp_path, variant_path)
+            written.append(variant_path)
+    return written
+
+
+class MediaTranscoder:
+    """Persistent job queue that re-encodes image blobs in its own process pool
+
+    ``workers`` jobs run at a time, one per pool process.
+    """
+
+    def __init__(self, max_size: int, quality: int, workers: int, poll_interval: float, batch_size: int,
+                 max_attempts: int, retry_delay: float):
+        self.max_size = max_size
+        self.quality = quality
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        """Look for due jobs now instead of at the next poll, e.g. after an upload"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _create_missing_jobs(self, db, now: datetime) -> None:
+        missing = [sha256 for (sha256,) in db.query(FileBlob.sha256).outerjoin(
+            TranscodeJob, TranscodeJob.blob_sha256 == FileBlob.sha256
+        ).filter(
+            FileBlob.file_type == "image",
+            FileBlob.ref_count > 0,
+            TranscodeJob.blob_sha256.is_(None)
+        ).limit(self.batch_size)]
+        if not missing:
+            return
+        db.add_all(
+            TranscodeJob(blob_sha256=sha256, status="pending", attempts=0, next_attempt_at=now, updated_at=now)
+            for sha256 in missing
+        )
+        try:
+            db.commit()
+        except IntegrityError:
+            # Created by another worker process
+            db.rollback()
+
+    def claim(self) -> List[Tuple[str, str]]:
+        """Mark up to ``workers`` due jobs as running; returns their blob hashes and paths"""
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            self._create_missing_jobs(db, now)
+            jobs = db.query(TranscodeJob.blob_sha256, TranscodeJob.status, TranscodeJob.attempts, FileBlob.path).join(
+                FileBlob, FileBlob.sha256 == TranscodeJob.blob_sha256
+            ).filter(or_(
+                and_(TranscodeJob.status == "pending", TranscodeJob.next_attempt_at <= now),
+                and_(TranscodeJob.status == "running", TranscodeJob.updated_at < now - RUNNING_TIMEOUT)
+            )).limit(self.workers).all()
+
+            claimed = []
+            for sha256, job_status, attempts, path in jobs:
+                query = db.query(TranscodeJob).filter(
+                    TranscodeJob.blob_sha256 == sha256,
+                    TranscodeJob.status == job_status,
+                    TranscodeJob.attempts == attempts
+                )
+                if attempts >= self.max_attempts:
+                    # Its worker died on the last attempt
+                    query.update({TranscodeJob.status: "failed", TranscodeJob.updated_at: now},
+                                 synchronize_session=False)
+                    continue
+                # Another worker process may be claiming the same job
+                if query.update(
+                    {TranscodeJob.status: "running", TranscodeJob.attempts: attempts + 1,
+                     TranscodeJob.updated_at: now},
+                    synchronize_session=False
+                ):
+                    claimed.append((sha256, path))
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def finish(self, sha256: str, error: Optional[str] = None) -> None:
+        """Record the outcome of a job; failures are retried until ``max_attempts``"""
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            job = db.get(TranscodeJob, sha256)
+            if job is None:
+                # The blob was collected meanwhile
+                return
+            job.updated_at = now
+            if error is None:
+                job.status = "done"
+                job.last_error = None
+            else:
+                job.last_error = error[:500]
+                if job.attempts >= self.max_attempts:
+                    job.status = "failed"
+                else:
+                    job.status = "pending"
+                    job.next_attempt_at = now + timedelta(seconds=self.retry_delay * 2 ** (job.attempts - 1))
+            db.commit()
+        finally:
+            db.close()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        # The first job forks every worker; do it now, while the application
+        # has not started its own threads yet
+        executor.submit(os.getpid)
+        return executor
+
+    async def _run_in_pool(self, func, *args):
+        executor = self._executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for memory; the pool cannot be reused
+            if self._executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            raise
+
+    async def _process(self, sha256: str, path: str) -> None:
+        error = None
+        try:
+            await self._run_in_pool(
+                transcode_image, os.path.join(settings.upload_dir, path), self.max_size, self.quality
+            )
+        except Exception as exc:
+            error = str(exc) or exc.__class__.__name__
+            logger.warning("Transcoding %s failed: %s", path, error)
+        await asyncio.to_thread(self.finish, sha256, error)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            if self._executor is None:
+                self._executor = self._create_executor()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self) -> None:
+        while True:
+            jobs = []
+            try:
+                jobs = await asyncio.to_thread(self.claim)
+                await asyncio.gather(*(self._process(sha256, path) for sha256, path in jobs))
+            except Exception as exc:
+                logger.error("Media transcoding failed: %s", exc)
+            if jobs:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+media_transcoder = MediaTranscoder(
+    max_size=settings.image_variant_max_size,
+    quality=settings.image_variant_quality,
+    workers=settings.transcode_workers,
+    poll_interval=settings.transcode_poll_interval,
+    batch_size=settings.transcode_batch_size,
+    max_attempts=settings.transcode_max_attempts,
+    retry_delay=settings.transcode_retry_delay,
+)
@@ -0,0 +1,200 @@
+"""
+Indexed user search
+
+A query matches the users who have every word of it as the prefix of a word
+of their username, first or last name or phone number, so "ив пет" finds
+Иван Петров. A query that looks like a phone number is normalised the way
+numbers are stored and matched as one prefix of the stored digits, so
+"+7 999 123", "8 (999) 123" and "7999123" all find +79991234567. Matching is answered by
+an index instead of scanning ``users`` with ``LIKE '%q%'``:
+
+- SQLite: an FTS5 table over those columns with prefix indexes, kept in
+  sync by triggers that fire only when one of them changes - not on the
+  frequent ``is_online`` / ``last_seen`` updates;
+- PostgreSQL: a GIN index over their ``simple`` text search vector,
+  queried with prefix ``tsquery`` terms.
+
+At most ``candidates`` matches are read from the index and ranked in
+Python - exact username first, then usernames starting with the query, then
+names - so the cost of a query does not grow with the number of users a
+short prefix matches. The exact username is looked up through its unique
+index, so it is never cut off by that limit.
+"""
+
+from typing import List, Optional
+import logging
+import re
+from sqlalchemy import or_, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.core.encryption import data_sanitizer
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+# Words as both the FTS5 unicode61 tokenizer and the PostgreSQL parser see them
+_WORD = re.compile(r"[^\W_]+")
+_PHONE_QUERY = re.compile(r"\+?[\d\s().-]*\d[\d\s().-]*")
+
+_SQLITE_DDL = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+        username, first_name, last_name, phone_number,
+        content='users', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='1 2 3 4 5 6 7 8'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_search(rowid, username, first_name, last_name, phone_number)
+        VALUES (new.id, new.username, new.first_name, new.last_name, new.phone_number);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_search(users_search, rowid, username, first_name, last_name, phone_number)
+        VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.phone_number);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_search_update
+    AFTER UPDATE OF username, first_name, last_name, phone_number ON users BEGIN
+        INSERT INTO users_search(users_search, rowid, username, first_name, last_name, phone_number)
+        VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.phone_number);
+        INSERT INTO users_search(rowid, username, first_name, last_name, phone_number)
+        VALUES (new.id, new.username, new.first_name, new.last_name, new.phone_number);
+    END
+    """,
+)
+
+_SQLITE_QUERY = text("""
+    SELECT users.id, users.username, users.first_name, users.last_name
+    FROM users_search JOIN users ON users.id = users_search.rowid
+    WHERE users_search MATCH :match AND users.id != :exclude_id AND users.is_active
+    LIMIT :candidates
+""")
+
+# The query must repeat this expression exactly for the index to be used
+_POSTGRES_DOCUMENT = (
+    "to_tsvector('simple', coalesce(username, '') || ' ' || coalesce(first_name, '') || ' ' || "
+    "coalesce(last_name, '') || ' ' || regexp_replace(phone_number, '[^0-9]', ' ', 'g'))"
+)
+
+_POSTGRES_DDL = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_search ON users USING gin ({_POSTGRES_DOCUMENT})"
+
+_POSTGRES_QUERY = text(f"""
+    SELECT id, username, first_name, last_name FROM users
+    WHERE {_POSTGRES_DOCUMENT} @@ to_tsquery('simple', :match) AND id != :exclude_id AND is_active
+    LIMIT :candidates
+""")
+
+
+def _phone_prefix(query: str) -> Optional[str]:
+    """Digits that a stored number starts with if it matches ``query``; None if it is no phone number"""
+    if not _PHONE_QUERY.fullmatch(query):
+        return None
+    digits = re.sub(r"\D", "", query)
+    international = query.startswith("+")
+    if international or len(digits) >= 10:
+        try:
+            return data_sanitizer.sanitize_phone_number(query)[1:]
+        except ValueError:
+            pass
+    # The start of a national number, as sanitize_phone_number reads a complete one
+    if not international and digits.startswith("8"):
+        return f"7{digits[1:]}"
+    return digits
+
+
+def _rank(row, query: str) -> tuple:
+    user_id, username, first_name, last_name = row
+    query = query.lower()
+    username = (username or "").lower()
+    name = f"{first_name or ''} {last_name or ''}".lower()
+    if username == query:
+        tier = 0
+    elif username.startswith(query):
+        tier = 1
+    elif name.startswith(query):
+        tier = 2
+    else:
+        tier = 3
+    return tier, len(username) if tier == 1 else 0, name, user_id
+
+
+class UserSearch:
+    """Prefix search over users backed by the database's own text index
+
+    Falls back to substring ``LIKE`` matching where no index could be
+    created, e.g. SQLite built without FTS5.
+    """
+
+    def __init__(self, candidates: int):
+        self.candidates = candidates
+        self.backend: Optional[str] = None
+
+    def create_index(self, engine: Engine) -> None:
+        """Create the search index if missing; on SQLite, fill it from existing users"""
+        try:
+            if engine.dialect.name == "sqlite":
+                with engine.begin() as conn:
+                    exists = conn.execute(text(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'"
+                    )).first()
+                    for statement in _SQLITE_DDL:
+                        conn.execute(text(statement))
+                    if not exists:
+                        conn.execute(text("INSERT INTO users_search(users_search) VALUES ('rebuild')"))
+                self.backend = "fts5"
+            elif engine.dialect.name == "postgresql":
+                # The query works without the index, only slower
+                self.backend = "tsvector"
+                # Built without locking out profile updates, which needs autocommit
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    conn.execute(text(_POSTGRES_DDL))
+        except Exception as exc:
+            logger.warning("User search index is unavailable: %s", exc)
+            if engine.dialect.name != "postgresql":
+                self.backend = None
+
+    def search(self, db: Session, query: str, limit: int, exclude_id: Optional[int] = None) -> List[User]:
+        """Active users matching ``query``, best matches first"""
+        query = query.strip().removeprefix("@")
+        phone = _phone_prefix(query)
+        words = [phone] if phone else _WORD.findall(query.lower())
+        if not words:
+            return []
+        params = {"exclude_id": exclude_id or 0, "candidates": self.candidates}
+        columns = (User.id, User.username, User.first_name, User.last_name)
+        # "id != NULL" would match nobody
+        filters = [User.is_active == True] + ([User.id != exclude_id] if exclude_id is not None else [])
+        if self.backend == "fts5":
+            params["match"] = " ".join(f'"{word}"*' for word in words)
+            rows = db.execute(_SQLITE_QUERY, params).all()
+        elif self.backend == "tsvector":
+            params["match"] = " & ".join(f"{word}:*" for word in words)
+            rows = db.execute(_POSTGRES_QUERY, params).all()
+        else:
+            rows = db.query(*columns).filter(
+                *filters,
+                or_(
+                    User.phone_number.contains(phone or query),
+                    User.username.contains(query),
+                    User.first_name.contains(query),
+                    User.last_name.contains(query)
+                )
+            ).limit(self.candidates).all()
+
+        exact = db.query(*columns).filter(User.username == query, *filters).first()
+        if exact is not None and all(row[0] != exact[0] for row in rows):
+            rows.append(exact)
+        # Candidates are ranked by these few columns; only the results are loaded
+        ids = [row[0] for row in sorted(rows, key=lambda row: _rank(row, query))[:limit]]
+        if not ids:
+            return []
+        users = {user.id: user for user in db.query(User).filter(User.id.in_(ids))}
+        return [users[user_id] for user_id in ids if user_id in users]
+
+
+user_search = UserSearch(candidates=settings.user_search_candidates)
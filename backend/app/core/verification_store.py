@@ -0,0 +1,359 @@
+"""
+Phone verification code storage
+
+Live verification state (code, attempts, expiry) is kept in a TTL store:
+in process memory, or in Redis when ``USE_REDIS`` is enabled so that all
+workers share it. There is no in-memory fallback for Redis, which would
+hand out codes other workers cannot check and multiply the attempt limit by
+the number of workers: while Redis is down, sending and checking codes
+answer 503. The ``phone_verifications`` table is only an audit log: rows
+are queued and written in batches, and rows past their retention are
+purged in bounded batches.
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import logging
+import math
+import secrets
+import time
+from fastapi import HTTPException, status
+from app.core.config import settings
+from app.core.database import SessionLocal, engine
+from app.models.verification import PhoneVerification
+
+logger = logging.getLogger(__name__)
+
+
+# Outcomes of checking a code
+CODE_ACCEPTED = "accepted"
+CODE_INVALID = "invalid"
+CODE_MISSING = "missing"
+CODE_ALREADY_VERIFIED = "already_verified"
+CODE_ATTEMPTS_EXCEEDED = "attempts_exceeded"
+
+
+class VerificationEntry:
+    __slots__ = ("code", "attempts", "max_attempts", "expires_at", "verified")
+
+    def __init__(self, code: str, attempts: int, max_attempts: int, expires_at: float, verified: bool = False):
+        self.code = code
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.expires_at = expires_at
+        self.verified = verified
+
+
+class MemoryVerificationStore:
+    """Per-process verification store with a heap-based TTL index.
+
+    Expired entries are evicted from the front of the heap on every write,
+    so memory is bounded by the codes issued within one TTL.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, VerificationEntry] = {}
+        self._expiry: List[Tuple[float, str]] = []
+
+    def _evict_expired(self, now: float) -> None:
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, phone_number = heapq.heappop(self._expiry)
+            entry = self._entries.get(phone_number)
+            # A re-issued code has a later expiry and its own heap item
+            if entry is not None and entry.expires_at == expires_at:
+                del self._entries[phone_number]
+
+    async def issue(self, phone_number: str, code: str, ttl: int, max_attempts: int) -> None:
+        now = time.time()
+        self._evict_expired(now)
+        entry = VerificationEntry(code, 0, max_attempts, now + ttl)
+        self._entries[phone_number] = entry
+        heapq.heappush(self._expiry, (entry.expires_at, phone_number))
+
+    async def get(self, phone_number: str) -> Optional[VerificationEntry]:
+        entry = self._entries.get(phone_number)
+        if entry is None or entry.expires_at <= time.time():
+            return None
+        return entry
+
+    async def check_code(self, phone_number: str, code: str) -> Tuple[str, Optional[VerificationEntry]]:
+        """Compare ``code`` and count the attempt; nothing awaits in between, so it is atomic"""
+        entry = await self.get(phone_number)
+        if entry is None:
+            return CODE_MISSING, None
+        if entry.verified:
+            return CODE_ALREADY_VERIFIED, entry
+        if entry.attempts >= entry.max_attempts:
+            return CODE_ATTEMPTS_EXCEEDED, entry
+        if not secrets.compare_digest(entry.code, code):
+            entry.attempts += 1
+            return CODE_INVALID, entry
+        entry.verified = True
+        return CODE_ACCEPTED, entry
+
+
+class RedisVerificationStore:
+    """Verification store shared by all workers; Redis key TTLs do the expiry.
+
+    A code is checked by a Lua script that reads the entry, counts the
+    attempt and marks it verified in one step: concurrent guesses cannot
+    exceed the attempt limit, and nothing is written to a key that has
+    expired, which would recreate it as a partial hash without a TTL.
+
+    Redis calls time out after ``timeout`` seconds and then fail with 503.
+    After a failure Redis is left alone for a backoff that doubles up to
+    ``max_backoff`` seconds while it keeps failing, and only one request at
+    a time probes it, so an outage does not add a timeout to every login.
+    """
+
+    # KEYS[1]: the entry; ARGV[1]: the code. Returns the outcome and the entry fields
+    _CHECK_CODE = """
+    local entry = redis.call('HMGET', KEYS[1], 'code', 'attempts', 'max_attempts', 'expires_at', 'verified')
+    if not entry[1] then
+        return {'missing'}
+    end
+    local outcome
+    if entry[5] == '1' then
+        outcome = 'already_verified'
+    elseif tonumber(entry[2]) >= tonumber(entry[3]) then
+        outcome = 'attempts_exceeded'
+    elseif entry[1] ~= ARGV[1] then
+        outcome = 'invalid'
+        entry[2] = tostring(redis.call('HINCRBY', KEYS[1], 'attempts', 1))
+    else
+        outcome = 'accepted'
+        redis.call('HSET', KEYS[1], 'verified', 1)
+        entry[5] = '1'
+    end
+    return {outcome, entry[1], entry[2], entry[3], entry[4], entry[5]}
+    """
+
+    def __init__(self, redis_url: str, timeout: float, min_backoff: float = 1.0,
+                 max_backoff: float = settings.verification_redis_max_backoff):
+        import redis.asyncio as aioredis
+
+        self._redis = aioredis.from_url(
+            redis_url,
+            decode_responses=True,
+            socket_connect_timeout=timeout,
+            socket_timeout=timeout
+        )
+        self._check_code = self._redis.register_script(self._CHECK_CODE)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+    @staticmethod
+    def _key(phone_number: str) -> str:
+        return f"verification:{phone_number}"
+
+    def _unavailable(self) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Phone verification is temporarily unavailable",
+            headers={"Retry-After": str(max(1, math.ceil(self._retry_at - time.monotonic())))}
+        )
+
+    async def _call(self, operation):
+        """Await ``operation()``; raises 503 if Redis fails or is backing off"""
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise self._unavailable()
+        if self._backoff:
+            # Requests arriving while this one probes Redis fail fast
+            self._retry_at = now + self._backoff
+        try:
+            result = await operation()
+        except Exception as exc:
+            if not self._backoff:
+                logger.warning("Redis verification store unavailable: %s", exc)
+                self._backoff = self.min_backoff
+            else:
+                self._backoff = min(self._backoff * 2, self.max_backoff)
+            self._retry_at = time.monotonic() + self._backoff
+            raise self._unavailable() from exc
+        if self._backoff:
+            logger.info("Redis verification store restored")
+            self._backoff = 0.0
+            self._retry_at = 0.0
+        return result
+
+    async def issue(self, phone_number: str, code: str, ttl: int, max_attempts: int) -> None:
+        key = self._key(phone_number)
+
+        async def issue():
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.hset(key, mapping={
+                    "code": code,
+                    "attempts": 0,
+                    "max_attempts": max_attempts,
+                    "expires_at": time.time() + ttl,
+                    "verified": 0,
+                })
+                pipe.expire(key, ttl)
+                await pipe.execute()
+
+        await self._call(issue)
+
+    async def get(self, phone_number: str) -> Optional[VerificationEntry]:
+        data = await self._call(lambda: self._redis.hgetall(self._key(phone_number)))
+        if "code" not in data:
+            return None
+        return VerificationEntry(
+            code=data["code"],
+            attempts=int(data["attempts"]),
+            max_attempts=int(data["max_attempts"]),
+            expires_at=float(data["expires_at"]),
+            verified=data["verified"] == "1",
+        )
+
+    async def check_code(self, phone_number: str, code: str) -> Tuple[str, Optional[VerificationEntry]]:
+        result = await self._call(lambda: self._check_code(keys=[self._key(phone_number)], args=[code]))
+        if result[0] == CODE_MISSING:
+            return CODE_MISSING, None
+        outcome, stored_code, attempts, max_attempts, expires_at, verified = result
+        return outcome, VerificationEntry(
+            code=stored_code,
+            attempts=int(attempts),
+            max_attempts=int(max_attempts),
+            expires_at=float(expires_at),
+            verified=verified == "1",
+        )
+
+
+def _create_store():
+    if settings.use_redis:
+        try:
+            return RedisVerificationStore(settings.redis_url, timeout=settings.verification_redis_timeout)
+        except ImportError:
+            logger.warning("redis package is not installed, verification codes are kept in memory")
+    return MemoryVerificationStore()
+
+
+class VerificationAuditLog:
+    """Batched writer and purger for the ``phone_verifications`` audit table.
+
+    ``record`` only appends to an in-memory queue; a background task flushes
+    the queue with one bulk insert every ``flush_interval`` seconds and, every
+    ``purge_interval`` seconds, deletes rows that expired more than
+    ``retention`` ago, ``purge_batch_size`` rows per transaction. While the
+    database is slow or down, at most ``max_pending`` rows are kept; older
+    ones are dropped, with a warning at the next flush.
+    """
+
+    def __init__(self, flush_interval: float, purge_interval: float, retention: timedelta, purge_batch_size: int,
+                 max_pending: int):
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.retention = retention
+        self.purge_batch_size = purge_batch_size
+        self.max_pending = max_pending
+        self._pending: List[dict] = []
+        self._dropped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _trim(self) -> None:
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            del self._pending[:overflow]
+            self._dropped += overflow
+
+    def record(self, phone_number: str, code: str, expires_at: datetime, attempts: int = 0,
+               verified_at: Optional[datetime] = None) -> None:
+        self._pending.append({
+            "phone_number": phone_number,
+            "verification_code": code,
+            "is_verified": verified_at is not None,
+            "attempts": attempts,
+            "expires_at": expires_at,
+            "created_at": datetime.utcnow(),
+            "verified_at": verified_at,
+        })
+        self._trim()
+
+    def flush(self) -> int:
+        if self._dropped:
+            logger.warning("Dropped %s phone verification audit rows while the database lagged", self._dropped)
+            self._dropped = 0
+        rows, self._pending = self._pending, []
+        if not rows:
+            return 0
+        db = SessionLocal()
+        try:
+            db.bulk_insert_mappings(PhoneVerification, rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Keep the rows for the next flush rather than losing the audit trail
+            self._pending[:0] = rows
+            self._trim()
+            raise
+        finally:
+            db.close()
+        return len(rows)
+
+    def purge_expired(self, max_batches: int = 100) -> int:
+        """Delete audit rows past retention, one bounded batch per transaction"""
+        cutoff = datetime.utcnow() - self.retention
+        deleted = 0
+        db = SessionLocal()
+        try:
+            for _ in range(max_batches):
+                ids = [row_id for (row_id,) in db.query(PhoneVerification.id).filter(
+                    PhoneVerification.expires_at < cutoff
+                ).limit(self.purge_batch_size)]
+                if not ids:
+                    break
+                db.query(PhoneVerification).filter(
+                    PhoneVerification.id.in_(ids)
+                ).delete(synchronize_session=False)
+                db.commit()
+                deleted += len(ids)
+        finally:
+            db.close()
+        return deleted
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    async def _run(self) -> None:
+        # Tables created before the expiry index existed do not get it from create_all
+        for index in PhoneVerification.__table__.indexes:
+            await asyncio.to_thread(index.create, engine, checkfirst=True)
+        next_purge = time.monotonic()
+        while True:
+            try:
+                await asyncio.to_thread(self.flush)
+                if time.monotonic() >= next_purge:
+                    deleted = await asyncio.to_thread(self.purge_expired)
+                    if deleted:
+                        logger.info("Purged %s expired phone verification rows", deleted)
+                    next_purge = time.monotonic() + self.purge_interval
+            except Exception as exc:
+                logger.error("Phone verification audit maintenance failed: %s", exc)
+            await asyncio.sleep(self.flush_interval)
+
+
+verification_store = _create_store()
+verification_audit = VerificationAuditLog(
+    flush_interval=settings.verification_audit_flush_interval,
+    purge_interval=settings.verification_purge_interval,
+    retention=timedelta(days=settings.verification_audit_retention_days),
+    purge_batch_size=settings.verification_purge_batch_size,
+    max_pending=settings.verification_audit_max_pending,
+)
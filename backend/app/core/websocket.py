@@ -1,12 +1,282 @@
-from typing import Dict, List, Set
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 from fastapi import WebSocket
 import asyncio
 import json
 import logging
+import math
+import time
+from app.core.config import settings
 
 
 logger = logging.getLogger(__name__)
 
+_NO_CONNECTIONS: FrozenSet[WebSocket] = frozenset()
+
+
+class _HeartbeatState:
+    __slots__ = ("user_id", "slot", "last_seen", "ping_sent_at", "answers_pings")
+
+    def __init__(self, user_id: int, slot: int, now: float) -> None:
+        self.user_id = user_id
+        self.slot = slot
+        self.last_seen = now
+        self.ping_sent_at: Optional[float] = None
+        self.answers_pings = False
+
+
+class HeartbeatScheduler:
+    """Server-driven heartbeats for registered websockets.
+
+    Connections are kept on a hashed timer wheel with ``interval / tick``
+    slots. A single background task advances the wheel every ``tick`` seconds
+    and only visits the connections whose slot came due, so there is no
+    sleep task per socket and the work per tick is proportional to the
+    connections due. Each ping is sent by its own task within
+    ``send_timeout``, so a stalled socket delays nothing but itself and is
+    reaped when the send fails.
+
+    Only clients that have answered a ping with ``{"type": "pong"}`` are
+    reaped for silence - after ``timeout`` seconds without any frame from
+    them. Clients that never answer are left to the protocol-level
+    ping/pong of the server (uvicorn's ``ws_ping_interval``), so an idle
+    client without a pong handler is not disconnected.
+    """
+
+    def __init__(self, manager: "ConnectionManager", interval: float, timeout: float, tick: float = 1.0,
+                 send_timeout: float = 5.0) -> None:
+        self._manager = manager
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.send_timeout = send_timeout
+        self._wheel_size = max(1, math.ceil(interval / tick))
+        self._slots: List[Set[WebSocket]] = [set() for _ in range(self._wheel_size)]
+        self._cursor = 0
+        self._states: Dict[WebSocket, _HeartbeatState] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._pings: Set[asyncio.Task] = set()
+        self._reaped = 0
+        self._registered = 0
+        self._avg_rtt: Optional[float] = None
+
+    def register(self, websocket: WebSocket, user_id: int) -> None:
+        """Start tracking a connection; its first ping is at most one interval away."""
+        if websocket in self._states:
+            return
+        # Spread connections over the wheel so a burst of connects does not
+        # turn into a burst of pings on a single tick.
+        slot = (self._cursor + 1 + self._registered % self._wheel_size) % self._wheel_size
+        self._registered += 1
+        self._states[websocket] = _HeartbeatState(user_id, slot, time.monotonic())
+        self._slots[slot].add(websocket)
+
+    def unregister(self, websocket: WebSocket) -> None:
+        state = self._states.pop(websocket, None)
+        if state is not None:
+            self._slots[state.slot].discard(websocket)
+
+    def touch(self, websocket: WebSocket) -> None:
+        """Record inbound traffic; any frame proves the peer is alive."""
+        state = self._states.get(websocket)
+        if state is not None:
+            state.last_seen = time.monotonic()
+
+    def record_pong(self, websocket: WebSocket) -> None:
+        """Record a pong reply and fold its round trip into the average."""
+        state = self._states.get(websocket)
+        if state is None or state.ping_sent_at is None:
+            return
+        now = time.monotonic()
+        rtt = now - state.ping_sent_at
+        state.ping_sent_at = None
+        state.last_seen = now
+        state.answers_pings = True
+        # Exponentially weighted so the figure tracks current network conditions
+        self._avg_rtt = rtt if self._avg_rtt is None else self._avg_rtt * 0.9 + rtt * 0.1
+
+    def stats(self) -> dict:
+        return {
+            "active_connections": len(self._states),
+            "reaped_connections": self._reaped,
+            "average_rtt_ms": round(self._avg_rtt * 1000, 2) if self._avg_rtt is not None else None,
+            "heartbeat_interval": self.interval,
+            "heartbeat_timeout": self.timeout,
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._pings):
+            task.cancel()
+        await asyncio.gather(*self._pings, return_exceptions=True)
+
+    async def _run(self) -> None:
+        # Ticks are scheduled from a fixed deadline, so time spent in a tick
+        # and late wakeups do not make the wheel fall behind
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            # Catch up on ticks missed while the loop was busy, at most one turn of the wheel
+            for _ in range(self._wheel_size):
+                try:
+                    self._advance()
+                except Exception as exc:
+                    logger.error("Heartbeat tick failed: %s", exc)
+                next_tick += self.tick
+                if next_tick > time.monotonic():
+                    break
+            else:
+                next_tick = time.monotonic() + self.tick
+
+    def _advance(self) -> None:
+        self._cursor = (self._cursor + 1) % self._wheel_size
+        due = self._slots[self._cursor]
+        if not due:
+            return
+
+        now = time.monotonic()
+        frame = json.dumps({"type": "ping", "timestamp": int(time.time() * 1000)})
+        # Connections stay in their slot, so they come due again in one interval
+        for websocket in list(due):
+            state = self._states[websocket]
+            if state.answers_pings and now - state.last_seen > self.timeout:
+                self._spawn(self._reap(websocket))
+            else:
+                self._spawn(self._ping(websocket, frame, now))
+
+    def _spawn(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self._pings.add(task)
+        task.add_done_callback(self._pings.discard)
+
+    async def _ping(self, websocket: WebSocket, frame: str, now: float) -> None:
+        state = self._states.get(websocket)
+        if state is None:
+            return
+        state.ping_sent_at = now
+        try:
+            await asyncio.wait_for(websocket.send_text(frame), timeout=self.send_timeout)
+        except Exception:
+            # Closed, or its send buffer is full and the peer is not reading
+            await self._reap(websocket)
+
+    async def _reap(self, websocket: WebSocket) -> None:
+        state = self._states.get(websocket)
+        if state is None:
+            return
+        self._reaped += 1
+        logger.info("Reaping unresponsive websocket: user_id=%s", state.user_id)
+        self._manager.disconnect(websocket, state.user_id)
+        try:
+            await asyncio.wait_for(websocket.close(code=1001), timeout=self.send_timeout)
+        except Exception:
+            pass
+
+
+class CallRoom:
+    """Participants of one call plus its expiry and signaling token bucket."""
+
+    __slots__ = ("call_id", "participants", "expires_at", "tokens", "refilled_at")
+
+    def __init__(self, call_id: str, participants: Set[int], expires_at: float, tokens: float) -> None:
+        self.call_id = call_id
+        self.participants = participants
+        self.expires_at = expires_at
+        self.tokens = tokens
+        self.refilled_at = time.monotonic()
+
+
+class CallRoomRegistry:
+    """Maps call ids to their participants so signaling reaches only them.
+
+    Rooms expire after ``ttl`` seconds without signaling traffic; expired
+    rooms are dropped lazily on lookup and by a periodic sweep. Each room has
+    a token bucket refilled at ``rate`` frames per second up to ``burst``,
+    which caps how fast a single call can push frames through the server.
+    """
+
+    def __init__(self, ttl: float, max_participants: int, rate: float, burst: int) -> None:
+        self.ttl = ttl
+        self.max_participants = max_participants
+        self.rate = rate
+        self.burst = burst
+        self._rooms: Dict[str, CallRoom] = {}
+        self._next_sweep = time.monotonic() + ttl
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def get(self, call_id: str) -> Optional[CallRoom]:
+        room = self._rooms.get(call_id)
+        if room is not None and room.expires_at <= time.monotonic():
+            del self._rooms[call_id]
+            return None
+        return room
+
+    def open(self, call_id: str, caller_id: int, participant_ids: List[int]) -> CallRoom:
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.purge_expired()
+        participants = {caller_id, *participant_ids}
+        if len(participants) > self.max_participants:
+            raise ValueError("Too many call participants")
+        room = CallRoom(call_id, participants, now + self.ttl, float(self.burst))
+        self._rooms[call_id] = room
+        return room
+
+    def leave(self, call_id: str, user_id: int) -> None:
+        """Remove a participant; a room with fewer than two members is closed."""
+        room = self._rooms.get(call_id)
+        if room is None:
+            return
+        room.participants.discard(user_id)
+        if len(room.participants) < 2:
+            del self._rooms[call_id]
+
+    def allow(self, room: CallRoom) -> bool:
+        """Consume one signaling token and push back the room's expiry."""
+        now = time.monotonic()
+        room.tokens = min(self.burst, room.tokens + (now - room.refilled_at) * self.rate)
+        room.refilled_at = now
+        if room.tokens < 1:
+            return False
+        room.tokens -= 1
+        room.expires_at = now + self.ttl
+        return True
+
+    def purge_expired(self) -> int:
+        now = time.monotonic()
+        expired = [call_id for call_id, room in self._rooms.items() if room.expires_at <= now]
+        for call_id in expired:
+            del self._rooms[call_id]
+        self._next_sweep = now + self.ttl
+        return len(expired)
+
+
+class _Shard:
+    """One stripe of the connection registry.
+
+    ``connections`` maps user_id to an immutable frozenset that is replaced,
+    never mutated, so readers can iterate it across awaits without copying.
+    ``snapshot`` is a cached tuple of every socket in the shard for fan-out
+    and is rebuilt lazily, only after the shard changed.
+    """
+
+    __slots__ = ("connections", "snapshot")
+
+    def __init__(self) -> None:
+        self.connections: Dict[int, FrozenSet[WebSocket]] = {}
+        self.snapshot: Optional[Tuple[WebSocket, ...]] = None
+
 
 class ConnectionManager:
     """In-memory websocket connection manager keyed by user_id.
@@ -16,48 +286,104 @@ class ConnectionManager:
     - send_personal_message: send text to all connections of a user
     - broadcast: send text to all connected users
     - helpers for typing/call notifications used by API layer
+    - calls: call rooms that scope signaling frames to call participants
+    - heartbeat: server-driven liveness checks that reap dead connections
+
+    The registry is split into shards by user_id. Mutations run without an
+    await in between, so on the event loop they are atomic and need no lock;
+    they swap in new frozensets (copy-on-write) and invalidate only their own
+    shard's broadcast snapshot. Lookups and fan-out therefore iterate shared
+    immutable collections without locking or per-call list allocation.
     """
 
-    def __init__(self) -> None:
-        self._user_id_to_connections: Dict[int, Set[WebSocket]] = {}
-        self._lock = asyncio.Lock()
+    def __init__(self, shard_count: int = 64) -> None:
+        self._shards: Tuple[_Shard, ...] = tuple(_Shard() for _ in range(shard_count))
+        self._connection_count = 0
+        self.heartbeat = HeartbeatScheduler(
+            self,
+            interval=settings.ws_heartbeat_interval,
+            timeout=settings.ws_heartbeat_timeout,
+            tick=settings.ws_heartbeat_tick,
+            send_timeout=settings.ws_heartbeat_send_timeout,
+        )
+        self.calls = CallRoomRegistry(
+            ttl=settings.ws_call_room_ttl,
+            max_participants=settings.ws_call_max_participants,
+            rate=settings.ws_call_rate_limit,
+            burst=settings.ws_call_rate_burst,
+        )
+
+    def _shard(self, user_id: int) -> _Shard:
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    @property
+    def connection_count(self) -> int:
+        return self._connection_count
+
+    @property
+    def user_count(self) -> int:
+        return sum(len(shard.connections) for shard in self._shards)
+
+    def get_connections(self, user_id: int) -> FrozenSet[WebSocket]:
+        return self._shard(user_id).connections.get(user_id, _NO_CONNECTIONS)
+
+    def is_connected(self, user_id: int) -> bool:
+        return user_id in self._shard(user_id).connections
 
     async def connect(self, websocket: WebSocket, user_id: int) -> None:
         await websocket.accept()
-        async with self._lock:
-            if user_id not in self._user_id_to_connections:
-                self._user_id_to_connections[user_id] = set()
-            self._user_id_to_connections[user_id].add(websocket)
-        logger.info("WebSocket connected: user_id=%s total_conns=%s", user_id, len(self._user_id_to_connections[user_id]))
+        self.register(websocket, user_id)
+        logger.info("WebSocket connected: user_id=%s total_conns=%s", user_id, len(self.get_connections(user_id)))
+
+    def register(self, websocket: WebSocket, user_id: int) -> None:
+        """Add an already accepted websocket to the registry."""
+        shard = self._shard(user_id)
+        current = shard.connections.get(user_id, _NO_CONNECTIONS)
+        if websocket in current:
+            return
+        shard.connections[user_id] = current | {websocket}
+        shard.snapshot = None
+        self._connection_count += 1
+        self.heartbeat.register(websocket, user_id)
 
     def disconnect(self, websocket: WebSocket, user_id: int) -> None:
+        self.heartbeat.unregister(websocket)
         try:
-            connections = self._user_id_to_connections.get(user_id)
+            shard = self._shard(user_id)
+            connections = shard.connections.get(user_id)
             if connections and websocket in connections:
-                connections.remove(websocket)
-                if not connections:
-                    self._user_id_to_connections.pop(user_id, None)
-            logger.info("WebSocket disconnected: user_id=%s remaining_conns=%s", user_id, len(self._user_id_to_connections.get(user_id, [])))
+                remaining = connections - {websocket}
+                if remaining:
+                    shard.connections[user_id] = remaining
+                else:
+                    del shard.connections[user_id]
+                shard.snapshot = None
+                self._connection_count -= 1
+            logger.info("WebSocket disconnected: user_id=%s remaining_conns=%s", user_id, len(self.get_connections(user_id)))
         except Exception as exc:
             logger.error("Error during disconnect for user_id=%s: %s", user_id, exc)
 
+    def _shard_snapshot(self, shard: _Shard) -> Tuple[WebSocket, ...]:
+        snapshot = shard.snapshot
+        if snapshot is None:
+            snapshot = tuple(ws for conns in shard.connections.values() for ws in conns)
+            shard.snapshot = snapshot
+        return snapshot
+
     async def send_personal_message(self, message_text: str, user_id: int) -> None:
-        connections = list(self._user_id_to_connections.get(user_id, []))
-        for ws in connections:
+        for ws in self.get_connections(user_id):
             try:
                 await ws.send_text(message_text)
             except Exception as exc:
                 logger.warning("Failed to send to user_id=%s: %s", user_id, exc)
 
     async def broadcast(self, message_text: str) -> None:
-        all_connections: List[WebSocket] = []
-        for conns in self._user_id_to_connections.values():
-            all_connections.extend(list(conns))
-        for ws in all_connections:
-            try:
-                await ws.send_text(message_text)
-            except Exception as exc:
-                logger.warning("Broadcast send failed: %s", exc)
+        for shard in self._shards:
+            for ws in self._shard_snapshot(shard):
+                try:
+                    await ws.send_text(message_text)
+                except Exception as exc:
+                    logger.warning("Broadcast send failed: %s", exc)
 
     async def send_typing_indicator(self, chat_id: int, user_id: int, is_typing: bool) -> None:
         payload = {
@@ -68,12 +394,56 @@ class ConnectionManager:
         }
         await self.broadcast(json.dumps(payload))
 
-    async def send_call_notification(self, call_data: dict) -> None:
-        payload = {
+    async def send_call_notification(self, user_id: int, call_data: dict) -> None:
+        """Route a call signaling frame to the other members of its call.
+
+        An ``offer`` carrying ``participants`` opens the room; every other
+        frame must reference an existing room the sender belongs to. A
+        ``hangup`` removes the sender from the room.
+        """
+        if not isinstance(call_data, dict):
+            call_data = {}
+        call_id = call_data.get("call_id")
+        if not call_id:
+            await self._send_call_error(user_id, None, "call_id is required")
+            return
+        call_id = str(call_id)
+
+        room = self.calls.get(call_id)
+        if room is None:
+            participant_ids = call_data.get("participants")
+            if call_data.get("action") != "offer" or not isinstance(participant_ids, list):
+                await self._send_call_error(user_id, call_id, "Unknown call")
+                return
+            try:
+                room = self.calls.open(call_id, user_id, [int(p) for p in participant_ids])
+            except (TypeError, ValueError) as exc:
+                await self._send_call_error(user_id, call_id, str(exc))
+                return
+        elif user_id not in room.participants:
+            await self._send_call_error(user_id, call_id, "Not a participant of this call")
+            return
+
+        if not self.calls.allow(room):
+            await self._send_call_error(user_id, call_id, "Call signaling rate limit exceeded")
+            return
+
+        payload = json.dumps({
             "type": "call_notification",
-            "data": call_data or {},
-        }
-        await self.broadcast(json.dumps(payload))
+            "from_user_id": user_id,
+            "data": call_data,
+        })
+        recipients = [participant for participant in room.participants if participant != user_id]
+        if call_data.get("action") == "hangup":
+            self.calls.leave(call_id, user_id)
+        for participant in recipients:
+            await self.send_personal_message(payload, participant)
+
+    async def _send_call_error(self, user_id: int, call_id: Optional[str], error: str) -> None:
+        await self.send_personal_message(
+            json.dumps({"type": "call_error", "call_id": call_id, "error": error}),
+            user_id,
+        )
 
     async def send_message_notification(self, message_data: dict) -> None:
         payload = {
@@ -7,7 +7,17 @@ import os
 import logging
 from app.core.config import settings
 from app.core.database import engine, Base, create_tables
-from app.core.security_headers import get_security_middleware
+from app.core.security_headers import SecurityMiddleware, audit_log_queue
+from app.core.rate_limiting import RateLimitMiddleware
+from app.core.websocket import manager as websocket_manager
+from app.core.sessions import revocation_sync
+from app.core.verification_store import verification_audit
+from app.core.encryption import encryption_manager
+from app.core.storage import upload_sessions
+from app.core.blob_store import blob_store
+from app.core.thumbnails import thumbnail_queue
+from app.core.transcoding import media_transcoder
+from app.core.user_search import user_search
 from app.api.v1 import auth, users, chats, messages, websocket, files
 from fastapi.openapi.docs import get_swagger_ui_html, get_redoc_html
 import requests
@@ -44,6 +54,7 @@ download_swagger_files()
 
 # Create database tables
 create_tables()
+user_search.create_index(engine)
 
 # Create FastAPI app with disabled default docs
 app = FastAPI(
@@ -80,17 +91,19 @@ app.add_middleware(
     max_age=600,
 )
 
-# Временно отключаем security middleware для разработки
-# if settings.enable_security_headers:
-#     for middleware_class in get_security_middleware():
-#         app.add_middleware(middleware_class)
-
 # Trusted host middleware - временно разрешаем все хосты
 app.add_middleware(
     TrustedHostMiddleware,
     allowed_hosts=["*"]
 )
 
+# Rate limiting - отклоняет запросы до чтения тела и открытия сессии БД
+if settings.enable_rate_limiting:
+    app.add_middleware(RateLimitMiddleware)
+
+# Security middleware (request ID, заголовки безопасности, CSRF, аудит) - внешний слой
+app.add_middleware(SecurityMiddleware)
+
 # Create upload directory
 os.makedirs(settings.upload_dir, exist_ok=True)
 os.makedirs(os.path.join(settings.upload_dir, "image"), exist_ok=True)
@@ -100,7 +113,6 @@ os.makedirs(os.path.join(settings.upload_dir, "document"), exist_ok=True)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/files", StaticFiles(directory=settings.upload_dir), name="files")
 
 # Include routers
 app.include_router(auth.router, prefix="/api/v1")
@@ -109,6 +121,8 @@ app.include_router(chats.router, prefix="/api/v1")
 app.include_router(messages.router, prefix="/api/v1")
 app.include_router(websocket.router, prefix="/api/v1")
 app.include_router(files.router, prefix="/api/v1")
+# Stored files at their public /files/... URLs, with range requests and caching headers
+app.include_router(files.media_router)
 
 # Custom OPTIONS handler for CORS preflight
 @app.options("/api/v1/{path:path}")
@@ -204,6 +218,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             "status_code": exc.status_code
         },
         headers={
+            **(exc.headers or {}),
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
             "Access-Control-Allow-Headers": "*",
@@ -235,11 +250,29 @@ async def startup_event():
     logger.info(f"Debug mode: {settings.debug}")
     logger.info(f"Database URL: {settings.database_url}")
     logger.info("CORS configured for development")
+    # Fork the thumbnail and transcoding workers, so they go before anything that starts threads
+    thumbnail_queue.start()
+    media_transcoder.start()
+    encryption_manager.prepare()
+    audit_log_queue.start()
+    websocket_manager.heartbeat.start()
+    revocation_sync.start()
+    verification_audit.start()
+    upload_sessions.start()
+    blob_store.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Run on application shutdown"""
     logger.info("Application shutting down...")
+    await websocket_manager.heartbeat.stop()
+    await revocation_sync.stop()
+    await verification_audit.stop()
+    await upload_sessions.stop()
+    await blob_store.stop()
+    await media_transcoder.stop()
+    await thumbnail_queue.stop()
+    audit_log_queue.stop()
 
 if __name__ == "__main__":
     import uvicorn
@@ -2,5 +2,7 @@ from .user import User
 from .chat import Chat, ChatParticipant
 from .message import Message
 from .verification import PhoneVerification
+from .session import UserSession, RevokedToken
+from .file import FileBlob, StoredFile, StorageUsage, TranscodeJob
 
-__all__ = ["User", "Chat", "ChatParticipant", "Message", "PhoneVerification"]
+__all__ = ["User", "Chat", "ChatParticipant", "Message", "PhoneVerification", "UserSession", "RevokedToken", "FileBlob", "StoredFile", "StorageUsage", "TranscodeJob"]
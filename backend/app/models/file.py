@@ -0,0 +1,81 @@
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ForeignKey, Index
+from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
+from app.core.database import Base
+
+
+class FileBlob(Base):
+    """Stored file content, shared by every upload with the same SHA-256."""
+    __tablename__ = "file_blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    file_type = Column(String(20), nullable=False)
+    path = Column(String(255), unique=True, nullable=False)  # relative to the upload directory
+    size = Column(BigInteger, nullable=False)
+    mime_type = Column(String(100), nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=func.now())
+    unreferenced_at = Column(DateTime, nullable=True, index=True)
+    preview = Column(Text, nullable=True)  # tiny WebP data URI of images, inlined in payloads
+
+    def __repr__(self):
+        return f"<FileBlob(sha256={self.sha256}, ref_count={self.ref_count})>"
+
+
+class StoredFile(Base):
+    """An uploaded file as seen by its owner; the content lives in a ``FileBlob``.
+
+    ``ref_count`` counts the messages that carry the file; files left
+    without references are removed by the orphan sweeper.
+    """
+    __tablename__ = "files"
+    __table_args__ = (
+        Index("ix_files_owner_created", "owner_id", "created_at"),
+        Index("ix_files_unreferenced", "ref_count", "created_at"),
+    )
+
+    id = Column(String(36), primary_key=True)
+    blob_sha256 = Column(String(64), ForeignKey("file_blobs.sha256"), nullable=False, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    filename = Column(String(255), nullable=False)
+    file_type = Column(String(20), nullable=False)
+    mime_type = Column(String(100), nullable=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=func.now())
+
+    blob = relationship("FileBlob")
+
+    def __repr__(self):
+        return f"<StoredFile(id={self.id}, owner_id={self.owner_id}, blob_sha256={self.blob_sha256})>"
+
+
+class StorageUsage(Base):
+    """Per-user totals of stored files, kept up to date for quota checks."""
+    __tablename__ = "storage_usage"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    bytes_used = Column(BigInteger, nullable=False, default=0)
+    file_count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<StorageUsage(user_id={self.user_id}, bytes_used={self.bytes_used})>"
+
+
+class TranscodeJob(Base):
+    """Pending or finished re-encoding of an image blob into its served variants."""
+    __tablename__ = "transcode_jobs"
+    __table_args__ = (
+        Index("ix_transcode_jobs_due", "status", "next_attempt_at"),
+    )
+
+    blob_sha256 = Column(String(64), ForeignKey("file_blobs.sha256"), primary_key=True)
+    status = Column(String(20), nullable=False, default="pending")  # pending, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=func.now())
+    last_error = Column(String(500), nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now())
+
+    def __repr__(self):
+        return f"<TranscodeJob(blob_sha256={self.blob_sha256}, status={self.status}, attempts={self.attempts})>"
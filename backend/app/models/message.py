@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Enum
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Enum
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
 from app.core.database import Base
+from app.models.types import EncryptedText
 
 
 class MessageType(str, enum.Enum):
@@ -24,9 +25,9 @@ class Message(Base):
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # For private chats
-    content = Column(Text, nullable=True)
+    content = Column(EncryptedText, nullable=True)
     message_type = Column(Enum(MessageType), default=MessageType.TEXT)
-    file_url = Column(String(500), nullable=True)
+    file_url = Column(String(500), nullable=True, index=True)
     file_size = Column(Integer, nullable=True)
     file_name = Column(String(200), nullable=True)
     is_edited = Column(Boolean, default=False)
@@ -0,0 +1,53 @@
+from typing import List, Optional, Sequence
+import logging
+from sqlalchemy import Text
+from sqlalchemy.types import TypeDecorator
+from app.core.config import settings
+from app.core.encryption import encryption_manager
+
+logger = logging.getLogger(__name__)
+
+class EncryptedText(TypeDecorator):
+    """Text column encrypted at rest with AES-256-GCM.
+
+    Values are written as ``enc:v1:<token>`` while ``settings.encrypt_messages``
+    is on and decrypted transparently when rows are loaded; rows written
+    before encryption was enabled (no prefix) are returned unchanged, so the
+    setting can be switched without a data migration. Decryption happens in
+    the result processor with the manager's cached AES-GCM context, so a page
+    of rows costs one AEAD open per row and no per-row key setup.
+
+    Ciphertext cannot be matched by SQL ``LIKE``; see ``search_messages``.
+    """
+
+    impl = Text
+    cache_ok = True
+
+    PREFIX = "enc:v1:"
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not settings.encrypt_messages:
+            return value
+        return self.PREFIX + encryption_manager.encrypt_data(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not value.startswith(self.PREFIX):
+            return value
+        try:
+            return encryption_manager.decrypt_text(value[len(self.PREFIX):])
+        except ValueError:
+            # Legacy plaintext that merely looks like ciphertext, or a wrong ENCRYPTION_KEY
+            logger.error("Could not decrypt an encrypted column value, returning it as stored; is ENCRYPTION_KEY right?")
+            return value
+
+    def decrypt_many(self, values: Sequence[Optional[str]]) -> List[Optional[str]]:
+        """``process_result_value`` for a batch of raw column values"""
+        encrypted = [i for i, value in enumerate(values) if value is not None and value.startswith(self.PREFIX)]
+        try:
+            plaintexts = encryption_manager.decrypt_many([values[i][len(self.PREFIX):] for i in encrypted])
+        except ValueError:
+            return [self.process_result_value(value, None) for value in values]
+        result = list(values)
+        for i, plaintext in zip(encrypted, plaintexts):
+            result[i] = plaintext
+        return result
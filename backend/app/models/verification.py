@@ -12,7 +12,7 @@ class PhoneVerification(Base):
     is_verified = Column(Boolean, default=False)
     attempts = Column(Integer, default=0)
     max_attempts = Column(Integer, default=3)
-    expires_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
     created_at = Column(DateTime, default=func.now())
     verified_at = Column(DateTime, nullable=True)
 
@@ -2,10 +2,12 @@ from .user import UserCreate, UserUpdate, UserResponse, UserProfile
 from .auth import Token, TokenData, PhoneVerificationRequest, PhoneVerificationResponse
 from .chat import ChatCreate, ChatUpdate, ChatResponse, ChatParticipantResponse
 from .message import MessageCreate, MessageUpdate, MessageResponse
+from .file import UploadSessionCreate, FileLinkCreate, UploadSessionResponse
 
 __all__ = [
     "UserCreate", "UserUpdate", "UserResponse", "UserProfile",
     "Token", "TokenData", "PhoneVerificationRequest", "PhoneVerificationResponse",
     "ChatCreate", "ChatUpdate", "ChatResponse", "ChatParticipantResponse",
-    "MessageCreate", "MessageUpdate", "MessageResponse"
+    "MessageCreate", "MessageUpdate", "MessageResponse",
+    "UploadSessionCreate", "FileLinkCreate", "UploadSessionResponse"
 ]
@@ -1,14 +1,14 @@
 from pydantic import BaseModel, Field, validator
 from typing import Optional
+from app.core.encryption import data_sanitizer
 
 class PhoneVerificationRequest(BaseModel):
     phone_number: str = Field(..., min_length=10, max_length=20, example="+77001234567")
     
     @validator('phone_number')
     def validate_phone_number(cls, v):
-        if not v.startswith('+'):
-            raise ValueError('Phone number must start with +')
-        return v
+        # Users are stored and looked up by the E.164 form only
+        return data_sanitizer.sanitize_phone_number(v)
 
 class PhoneVerificationResponse(BaseModel):
     success: bool
@@ -20,6 +20,10 @@ class VerifyCodeRequest(BaseModel):
     phone_number: str = Field(..., min_length=10, max_length=20, example="+77001234567")
     verification_code: str = Field(..., min_length=4, max_length=4, example="1234")
     
+    @validator('phone_number')
+    def validate_phone_number(cls, v):
+        return data_sanitizer.sanitize_phone_number(v)
+    
     @validator('verification_code')
     def validate_verification_code(cls, v):
         if not v.isdigit():
@@ -0,0 +1,24 @@
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import Optional
+
+
+class UploadSessionCreate(BaseModel):
+    file_type: str  # image, video, audio, document
+    filename: str = Field(..., max_length=255)
+    content_type: str
+    size: int = Field(..., gt=0)
+
+
+class FileLinkCreate(BaseModel):
+    file_id: str  # a file of the caller's, or one attached to a message in their chats
+    filename: Optional[str] = Field(None, max_length=255)  # defaults to the file's own name
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    file_type: str
+    filename: str
+    size: int
+    offset: int
+    expires_at: datetime
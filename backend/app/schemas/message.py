@@ -13,6 +13,7 @@ class MessageBase(BaseModel):
 class MessageCreate(MessageBase):
     chat_id: int
     receiver_id: Optional[int] = None
+    file_id: Optional[str] = None  # id returned by the file upload
 
 
 class MessageUpdate(BaseModel):
@@ -27,6 +28,7 @@ class MessageResponse(MessageBase):
     file_url: Optional[str]
     file_size: Optional[int]
     file_name: Optional[str]
+    file_preview: Optional[str] = None  # WebP data URI of a few pixels, for image placeholders
     is_edited: bool
     edited_at: Optional[datetime]
     is_deleted: bool
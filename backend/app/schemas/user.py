@@ -1,6 +1,7 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, validator
 from typing import Optional
 from datetime import datetime
+from app.core.encryption import data_sanitizer
 
 
 class UserBase(BaseModel):
@@ -10,6 +11,10 @@ class UserBase(BaseModel):
     last_name: Optional[str] = None
     bio: Optional[str] = None
 
+    @validator('phone_number')
+    def validate_phone_number(cls, v):
+        return data_sanitizer.sanitize_phone_number(v)
+
 
 class UserCreate(UserBase):
     pass
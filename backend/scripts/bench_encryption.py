@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Event-loop latency benchmark for EncryptionManager
+Замер задержки event loop при конкурентном хешировании
+
+Runs N concurrent PBKDF2 hashes from coroutines, once calling the blocking
+hash_sensitive_data directly and once through hash_sensitive_data_async,
+while a probe task measures how late the event loop wakes it up.
+
+    python scripts/bench_encryption.py --concurrency 32
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.core.encryption import EncryptionManager
+
+PROBE_INTERVAL = 0.005
+
+
+async def probe(lags: list, stop: asyncio.Event):
+    """Sleep for PROBE_INTERVAL repeatedly and record how late each wake-up is"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def run_case(name: str, make_job, concurrency: int):
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(PROBE_INTERVAL * 2)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(make_job() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await probe_task
+    lags_ms = sorted(lag * 1000 for lag in lags) or [0.0]
+    p99 = lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))]
+    print(
+        f"{name:<8} total={elapsed:6.2f}s  hashes/s={concurrency / elapsed:7.1f}  "
+        f"loop lag median={statistics.median(lags_ms):7.2f}ms  p99={p99:7.2f}ms  max={lags_ms[-1]:7.2f}ms"
+    )
+
+
+async def main(concurrency: int, workers: int):
+    manager = EncryptionManager(max_workers=workers)
+
+    async def blocking_job():
+        manager.hash_sensitive_data("+79990000000")
+
+    async def async_job():
+        await manager.hash_sensitive_data_async("+79990000000")
+
+    print(f"{concurrency} concurrent PBKDF2-SHA256 hashes, {workers} pool workers")
+    await run_case("sync", blocking_job, concurrency)
+    await run_case("async", async_job, concurrency)
+
+    started = time.perf_counter()
+    ciphertexts = [manager.encrypt_data(f"message {i}") for i in range(10000)]
+    manager.decrypt_many(ciphertexts)
+    print(f"encrypt_data+decrypt_many of 10000 messages: {time.perf_counter() - started:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.workers))
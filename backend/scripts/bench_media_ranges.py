@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for concurrent video range reads
+Замер пропускной способности при параллельных Range-запросах к видео
+
+Simulates clients scrubbing through a stored video: every request asks for
+a random byte range. Calls small FastAPI apps directly through ASGI (no
+sockets) serving the file with the previous plain FileResponse, which
+ignores Range and sends the whole file, with media_response reading
+chunks off the event loop, and with media_response on a server that
+advertises the zero-copy send extension (the fake server sendfile()s to
+/dev/null). Prints requests per second, useful and total bytes sent.
+
+    python scripts/bench_media_ranges.py --file-size 32 --range-size 1 --requests 400 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ["DEBUG"] = "false"
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse
+from app.core.media import media_response
+
+
+def build_app(path: str, ranged: bool) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/files/video/{filename}")
+    async def get_file(filename: str, request: Request):
+        if ranged:
+            return media_response(request, path)
+        return FileResponse(path)
+
+    return app
+
+
+async def call(app, path: str, headers: list, zero_copy: bool, devnull: int) -> tuple:
+    """Run one GET through the ASGI app; return the status and the body bytes sent"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "server": ("testserver", 80), "client": ("127.0.0.1", 5000),
+        "headers": [(b"host", b"testserver")] + headers,
+        "extensions": {"http.response.zerocopysend": {}} if zero_copy else {},
+    }
+    status = 0
+    sent = 0
+    request_sent = False
+    response_done = asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, sent
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            sent += len(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_done.set()
+        elif message["type"] == "http.response.zerocopysend":
+            fd, offset, count = message["file"].fileno(), message.get("offset", 0), message["count"]
+            while count:
+                written = await asyncio.to_thread(os.sendfile, devnull, fd, offset, count)
+                offset += written
+                count -= written
+                sent += written
+            response_done.set()
+
+    await app(scope, receive, send)
+    return status, sent
+
+
+async def measure(app, url: str, file_size: int, range_size: int, requests: int, concurrency: int,
+                  zero_copy: bool, devnull: int) -> tuple:
+    useful = 0
+    total = 0
+
+    async def worker(count: int):
+        nonlocal useful, total
+        rng = random.Random(count)
+        for _ in range(count):
+            start = rng.randrange(0, file_size - range_size)
+            header = f"bytes={start}-{start + range_size - 1}".encode()
+            status, sent = await call(app, url, [(b"range", header)], zero_copy, devnull)
+            assert status in (200, 206), status
+            useful += range_size
+            total += sent
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(requests // concurrency) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return requests // concurrency * concurrency / elapsed, useful / elapsed, total
+
+
+async def main(file_size: int, range_size: int, requests: int, concurrency: int):
+    directory = tempfile.mkdtemp()
+    # Content-addressed name, as stored by the blob store
+    path = os.path.join(directory, "0" * 64 + ".mp4")
+    with open(path, "wb") as f:
+        for _ in range(file_size // (1024 * 1024)):
+            f.write(os.urandom(1024 * 1024))
+    file_size = os.path.getsize(path)
+    url = f"/files/video/{os.path.basename(path)}"
+    devnull = os.open(os.devnull, os.O_WRONLY)
+
+    variants = {
+        "FileResponse (whole file)": (build_app(path, ranged=False), False),
+        "media_response (chunks)": (build_app(path, ranged=True), False),
+        "media_response (zero-copy)": (build_app(path, ranged=True), True),
+    }
+    try:
+        print(f"{file_size // (1024 * 1024)} MB video, {range_size // 1024} KB ranges, "
+              f"{requests} requests, {concurrency} concurrent")
+        for name, (app, zero_copy) in variants.items():
+            await measure(app, url, file_size, range_size, concurrency, concurrency, zero_copy, devnull)
+            rate, useful_rate, total = await measure(
+                app, url, file_size, range_size, requests, concurrency, zero_copy, devnull
+            )
+            print(f"  {name:<28} {rate:8.0f} req/s  {useful_rate / 1048576:8.1f} MB/s of requested ranges  "
+                  f"{total / 1048576:10.1f} MB sent")
+
+        app = variants["media_response (chunks)"][0]
+        status, _ = await call(app, url, [(b"if-none-match", b'"' + b"0" * 64 + b'"')], False, devnull)
+        print(f"conditional GET with a matching ETag: {status}")
+    finally:
+        os.close(devnull)
+        os.remove(path)
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file-size", type=int, default=32, help="MB")
+    parser.add_argument("--range-size", type=int, default=1, help="MB")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(main(args.file_size * 1024 * 1024, args.range_size * 1024 * 1024, args.requests, args.concurrency))
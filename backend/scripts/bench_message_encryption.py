@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Read-latency benchmark for encrypted message content
+Замер накладных расходов шифрования сообщений при чтении истории
+
+Fills a throwaway SQLite database with one plaintext and one encrypted
+chat, then times the history page query used by get_chat_messages for
+both and prints the relative overhead.
+
+    python scripts/bench_message_encryption.py --messages 5000 --page 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Use a throwaway SQLite database before the app settings are loaded
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_TYPE"] = "sqlite"
+os.environ["SQLITE_DATABASE_PATH"] = os.path.join(_db_dir, "bench.db")
+os.environ["DEBUG"] = "false"
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import desc
+from sqlalchemy.orm import joinedload
+from app.core.config import settings
+from app.core.database import SessionLocal, create_tables
+from app.models import User, Chat, Message
+
+
+def populate(messages: int) -> tuple:
+    db = SessionLocal()
+    user = User(phone_number="+79990000000", first_name="Bench")
+    plain_chat, encrypted_chat = Chat(name="plain"), Chat(name="encrypted")
+    db.add_all([user, plain_chat, encrypted_chat])
+    db.commit()
+
+    for chat, encrypt in ((plain_chat, False), (encrypted_chat, True)):
+        settings.encrypt_messages = encrypt
+        db.add_all(
+            Message(chat_id=chat.id, sender_id=user.id, content=f"Message number {i} with some typical chat text")
+            for i in range(messages)
+        )
+        db.commit()
+    chat_ids = (plain_chat.id, encrypted_chat.id)
+    db.close()
+    return chat_ids
+
+
+def read_page(chat_id: int, page: int) -> float:
+    db = SessionLocal()
+    started = time.perf_counter()
+    messages = db.query(Message).filter(
+        Message.chat_id == chat_id,
+        Message.is_deleted == False
+    ).options(
+        joinedload(Message.sender),
+        joinedload(Message.receiver),
+        joinedload(Message.reply_to)
+    ).order_by(desc(Message.created_at)).limit(page).all()
+    [message.content for message in messages]
+    elapsed = time.perf_counter() - started
+    db.close()
+    return elapsed
+
+
+def time_pages(chat_ids: tuple, page: int, rounds: int) -> list:
+    """Median page read time per chat; reads alternate to cancel out drift"""
+    timings = [[] for _ in chat_ids]
+    for _ in range(rounds):
+        for index, chat_id in enumerate(chat_ids):
+            timings[index].append(read_page(chat_id, page))
+    return [statistics.median(chat_timings) for chat_timings in timings]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=300)
+    args = parser.parse_args()
+
+    create_tables()
+    plain_chat_id, encrypted_chat_id = populate(args.messages)
+    settings.encrypt_messages = True
+
+    # Warm up caches and the derived key
+    time_pages((plain_chat_id, encrypted_chat_id), args.page, 20)
+
+    plain, encrypted = time_pages((plain_chat_id, encrypted_chat_id), args.page, args.rounds)
+    print(f"Page of {args.page} messages (median of {args.rounds} reads)")
+    print(f"  plaintext: {plain * 1000:.3f} ms")
+    print(f"  encrypted: {encrypted * 1000:.3f} ms")
+    print(f"  overhead:  {(encrypted / plain - 1) * 100:+.1f}%")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Throughput and memory benchmark for the in-process rate limiter
+Замер производительности и потребления памяти ограничителя запросов
+
+Feeds N distinct client keys (plus a stream of repeat hits on a hot set)
+through MemoryRateLimitBackend and prints ops/sec, the number of tracked keys and
+the process RSS growth. Run it with --max-keys above --keys to see the
+per-key cost with no eviction at all.
+
+    python scripts/bench_rate_limiter.py --keys 1000000 --max-keys 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.core.rate_limiting import MemoryRateLimitBackend, RateLimiter
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MB"""
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def run(keys: int, hot_keys: int, repeat_hits: int, max_keys: int):
+    backend = MemoryRateLimitBackend(max_keys=max_keys)
+    rules = list(RateLimiter(backend).rules.values())
+    names = [f"ip:10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(keys)]
+    baseline = rss_mb()
+
+    started = time.perf_counter()
+    for index, name in enumerate(names):
+        rule = rules[index % len(rules)]
+        backend.consume(name, rule['requests'], rule['window'], rule['block_duration'], time.time())
+    distinct_elapsed = time.perf_counter() - started
+    distinct_rss = rss_mb() - baseline
+
+    hot = [(names[i], rules[i % len(rules)]) for i in random.sample(range(keys), hot_keys)]
+    started = time.perf_counter()
+    for _ in range(repeat_hits // hot_keys):
+        for name, rule in hot:
+            backend.consume(name, rule['requests'], rule['window'], rule['block_duration'], time.time())
+    repeat_elapsed = time.perf_counter() - started
+
+    print(f"{keys} distinct keys, max_keys={max_keys}")
+    print(f"  distinct hits: {keys / distinct_elapsed:10.0f} ops/s")
+    print(f"  repeat hits:   {repeat_hits / repeat_elapsed:10.0f} ops/s ({hot_keys} hot keys)")
+    print(f"  tracked keys:  {len(backend.states):10d}")
+    print(f"  RSS growth:    {distinct_rss:10.1f} MB ({distinct_rss * 1024 * 1024 / len(backend.states):.0f} B/key)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=1000000)
+    parser.add_argument("--hot-keys", type=int, default=1000)
+    parser.add_argument("--repeat-hits", type=int, default=1000000)
+    parser.add_argument("--max-keys", type=int, default=200000)
+    args = parser.parse_args()
+    run(args.keys, args.hot_keys, args.repeat_hits, args.max_keys)
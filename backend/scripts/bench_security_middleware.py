@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the security middleware
+Замер пропускной способности security middleware
+
+Calls a small FastAPI app directly through ASGI (no sockets, so only the
+middleware cost is measured) with no middleware, with the previous stack
+of five BaseHTTPMiddleware classes, and with the fused SecurityMiddleware,
+and prints requests per second for each. Also checks that a streamed
+response still arrives in chunks.
+
+    python scripts/bench_security_middleware.py --requests 20000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+os.environ["ENABLE_SECURITY_HEADERS"] = "true"
+os.environ["DEBUG"] = "false"
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from app.core.config import settings
+from app.core.security_headers import SecurityMiddleware, _get_helmet_headers, _get_security_headers
+
+SUSPICIOUS_PATTERNS = settings.security_audit_patterns
+
+
+# The stack that was in app/core/security_headers.py before SecurityMiddleware,
+# reduced to the work each layer did per request
+class LegacyRequestIDMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        request.state.request_id = str(uuid.uuid4())
+        response = await call_next(request)
+        response.headers['X-Request-ID'] = request.state.request_id
+        return response
+
+
+class LegacySecurityHeadersMiddleware(BaseHTTPMiddleware):
+    headers = _get_security_headers()
+
+    async def dispatch(self, request, call_next):
+        start_time = time.time()
+        response = await call_next(request)
+        for header, value in self.headers.items():
+            response.headers[header] = value
+        response.headers['X-Process-Time'] = str(time.time() - start_time)
+        return response
+
+
+class LegacyCSRFProtectionMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        return await call_next(request)
+
+
+class LegacyHelmetMiddleware(BaseHTTPMiddleware):
+    headers = _get_helmet_headers()
+
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        for header, value in self.headers.items():
+            response.headers[header] = value
+        return response
+
+
+class LegacySecurityAuditMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        url = str(request.url)
+        user_agent = request.headers.get('user-agent', '')
+        for pattern in SUSPICIOUS_PATTERNS:
+            if pattern.lower() in url.lower() or pattern.lower() in user_agent.lower():
+                break
+        return await call_next(request)
+
+
+LEGACY_STACK = [
+    LegacyRequestIDMiddleware,
+    LegacySecurityHeadersMiddleware,
+    LegacyCSRFProtectionMiddleware,
+    LegacyHelmetMiddleware,
+    LegacySecurityAuditMiddleware,
+]
+
+
+def build_app(middleware: list) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/v1/ping")
+    async def ping():
+        return {"status": "ok"}
+
+    @app.get("/api/v1/stream")
+    async def stream():
+        async def chunks():
+            for _ in range(4):
+                yield b"x" * 1024
+                await asyncio.sleep(0)
+        return StreamingResponse(chunks(), media_type="application/octet-stream")
+
+    for middleware_class in middleware:
+        app.add_middleware(middleware_class)
+    return app
+
+
+async def call(app, path: str) -> list:
+    """Run one GET through the ASGI app and return the sent messages"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "server": ("testserver", 80), "client": ("127.0.0.1", 5000),
+        "headers": [(b"host", b"testserver"), (b"user-agent", b"bench/1.0"), (b"authorization", b"Bearer x")],
+    }
+    messages = []
+    request_sent = False
+    response_done = asyncio.Event()
+
+    async def receive():
+        # Like a server: the body once, then block until the response is done
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            response_done.set()
+
+    await app(scope, receive, send)
+    return messages
+
+
+async def measure(app, requests: int, concurrency: int) -> float:
+    async def worker(count: int):
+        for _ in range(count):
+            await call(app, "/api/v1/ping")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(requests // concurrency) for _ in range(concurrency)))
+    return requests // concurrency * concurrency / (time.perf_counter() - started)
+
+
+async def main(requests: int, concurrency: int, rounds: int):
+    variants = {
+        "none": build_app([]),
+        "BaseHTTPMiddleware x5": build_app(LEGACY_STACK),
+        "SecurityMiddleware": build_app([SecurityMiddleware]),
+    }
+    for app in variants.values():
+        await measure(app, 500, 10)
+
+    results = {name: [] for name in variants}
+    # Interleave rounds so drift affects every variant alike
+    for _ in range(rounds):
+        for name, app in variants.items():
+            results[name].append(await measure(app, requests, concurrency))
+
+    baseline = max(results["none"])
+    print(f"{requests} GET requests per round, {concurrency} concurrent, best of {rounds}")
+    for name, rates in results.items():
+        best = max(rates)
+        print(f"  {name:<22} {best:9.0f} req/s  ({(best / baseline - 1) * 100:+6.1f}% vs none)")
+
+    messages = await call(variants["SecurityMiddleware"], "/api/v1/stream")
+    body_chunks = [m for m in messages if m["type"] == "http.response.body" and m.get("body")]
+    headers = dict(messages[0]["headers"])
+    print(f"streamed response: {len(body_chunks)} body chunks, x-request-id={headers.get(b'x-request-id', b'-').decode()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.rounds))
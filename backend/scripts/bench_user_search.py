@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark for user search
+Замер времени поиска пользователей
+
+Fills a temporary SQLite database with generated users, builds the search
+index over the existing rows, and times queries of 1-6 characters - name,
+username and phone prefixes, as typed into the search box - through
+UserSearch and through the previous LIKE '%q%' query. Prints p50, p99 and
+max latency.
+
+    python scripts/bench_user_search.py --users 1000000 --queries 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ["DEBUG"] = "false"
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import create_engine, or_
+from sqlalchemy.orm import sessionmaker
+from app.core.database import Base
+from app.core.user_search import UserSearch
+from app.models import User
+
+FIRST_NAMES = ["Alexander", "Alexey", "Anna", "Boris", "Daria", "Dmitry", "Elena", "Igor", "Irina", "Ivan",
+               "Maria", "Mikhail", "Natalia", "Olga", "Pavel", "Sergey", "Tatiana", "Victor", "Yulia", "Zoe",
+               "Александр", "Алексей", "Анна", "Иван", "Мария", "Ольга", "Павел", "Сергей"]
+LAST_NAMES = ["Ivanov", "Petrov", "Sidorov", "Smirnov", "Kuznetsov", "Popov", "Volkov", "Sokolov", "Lebedev",
+              "Kozlov", "Novikov", "Morozov", "Иванов", "Петров", "Смирнов", "Волков", "Соколов"]
+
+
+def fill(engine, count: int, rng: random.Random) -> None:
+    Base.metadata.create_all(bind=engine, tables=[User.__table__])
+    with engine.begin() as conn:
+        for start in range(0, count, 10000):
+            conn.execute(User.__table__.insert(), [
+                {
+                    "phone_number": f"+7{9000000000 + i}",
+                    "username": f"{rng.choice(FIRST_NAMES).lower()}{i}" if i % 3 else None,
+                    "first_name": rng.choice(FIRST_NAMES),
+                    "last_name": rng.choice(LAST_NAMES) if i % 4 else None,
+                    "is_active": True,
+                }
+                for i in range(start, min(start + 10000, count))
+            ])
+
+
+def make_queries(count: int, users: int, rng: random.Random) -> list:
+    queries = []
+    for _ in range(count):
+        kind = rng.randrange(3)
+        if kind == 0:
+            word = rng.choice(FIRST_NAMES + LAST_NAMES)
+        elif kind == 1:
+            word = f"{rng.choice(FIRST_NAMES).lower()}{rng.randrange(users)}"
+        else:
+            word = str(9000000000 + rng.randrange(users))
+        queries.append(word[:rng.randint(1, 6)] if kind != 1 else word[:rng.randint(1, len(word))])
+    return queries
+
+
+def like_search(db, query: str, limit: int) -> list:
+    return db.query(User).filter(
+        User.is_active == True,
+        or_(
+            User.phone_number.contains(query),
+            User.username.contains(query),
+            User.first_name.contains(query),
+            User.last_name.contains(query)
+        )
+    ).limit(limit).all()
+
+
+def measure(name: str, search, queries: list) -> None:
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        search(query)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"  {name:<22} p50 {timings[len(timings) // 2]:7.2f} ms  "
+          f"p99 {timings[int(len(timings) * 0.99)]:7.2f} ms  max {timings[-1]:7.2f} ms")
+
+
+def main(users: int, queries: int, like_queries: int, limit: int) -> None:
+    rng = random.Random(1)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench_user_search.db")
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        started = time.perf_counter()
+        fill(engine, users, rng)
+        print(f"{users} users inserted in {time.perf_counter() - started:.1f} s")
+        started = time.perf_counter()
+        search = UserSearch(candidates=200)
+        search.create_index(engine)
+        print(f"{search.backend} index built in {time.perf_counter() - started:.1f} s")
+
+        db = sessionmaker(bind=engine)()
+        sample = make_queries(queries, users, rng)
+        print(f"{queries} queries, e.g. {', '.join(repr(q) for q in sample[:6])}")
+        measure("UserSearch", lambda q: search.search(db, q, limit), sample)
+        measure("LIKE '%q%'", lambda q: like_search(db, q, limit), sample[:like_queries])
+        top = search.search(db, sample[0], limit)
+        print(f"top results for {sample[0]!r}: {[user.username or user.first_name for user in top[:5]]}")
+        db.close()
+    finally:
+        engine.dispose()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--like-queries", type=int, default=200, help="the LIKE query is slow; time fewer")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    main(args.users, args.queries, args.like_queries, args.limit)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Move stored files to the hash-sharded directory layout
+Перенос сохраненных файлов в структуру каталогов по префиксу хеша
+
+Moves blobs from uploads/<type>/<sha256><ext> to
+uploads/<type>/<ab>/<cd>/<sha256><ext>, with their thumbnails and
+re-encoded variants, a batch per transaction. Safe to run while the server
+is up, and to interrupt and run again: each file is hard-linked at its new
+place before the row is updated and removed from the old one only after
+the commit, and URLs in either layout resolve to whichever file exists, so
+messages that keep the old URL still work.
+
+    python scripts/migrate_upload_layout.py --batch-size 500 --pause 0.1
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.core.blob_store import alternate_path
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.thumbnails import thumbnail_paths
+from app.core.transcoding import variant_paths
+from app.models.file import FileBlob
+
+
+def local(path: str) -> str:
+    return os.path.join(settings.upload_dir, path)
+
+
+def place(old_path: str, new_path: str) -> bool:
+    """Make the file at ``old_path`` also available at ``new_path``; False if neither exists"""
+    os.makedirs(os.path.dirname(local(new_path)), exist_ok=True)
+    try:
+        os.link(local(old_path), local(new_path))
+    except FileExistsError:
+        # Linked by an interrupted run; the name is the content hash
+        pass
+    except FileNotFoundError:
+        return os.path.exists(local(new_path))
+    except OSError:
+        # No hard links on this filesystem
+        temp_path = f"{local(new_path)}.tmp"
+        shutil.copy2(local(old_path), temp_path)
+        os.replace(temp_path, local(new_path))
+    return True
+
+
+def finish(old_path: str, new_path: str) -> None:
+    """Remove the old file and move its thumbnails and variants once the row points at ``new_path``"""
+    try:
+        os.remove(local(old_path))
+    except FileNotFoundError:
+        pass
+    derived = zip(thumbnail_paths(old_path) + variant_paths(old_path),
+                  thumbnail_paths(new_path) + variant_paths(new_path))
+    for old_derived, new_derived in derived:
+        if os.path.exists(old_derived):
+            os.makedirs(os.path.dirname(new_derived), exist_ok=True)
+            os.replace(old_derived, new_derived)
+
+
+def migrate(batch_size: int, pause: float, dry_run: bool) -> None:
+    db = SessionLocal()
+    moved = missing = skipped = 0
+    last_sha256 = ""
+    try:
+        # Flat paths have a single slash: "<type>/<name>"
+        pending = db.query(FileBlob).filter(~FileBlob.path.like("%/%/%"))
+        print(f"{pending.count()} blobs in the flat layout")
+        if dry_run:
+            return
+        while True:
+            blobs = pending.filter(FileBlob.sha256 > last_sha256).order_by(FileBlob.sha256).limit(batch_size).all()
+            if not blobs:
+                break
+            last_sha256 = blobs[-1].sha256
+
+            placed = []
+            for blob in blobs:
+                new_path = alternate_path(blob.path)
+                if new_path is None:
+                    skipped += 1
+                elif not place(blob.path, new_path):
+                    missing += 1
+                else:
+                    placed.append((blob.sha256, blob.path, new_path))
+
+            updated = []
+            for sha256, old_path, new_path in placed:
+                # The blob may have been collected since it was read
+                if db.query(FileBlob).filter(FileBlob.sha256 == sha256, FileBlob.path == old_path).update(
+                    {FileBlob.path: new_path}, synchronize_session=False
+                ):
+                    updated.append((old_path, new_path))
+                else:
+                    os.remove(local(new_path))
+                    skipped += 1
+            db.commit()
+            db.expire_all()
+
+            for old_path, new_path in updated:
+                finish(old_path, new_path)
+            moved += len(updated)
+            print(f"  moved {moved}, missing {missing}, skipped {skipped}")
+            time.sleep(pause)
+    finally:
+        db.close()
+    print(f"Done: {moved} moved, {missing} missing on disk, {skipped} skipped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds between batches")
+    parser.add_argument("--dry-run", action="store_true", help="only count the blobs to move")
+    args = parser.parse_args()
+    migrate(args.batch_size, args.pause, args.dry_run)
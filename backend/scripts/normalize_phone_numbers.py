@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Rewrite stored phone numbers in canonical E.164 form
+Приведение сохраненных номеров телефонов к формату E.164
+
+Phone numbers are normalized when they are written and looked up by exact
+match only, so numbers stored before that - "+7 (999) 123-45-67",
+"89991234567" - must be rewritten, or their owners would sign up again as
+new users. Run it when deploying, before the new code serves logins; it is
+safe to run while the server is up and to run again. Users whose
+normalized number belongs to another user are left as they are and
+listed, as are numbers that cannot be normalized.
+
+    python scripts/normalize_phone_numbers.py --batch-size 1000 --pause 0.1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy.exc import IntegrityError
+from app.core.database import SessionLocal
+from app.core.encryption import data_sanitizer
+from app.models.user import User
+
+
+def update(db, user_id: int, phone_number: str, normalized: str) -> int:
+    # The number may have changed since it was read
+    return db.query(User).filter(User.id == user_id, User.phone_number == phone_number).update(
+        {User.phone_number: normalized}, synchronize_session=False
+    )
+
+
+def normalize(batch_size: int, pause: float, dry_run: bool) -> None:
+    db = SessionLocal()
+    changed = conflicts = invalid = 0
+    last_id = 0
+    try:
+        while True:
+            users = db.query(User.id, User.phone_number).filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+            if not users:
+                break
+            last_id = users[-1].id
+
+            pending = []
+            for user_id, phone_number in users:
+                try:
+                    normalized = data_sanitizer.sanitize_phone_number(phone_number)
+                except ValueError:
+                    invalid += 1
+                    print(f"  user {user_id}: {phone_number!r} is not a phone number")
+                    continue
+                if normalized != phone_number:
+                    pending.append((user_id, phone_number, normalized))
+            if not pending:
+                continue
+
+            owners = dict(db.query(User.phone_number, User.id).filter(
+                User.phone_number.in_([normalized for _, _, normalized in pending])
+            ))
+            updates = []
+            for user_id, phone_number, normalized in pending:
+                if owners.setdefault(normalized, user_id) != user_id:
+                    conflicts += 1
+                    print(f"  user {user_id}: {normalized} belongs to user {owners[normalized]}, left as {phone_number!r}")
+                else:
+                    updates.append((user_id, phone_number, normalized))
+            if dry_run:
+                changed += len(updates)
+                continue
+
+            try:
+                changed += sum(update(db, *row) for row in updates)
+                db.commit()
+            except IntegrityError:
+                # Someone signed up with one of the numbers meanwhile; retry one by one
+                db.rollback()
+                for row in updates:
+                    try:
+                        changed += update(db, *row)
+                        db.commit()
+                    except IntegrityError:
+                        db.rollback()
+                        conflicts += 1
+                        print(f"  user {row[0]}: {row[2]} was taken meanwhile, left as {row[1]!r}")
+            print(f"  up to user {last_id}: {changed} normalized, {conflicts} conflicts, {invalid} invalid")
+            time.sleep(pause)
+    finally:
+        db.close()
+    action = "To normalize" if dry_run else "Done"
+    print(f"{action}: {changed} numbers, {conflicts} conflicts, {invalid} invalid")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds between batches")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+    normalize(args.batch_size, args.pause, args.dry_run)
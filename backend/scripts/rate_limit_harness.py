@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Test harness for the shared Redis rate limiting backend
+Проверка общего ограничителя запросов на Redis
+
+Simulates several uvicorn workers, each with its own RateLimiter and Redis
+connection, against one Redis: by default an in-process fakeredis server
+(pip install "fakeredis[lua]"), or a real one with --redis-url. Checks that
+the limit holds across workers, that the Redis script and the in-process
+backend agree, that every check is one round trip and that an unreachable
+Redis falls back to per-process limits without being retried on every
+request.
+
+    python scripts/rate_limit_harness.py --workers 4
+    python scripts/rate_limit_harness.py --redis-url redis://localhost:6379/15
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import uuid
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.core.rate_limiting import MemoryRateLimitBackend, RateLimiter, RedisRateLimitBackend
+
+failures = []
+
+
+def check(name: str, ok: bool, detail: str = ""):
+    print(f"{'PASS' if ok else 'FAIL'}  {name}{f'  ({detail})' if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def client_factory(redis_url: str):
+    if redis_url:
+        import redis.asyncio as aioredis
+        return lambda: aioredis.from_url(redis_url)
+
+    import fakeredis
+    server = fakeredis.FakeServer()
+    return lambda: fakeredis.aioredis.FakeRedis(server=server)
+
+
+def count_round_trips(client) -> list:
+    """Count commands sent by ``client``; the counter is the returned list"""
+    counter = [0]
+    execute_command = client.execute_command
+
+    async def counting_execute_command(*args, **kwargs):
+        counter[0] += 1
+        return await execute_command(*args, **kwargs)
+
+    client.execute_command = counting_execute_command
+    return counter
+
+
+async def shared_limit(new_client, workers: int, requests: int):
+    prefix = f"harness:{uuid.uuid4().hex}:"
+    limiters = [RateLimiter(RedisRateLimitBackend(new_client(), prefix=prefix)) for _ in range(workers)]
+    limit = limiters[0].rules['sms']['requests']
+
+    results = await asyncio.gather(*(
+        limiters[i % workers].hit("ip:203.0.113.7:sms", 'sms') for i in range(requests)
+    ))
+    allowed = sum(1 for ok, _ in results if ok)
+    check("limit is shared by all workers", allowed == limit, f"{allowed} of {requests} allowed, limit {limit}")
+    blocked = [info for ok, info in results if not ok]
+    check("rejections carry retry_after", all(info['retry_after'] > 0 for info in blocked))
+
+    local = [RateLimiter(MemoryRateLimitBackend()) for _ in range(workers)]
+    results = [await local[i % workers].hit("ip:203.0.113.7:sms", 'sms') for i in range(requests)]
+    print(f"      per-process backend for comparison: {sum(1 for ok, _ in results if ok)} allowed")
+
+
+async def parity(new_client):
+    """Replay the same timeline through both backends"""
+    redis_backend = RedisRateLimitBackend(new_client(), prefix=f"harness:{uuid.uuid4().hex}:")
+    memory_backend = MemoryRateLimitBackend()
+    limit, window, block_duration = 5, 10, 20
+    timeline = [1000.0 + step * 0.7 for step in range(120)]
+
+    mismatches = 0
+    for now in timeline:
+        expected = memory_backend.consume("key", limit, window, block_duration, now)
+        actual = await redis_backend.hit("key", limit, window, block_duration, now)
+        if expected[0] != actual[0] or expected[1] != actual[1] or expected[3] != actual[3] \
+                or abs(expected[2] - actual[2]) > 1e-6:
+            mismatches += 1
+    check("Redis script matches in-process algorithm", mismatches == 0, f"{mismatches} of {len(timeline)} differ")
+
+
+async def round_trips(new_client, requests: int):
+    client = new_client()
+    limiter = RateLimiter(RedisRateLimitBackend(client, prefix=f"harness:{uuid.uuid4().hex}:"))
+    # The first call may load the script (NOSCRIPT, SCRIPT LOAD, retry)
+    await limiter.hit("ip:198.51.100.1:general", 'general')
+
+    counter = count_round_trips(client)
+    for i in range(requests):
+        await limiter.hit(f"ip:198.51.100.{i % 250}:general", 'general')
+    check("one round trip per check", counter[0] == requests, f"{counter[0]} commands for {requests} checks")
+
+
+async def fallback():
+    import redis.asyncio as aioredis
+
+    # Nothing listens on port 1
+    backend = RedisRateLimitBackend(aioredis.from_url("redis://127.0.0.1:1/0", socket_connect_timeout=0.2))
+    limiter = RateLimiter(backend)
+    limit = limiter.rules['login']['requests']
+    attempts = [0]
+    script = backend._script
+
+    async def counting_script(*args, **kwargs):
+        attempts[0] += 1
+        return await script(*args, **kwargs)
+
+    backend._script = counting_script
+    results = [await limiter.hit("ip:192.0.2.1:login", 'login') for _ in range(limit + 3)]
+    allowed = sum(1 for ok, _ in results if ok)
+    check("unreachable Redis falls back to per-process limits", allowed == limit, f"{allowed} allowed, limit {limit}")
+    check("unreachable Redis is retried after a backoff", attempts[0] == 1, f"{attempts[0]} attempts for {limit + 3} checks")
+
+    backend._retry_at = 0.0
+    await limiter.hit("ip:192.0.2.1:login", 'login')
+    check("backoff grows while Redis keeps failing", backend._backoff == 2 * backend.min_backoff, f"{backend._backoff}s")
+
+
+async def main(redis_url: str, workers: int):
+    new_client = client_factory(redis_url)
+    await shared_limit(new_client, workers, requests=50)
+    await parity(new_client)
+    await round_trips(new_client, requests=200)
+    await fallback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default="", help="use a real Redis instead of fakeredis")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.redis_url, args.workers))
+    sys.exit(1 if failures else 0)
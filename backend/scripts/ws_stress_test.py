@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+WebSocket registry stress test
+Нагрузочная проверка ConnectionManager
+
+Connects and disconnects a large number of simulated sockets concurrently
+(interleaved with broadcasts), then checks that the registry is consistent
+and reports the registry memory cost per connection.
+
+    python scripts/ws_stress_test.py --connections 100000 --users 40000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+# Add the app directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.core.websocket import ConnectionManager
+
+
+class FakeWebSocket:
+    """Minimal stand-in for starlette's WebSocket"""
+
+    __slots__ = ("sent",)
+
+    def __init__(self):
+        self.sent = 0
+
+    async def accept(self):
+        await asyncio.sleep(0)
+
+    async def send_text(self, text: str):
+        self.sent += 1
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def check_consistency(manager: ConnectionManager, expected: dict) -> list:
+    """Compare the registry against the expected user_id -> sockets map"""
+    errors = []
+    if manager.connection_count != sum(len(conns) for conns in expected.values()):
+        errors.append(f"connection_count={manager.connection_count} does not match expected")
+    if manager.user_count != len(expected):
+        errors.append(f"user_count={manager.user_count}, expected {len(expected)}")
+    if manager.heartbeat.stats()["active_connections"] != manager.connection_count:
+        errors.append("heartbeat registry is out of sync with the connection registry")
+    for user_id, conns in expected.items():
+        if manager.get_connections(user_id) != conns:
+            errors.append(f"user_id={user_id} has wrong connection set")
+            break
+    return errors
+
+
+async def run(connections: int, users: int, broadcasts: int) -> int:
+    manager = ConnectionManager()
+    rng = random.Random(42)
+    sockets = [(FakeWebSocket(), rng.randrange(users)) for _ in range(connections)]
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    # Phase 1: connect everything concurrently while broadcasts are running
+    started = time.perf_counter()
+    connect_tasks = [manager.connect(ws, user_id) for ws, user_id in sockets]
+    broadcast_tasks = [manager.broadcast("{}") for _ in range(broadcasts)]
+    await asyncio.gather(*connect_tasks, *broadcast_tasks)
+    connect_time = time.perf_counter() - started
+    del connect_tasks, broadcast_tasks
+
+    registry_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    expected = {}
+    for ws, user_id in sockets:
+        expected.setdefault(user_id, set()).add(ws)
+    errors = check_consistency(manager, {k: frozenset(v) for k, v in expected.items()})
+
+    # Phase 2: disconnect a random half concurrently with broadcasts
+    rng.shuffle(sockets)
+    half = len(sockets) // 2
+
+    async def disconnect(ws, user_id):
+        await asyncio.sleep(0)
+        manager.disconnect(ws, user_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(disconnect(ws, user_id) for ws, user_id in sockets[:half]),
+        *(manager.broadcast("{}") for _ in range(broadcasts)),
+    )
+    disconnect_time = time.perf_counter() - started
+
+    for ws, user_id in sockets[:half]:
+        expected[user_id].discard(ws)
+        if not expected[user_id]:
+            del expected[user_id]
+    errors += check_consistency(manager, {k: frozenset(v) for k, v in expected.items()})
+
+    # Phase 3: disconnect the rest, the registry must end up empty
+    for ws, user_id in sockets[half:]:
+        manager.disconnect(ws, user_id)
+    errors += check_consistency(manager, {})
+
+    print(f"Connections:            {connections} across {users} users")
+    print(f"Concurrent connect:     {connect_time:.2f}s")
+    print(f"Concurrent disconnect:  {disconnect_time:.2f}s (half)")
+    print(f"Registry memory:        {registry_bytes / connections:.0f} bytes/connection")
+
+    if errors:
+        for error in errors:
+            print(f"❌ {error}")
+        return 1
+    print("✅ Registry consistent")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=40_000)
+    parser.add_argument("--broadcasts", type=int, default=5)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.connections, args.users, args.broadcasts)))